@@ -16,16 +16,23 @@ Description:
 import json
 import logging
 import sys
-import time
+import threading
 
 from github_helpers import *
+from pipeline import (
+    LOCAL, NETWORK, Skip, Stage, campaign_stages, make_item_prs, run_campaign
+)
+from shell_helpers import *
 
 
 # Switch to DEBUG for additional debugging info
 logging.basicConfig(stream=sys.stderr, level=logging.INFO)
 LOG = logging.getLogger(__name__)
 
-def main(org, root_dir, exclude_private=False, interactive=False):
+def main(
+        org, root_dir, exclude_private=False, interactive=False, campaign=None,
+        order=None, work_queue=None
+    ):
     """
     Goes through all repos in an org, clones them, makes a new branch, copies
     specific files, commits them, creates a pull request, and merges the pull
@@ -36,11 +43,15 @@ def main(org, root_dir, exclude_private=False, interactive=False):
       `/Users/<uname>/path/to/dir`
     * exclude_private (bool): if True, script skips private repos (default
       False)
-    * interactive (bool): if True, pauses before committing files upstream and
-      awaits user confirmation
+    * interactive (bool): if True, each repo's commits wait in a review queue
+      (see review.py) and are only pushed once approved
+    * campaign, order, work_queue: optional; see `pipeline.run_campaign`
     """
     gh_headers = get_github_headers()
     branch_name = "tcril/depr-automation-workflow"
+    # a repo can only have an open PR from the branch if the preflight in
+    # run_campaign didn't drop it for already having the branch
+    existing_prs = OpenPrs(gh_headers, org, branch_name) if work_queue else None
     workflow_template_name = "add-depr-ticket-to-depr-board.yml"
     issue_template_name = "depr-ticket.yml"
     commit_msg_wkflow_only = "build: add DEPR workflow automation"
@@ -59,23 +70,39 @@ def main(org, root_dir, exclude_private=False, interactive=False):
     pr_failed = []
     repos_skipped = []
 
-    for repo_data in get_repos(gh_headers, org, exclude_private):
-        (rname, ssh_url, dbranch, has_issues, count) = repo_data
-        LOG.info("\n\n******* CHECKING REPO: {} ({}) ************".format(rname, count))
+    count = 0
+    # stage functions run on several threads at once, so the count and lists
+    # are only touched while holding this
+    lock = threading.Lock()
+
+    def clone(item):
+        nonlocal count
+        rname, repo_path = item["rname"], item["repo_path"]
+        LOG.info("\n\n******* CHECKING REPO: {} ({}) ************".format(rname, item["count"]))
+        with lock:
+            count = max(count, item["count"])
+        if existing_prs:
+            existing_prs.expect(rname)
 
-        repo_path = get_repo_path(rname, root_dir)
         # clone repo; if exists, checkout the default branch & pull latest
-        clone_repo(root_dir, repo_path, ssh_url, dbranch)
+        clone_repo(root_dir, repo_path, item["ssh_url"], item["dbranch"])
         if issue_config_exists(repo_path):
             # Some repos may already configure issues, so don't overwrite
             LOG.info("Skipping {} (don't want to overwrite config.yml)".format(rname))
-            repos_skipped.append([rname, "config exists"])
-            continue
+            with lock:
+                repos_skipped.append([rname, "config exists"])
+            raise Skip("config exists")
+        return item
+
+    def edit(item):
+        rname, repo_path, has_issues = item["rname"], item["repo_path"], item["has_issues"]
         if not new_branch(repo_path, branch_name):
             # this branch already exists
             LOG.info("Skipping {}, branch already exists".format(rname))
-            repos_skipped.append([rname, "branch exists"])
-            continue
+            with lock:
+                repos_skipped.append([rname, "branch exists"])
+            raise Skip("branch exists")
+        item["branch_name"] = branch_name
 
         add_files(
             root_dir,
@@ -84,30 +111,66 @@ def main(org, root_dir, exclude_private=False, interactive=False):
             has_issues,
             issue_template_name
         )
-        if interactive:
-            try:
-                interactive_commit(repo_path)
-            except RepoError:
-                # move on to next repo
-                continue
+        if not has_changes(repo_path):
+            # the edit was a no-op; don't commit, push or open a PR
+            LOG.info(f"Skipping {item['rname']}, nothing changed")
+            drop_branch(repo_path, item["dbranch"], branch_name)
+            return None
 
         # If the repo has issues only committing the workflow, otherwise also
         # committing the issue template and configuration
         commit_msg = commit_msg_wkflow_only if has_issues else commit_msg_with_issue
-        pr_details = pr_details_wkflow_only if has_issues else pr_details_with_issue
-
-        make_commit(repo_path, commit_msg)
-        try:
-            pr_url = make_pr(gh_headers, org, rname, branch_name, dbranch, pr_details)
-            prs.append(pr_url)
-        except PrCreationError as pr_err:
-            LOG.info(pr_err.__str__())
-            # info you need to retry
-            pr_failed.append((org, rname, branch_name, dbranch, pr_details))
-        # Without, you hit secondary rate limits if you have more than ~30
-        # repos. I tried 3, too short. 30, totally worked. there's a good number
-        # in between that i'm sure
-        time.sleep(5)
+        item["sha"] = make_commit(repo_path, commit_msg)
+        return item
+
+    def details(item):
+        return pr_details_wkflow_only if item["has_issues"] else pr_details_with_issue
+
+    def open_prs(items):
+        results = {}
+        to_open = []
+        for item in items:
+            existing = existing_prs.get(item["rname"]) if existing_prs else None
+            if existing:
+                # don't make a duplicate (GitHub would refuse it with a 422)
+                LOG.info(f" Reusing open PR {existing}")
+                item["pr_url"] = existing
+                with lock:
+                    prs.append(existing)
+                results[item["rname"]] = item
+            else:
+                to_open.append(item)
+
+        for item, result in zip(to_open, make_item_prs(gh_headers, org, to_open, details)):
+            rname = item["rname"]
+            with lock:
+                if isinstance(result, PrCreationError):
+                    # info you need to retry; the error journals this stage
+                    # as failed, so a re-run retries the PR
+                    LOG.info(result.__str__())
+                    pr_failed.append((org, rname, branch_name, item["dbranch"], details(item)))
+                else:
+                    prs.append(result["pr_url"])
+            results[rname] = result
+        return [results[item["rname"]] for item in items]
+
+    stages = campaign_stages(
+        [Stage("clone", clone, NETWORK), Stage("edit", edit, LOCAL)],
+        open_prs, interactive
+    )
+    # ask GraphQL which repos already have the branch, so those are never
+    # cloned
+    preflight_skipped = []
+    run_campaign(
+        campaign or f"add_depr_wkflw_issues:{branch_name}", stages, root_dir,
+        lambda: get_repos(gh_headers, org, exclude_private),
+        work_queue=work_queue, order=order,
+        sizes=lambda: get_repo_sizes(gh_headers, org, exclude_private),
+        skip_existing=lambda repos: skip_existing_branches(
+            repos, gh_headers, org, branch_name, skipped=preflight_skipped
+        )
+    )
+    repos_skipped.extend([rname, "branch exists"] for rname, _ in preflight_skipped)
 
     LOG.info(
         "Processed {} repos; see output/prs.json ({}) and output/failed.json ({})".format(
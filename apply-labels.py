@@ -18,22 +18,29 @@ import logging
 import os
 import sys
 import argparse
-import requests
 
 from github_helpers import (
+    SESSION,
     get_github_headers,
     get_repos_plus_keys
 )
+from plan import REST, Plan, PlanError, list_repos, rate_limits
 
 # Switch to DEBUG for additional debugging info
 logging.basicConfig(stream=sys.stderr, level=logging.DEBUG)
 LOG = logging.getLogger(__name__)
 
-def main(org, name, color, description, exclude_private=False):
+def main(org, name, color, description, exclude_private=False, plan=False):
     """
     Script entrypoint
+
+    If `plan` is set, only prints what labelling the org would cost (see
+    plan.py), and raises PlanError if it won't fit the rate limit.
     """
     gh_headers = get_github_headers()
+    if plan:
+        print(make_plan(gh_headers, org, exclude_private).check(rate_limits(gh_headers)))
+        return
 
     count = 0
     for repo in get_repos_plus_keys(gh_headers, org, exclude_private):
@@ -47,6 +54,17 @@ def main(org, name, color, description, exclude_private=False):
     LOG.info(f"Successfully standardised label '{name}' across {count} repos")
 
 
+def make_plan(gh_headers, org, exclude_private=False):
+    """
+    Returns a plan.Plan for labelling every repo in the org: one GET to look
+    for the label on each, then a PATCH or a POST
+    """
+    run_plan = Plan(f"label every repo in {org}")
+    run_plan.targets = len(list_repos(gh_headers, org, exclude_private, run_plan))
+    run_plan.per_target(REST, 2)
+    return run_plan
+
+
 def create_or_update_label(gh_headers, org, repo, name, color, description):
     """
     Looks for the label; if it's present, updates it with the specified color &
@@ -60,11 +78,11 @@ def create_or_update_label(gh_headers, org, repo, name, color, description):
 
     action = None
     # If label is present, 200; if not, 404
-    label_present_r = requests.get(fetch_label_url, headers=gh_headers)
+    label_present_r = SESSION.get(fetch_label_url, headers=gh_headers)
 
     if label_present_r.status_code == 200:
         LOG.info("Label {0} present on repo {1}, updating label".format(name, repo))
-        r = requests.patch(
+        r = SESSION.patch(
             fetch_label_url,
             headers=gh_headers,
             json={"name": name, "color": color, "description": description}
@@ -77,7 +95,7 @@ def create_or_update_label(gh_headers, org, repo, name, color, description):
         # Add the label
         LOG.info("didn't find the label")
         LOG.info(f"URL: {create_label_url}")
-        r = requests.post(
+        r = SESSION.post(
             create_label_url,
             headers=gh_headers,
             json={"name": name, "color": color, "description": description}
@@ -140,6 +158,16 @@ if __name__ == "__main__":
         action="store_true"
     )
 
+    parser.add_argument(
+        "--plan",
+        help="Just print the calls and time it would take, and whether it fits\
+            the rate limit (exits non-zero if it doesn't)",
+        action="store_true"
+    )
+
     args = parser.parse_args()
 
-    main(args.org, args.name, args.color, args.description, args.exclude_private)
+    try:
+        main(args.org, args.name, args.color, args.description, args.exclude_private, args.plan)
+    except PlanError as err:
+        sys.exit(str(err))
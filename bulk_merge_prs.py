@@ -20,16 +20,25 @@ import argparse
 import datetime
 import json
 import logging
-import requests
 import sys
 import time
 
-from github_helpers import get_github_headers
+from github_helpers import SESSION, get_github_headers
+from plan import REST, Plan, PlanError, rate_limits
 
 logging.basicConfig(stream=sys.stderr, level=logging.INFO)
 LOG = logging.getLogger(__name__)
 
-def main(path_to_file):
+def main(path_to_file, plan=False):
+    """
+    Merges each PR in the json list at `path_to_file`. If `plan` is set,
+    only prints what that would cost (see plan.py), and raises PlanError if
+    it won't fit the rate limit.
+    """
+    if plan:
+        gh_headers = get_github_headers()
+        print(make_plan(path_to_file).check(rate_limits(gh_headers)))
+        return
     stamp = str(datetime.datetime.now())[:19]
     path_to_failures = "/Users/sarinacanelake/openedx/gh-scripting/output/closed_failures_" + stamp + ".json"
     gh_headers = get_github_headers()
@@ -46,7 +55,7 @@ def main(path_to_file):
             LOG.info("********* Closing: {}".format(pr))
             org, repo, number = parse_fields(pr)
             merge_url = "https://api.github.com/repos/{0}/{1}/pulls/{2}/merge".format(org, repo, number)
-            response = requests.put(merge_url, headers=gh_headers, json=params)
+            response = SESSION.put(merge_url, headers=gh_headers, json=params)
 
             sc = response.status_code
             if sc == 200:
@@ -57,7 +66,7 @@ def main(path_to_file):
                 # rebase before merging. Two repos require squashing, the rest
                 # require approvals. To keep it simple, let's only re-try w/ rebase.
                 if rjson["message"] == "Merge commits are not allowed on this repository.":
-                    response = requests.put(merge_url, headers=gh_headers, json=rebase_params)
+                    response = SESSION.put(merge_url, headers=gh_headers, json=rebase_params)
                     sc = response.status_code
                     if sc == 200:
                         LOG.info(" Merged - Success!\n")
@@ -74,6 +83,20 @@ def main(path_to_file):
         f.write(json.dumps(failures))
 
 
+def make_plan(path_to_file):
+    """
+    Returns a plan.Plan for merging the PRs in the json list at
+    `path_to_file`: a PUT each, with a 2s pause after each
+    """
+    with open(path_to_file) as f:
+        prs = json.load(f)
+    run_plan = Plan(f"merge the PRs in {path_to_file}", len(prs))
+    run_plan.per_target(REST, 1)
+    run_plan.pause = 2 * len(prs)
+    run_plan.note("repos that don't allow merge commits take a second PUT, to rebase")
+    return run_plan
+
+
 def parse_fields(pr):
     """
     given: https://github.com/<org>/<repo>/pull/<num>
@@ -95,7 +118,17 @@ if __name__ == "__main__":
         help="file to read from"
     )
 
-    args = parser.parse_args()
-    main(
-        args.file
+    parser.add_argument(
+        "--plan",
+        help="Just print the calls and time it would take, and whether it fits\
+            the rate limit (exits non-zero if it doesn't)",
+        action="store_true"
     )
+
+    args = parser.parse_args()
+    try:
+        main(
+            args.file, args.plan
+        )
+    except PlanError as err:
+        sys.exit(str(err))
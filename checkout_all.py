@@ -14,6 +14,7 @@ from github_helpers import (
   get_repos,
   get_repo_path
 )
+from shell_helpers import CommandTimeout
 
 logging.basicConfig(stream=sys.stderr, level=logging.INFO)
 LOG = logging.getLogger(__name__)
@@ -25,7 +26,11 @@ def clone_all(org, root_dir):
         LOG.info("\n\n******* CHECKING REPO: {} ({}) ************".format(rname, count))
         repo_path = get_repo_path(rname, root_dir)
         # clone repo; if exists, checkout the default branch & pull latest
-        clone_repo(root_dir, repo_path, ssh_url, dbranch)
+        try:
+            clone_repo(root_dir, repo_path, ssh_url, dbranch)
+        except CommandTimeout as err:
+            # move on; one hung clone shouldn't stop the rest
+            LOG.info(f" {err}")
 
 if __name__ == "__main__":
     root_dir = "/Users/sarinacanelake/openedx/"
@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+"""
+Records every command run through `shell_helpers` (`run`, and so `git`,
+`git_run` and friends, plus `grep_lines`): the command and git subcommand,
+the repo it ran in, how long it took, its exit code and how much it printed.
+
+Each command is added to a running duration histogram for its
+command/subcommand (with the total time per repo, to find the slowest), so
+memory grows with the number of repos rather than of commands run, e.g. in
+daemon.py. When the script exits they're logged as a short table, and
+written out as JSON and as Prometheus text (for the node_exporter textfile
+collector, or just for diffing between runs), so it's plain whether a
+campaign is slow because of clone, pull, push or local commits, and which
+repo is to blame.
+
+The median git and git-network durations are saved for `plan.py`.
+"""
+import atexit
+import json
+import logging
+import os
+import shlex
+import sys
+import threading
+
+from collections import Counter, defaultdict
+
+from http_metrics import percentile
+
+
+logging.basicConfig(stream=sys.stderr, level=logging.INFO)
+LOG = logging.getLogger(__name__)
+
+JSON_PATH = "output/command_metrics.json"
+PROMETHEUS_PATH = "output/command_metrics.prom"
+
+# Log the summary table when the script exits
+SUMMARY_AT_EXIT = True
+
+# Upper bounds (seconds) of the histogram buckets
+BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600]
+
+# Repos kept per command/subcommand, slowest first
+TOP_REPOS = 5
+
+# git subcommands that go out to the network (as in shell_helpers)
+NETWORK_SUBCOMMANDS = {"clone", "fetch", "pull", "push", "ls-remote"}
+
+
+def describe(args, cwd):
+    """
+    Returns (command, subcommand, repo) for a command line (a list, or a
+    string run through the shell) run in `cwd`. The subcommand is git's
+    (`fetch`, `commit`, ...), or "" for other commands. The repo is the
+    directory the command ran in, or for a clone the one it cloned into.
+    """
+    if isinstance(args, str):
+        args = shlex.split(args)
+    args = [str(arg) for arg in args]
+    command = os.path.basename(args[0]) if args else ""
+    subcommand = ""
+    if command == "git" and len(args) > 1:
+        subcommand = args[1]
+    repo = os.path.basename(str(cwd).rstrip("/"))
+    if subcommand == "clone" and len(args) > 2:
+        repo = os.path.basename(args[-1].rstrip("/"))
+    return command, subcommand, repo
+
+
+class Histogram:
+    """
+    Durations of one command/subcommand: bucket counts, sum, max, failures,
+    timeouts, output sizes, and total time per repo
+    """
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.failures = 0
+        self.timeouts = 0
+        self.stdout_bytes = 0
+        self.stderr_bytes = 0
+        self.repos = Counter()
+
+    def add(self, repo, duration, returncode, stdout_bytes, stderr_bytes, timed_out):
+        index = next((i for i, bound in enumerate(BUCKETS) if duration <= bound), len(BUCKETS))
+        self.buckets[index] += 1
+        self.count += 1
+        self.sum += duration
+        self.max = max(self.max, duration)
+        self.failures += returncode != 0
+        self.timeouts += timed_out
+        self.stdout_bytes += stdout_bytes
+        self.stderr_bytes += stderr_bytes
+        self.repos[repo] += duration
+
+    def percentile(self, pct):
+        return percentile(BUCKETS, self.buckets, pct, self.max)
+
+    def to_json(self):
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 3),
+            "max": round(self.max, 3),
+            "p50": round(self.percentile(50), 3),
+            "failures": self.failures,
+            "timeouts": self.timeouts,
+            "stdout_bytes": self.stdout_bytes,
+            "stderr_bytes": self.stderr_bytes,
+            "buckets": dict(zip([str(b) for b in BUCKETS] + ["+Inf"], self.buckets)),
+            "slowest_repos": {
+                repo: round(seconds, 3) for repo, seconds in self.repos.most_common(TOP_REPOS)
+            },
+        }
+
+
+class Recorder:
+    """
+    Collects a Histogram per (command, subcommand)
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.histograms = defaultdict(Histogram)
+
+    def record(self, args, cwd, duration, returncode, stdout_bytes, stderr_bytes, timed_out):
+        command, subcommand, repo = describe(args, cwd)
+        with self._lock:
+            self.histograms[(command, subcommand)].add(
+                repo, duration, returncode, stdout_bytes, stderr_bytes, timed_out
+            )
+
+    def to_json(self):
+        with self._lock:
+            return {
+                f"{command} {subcommand}".strip(): histogram.to_json()
+                for (command, subcommand), histogram in sorted(self.histograms.items())
+            }
+
+    def to_prometheus(self):
+        """
+        Returns the histograms in Prometheus text exposition format
+        """
+        name = "gh_scripting_command_duration_seconds"
+        lines = [
+            f"# HELP {name} Wall time of commands run by gh-scripting",
+            f"# TYPE {name} histogram",
+        ]
+        counters = []
+        with self._lock:
+            for (command, subcommand), histogram in sorted(self.histograms.items()):
+                labels = f'command="{command}",subcommand="{subcommand}"'
+                cumulative = 0
+                for bound, count in zip([str(b) for b in BUCKETS] + ["+Inf"], histogram.buckets):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+                lines.append(f"{name}_sum{{{labels}}} {histogram.sum:.6f}")
+                lines.append(f"{name}_count{{{labels}}} {histogram.count}")
+                counters.append((labels, histogram))
+
+        for metric, text, value in (
+                ("failures_total", "Commands that exited non-zero", lambda h: h.failures),
+                ("timeouts_total", "Commands killed for running too long", lambda h: h.timeouts),
+            ):
+            lines.append(f"# HELP gh_scripting_command_{metric} {text}")
+            lines.append(f"# TYPE gh_scripting_command_{metric} counter")
+            for labels, histogram in counters:
+                lines.append(f"gh_scripting_command_{metric}{{{labels}}} {value(histogram)}")
+        lines.append("# HELP gh_scripting_command_output_bytes_total Bytes commands printed")
+        lines.append("# TYPE gh_scripting_command_output_bytes_total counter")
+        for labels, histogram in counters:
+            lines.append(
+                f'gh_scripting_command_output_bytes_total{{{labels},stream="stdout"}} {histogram.stdout_bytes}'
+            )
+            lines.append(
+                f'gh_scripting_command_output_bytes_total{{{labels},stream="stderr"}} {histogram.stderr_bytes}'
+            )
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        """
+        Returns a printable table of the commands, most total time first
+        """
+        with self._lock:
+            items = sorted(self.histograms.items(), key=lambda item: -item[1].sum)
+            lines = [
+                f"  {'calls':>6} {'fail':>5} {'total':>8} {'p50':>7} {'max':>7}  command (slowest repo)"
+            ]
+            for (command, subcommand), histogram in items:
+                slowest = histogram.repos.most_common(1)[0]
+                lines.append(
+                    f"  {histogram.count:>6} {histogram.failures:>5} {histogram.sum:>7.1f}s"
+                    f" {histogram.percentile(50):>6.2f}s {histogram.max:>6.2f}s"
+                    f"  {f'{command} {subcommand}'.strip()} ({slowest[0]}: {slowest[1]:.1f}s)"
+                )
+        return "\n".join(lines)
+
+    def median_latencies(self):
+        """
+        Returns the median seconds of git's network and local subcommands,
+        keyed as in plan.py, estimated from their histograms added together
+        """
+        merged = {}
+        with self._lock:
+            for (command, subcommand), histogram in self.histograms.items():
+                if command != "git":
+                    continue
+                kind = "git-network" if subcommand in NETWORK_SUBCOMMANDS else "git"
+                buckets, top = merged.get(kind, ([0] * len(histogram.buckets), 0.0))
+                merged[kind] = (
+                    [a + b for a, b in zip(buckets, histogram.buckets)],
+                    max(top, histogram.max)
+                )
+        return {
+            kind: percentile(BUCKETS, buckets, 50, top)
+            for kind, (buckets, top) in merged.items()
+        }
+
+    def finish(self):
+        """
+        Logs the summary, writes the JSON and Prometheus files, and saves
+        the git medians for plan.py
+        """
+        if not self.histograms:
+            return
+        if SUMMARY_AT_EXIT:
+            LOG.info("\nCommands run:\n" + self.summary())
+        try:
+            with open(JSON_PATH, "w") as f:
+                json.dump(self.to_json(), f, indent=4)
+            with open(PROMETHEUS_PATH, "w") as f:
+                f.write(self.to_prometheus())
+        except OSError as err:
+            # e.g. no output/ directory where the script was run from
+            LOG.info(f" Not writing command metrics: {err}")
+        from plan import save_latencies
+        save_latencies(self.median_latencies())
+
+
+RECORDER = Recorder()
+atexit.register(RECORDER.finish)
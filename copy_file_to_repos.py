@@ -12,10 +12,15 @@ Description:
 
 import datetime
 import logging
+import os
 import sys
-import time
+import threading
 
+from file_helpers import rewrite_file
 from github_helpers import *
+from pipeline import (
+    LOCAL, NETWORK, Skip, Stage, campaign_stages, make_item_prs, run_campaign
+)
 from shell_helpers import *
 
 
@@ -27,7 +32,8 @@ def main(
         org, root_dir, branch_name, src_file_path,
         dest_file_path, commit_msg, pr_body,
         exclude_private=False, interactive=False,
-        select_repos=None, commit_on_existing=False
+        select_repos=None, commit_on_existing=False, campaign=None, order=None,
+        work_queue=None
     ):
     """
     Goes through all repos in an org, clones them, makes a new branch, copies
@@ -45,13 +51,20 @@ def main(
     * pr_body (str): body message of the PR
     * exclude_private (bool): optional; if True, script skips private repos (default
       False)
-    * interactive (bool): optional; if True, pauses before committing files upstream and
-      awaits user confirmation
+    * interactive (bool): optional; if True, each repo's commits wait in a review queue
+      (see review.py) and are only pushed once approved
     * select_repos (list): optional; if set, only these repos will be processed
     * commit_on_existing (bool): if True, will commit on an already-created branch of
       name `branch_name`. Default behavior is to skip repos with `branch_name` defined. If True, a new PR will not be made.
+    * campaign, order, work_queue: optional; see `pipeline.run_campaign`.
+      The campaign defaults to one per branch_name
     """
     gh_headers = get_github_headers()
+    # a repo can only have an open PR from the branch if the preflight in
+    # run_campaign didn't drop it for already having the branch
+    existing_prs = (
+        OpenPrs(gh_headers, org, branch_name) if work_queue or commit_on_existing else None
+    )
     pr_details = {
         "title": commit_msg,
         "body": pr_body
@@ -60,69 +73,139 @@ def main(
     count_commits = 0
     count_skipped = 0
     count_failed = 0
+    count = 0
 
     ts = str(datetime.datetime.now())[:19]
     filename = f"output/copy_file_{ts}.json"
-    with open(filename, "w") as f:
-        for repo_data in get_repos(gh_headers, org, exclude_private):
-            (rname, ssh_url, dbranch, _, count) = repo_data
-            LOG.info("\n\n******* CHECKING REPO: {} ({}) ************".format(rname, count))
-            if select_repos and rname not in select_repos:
-                LOG.info(f"Skipping repo {rname}")
-                count_skipped += 1
-                f.write(f"NOT ON LIST: {rname}\n")
-                continue
+    # stage functions run on several threads at once, so the output file and
+    # counters are only touched while holding this
+    lock = threading.Lock()
+
+    def clone(item):
+        nonlocal count
+        rname = item["rname"]
+        LOG.info("\n\n******* CHECKING REPO: {} ({}) ************".format(rname, item["count"]))
+        with lock:
+            count = max(count, item["count"])
+        if existing_prs:
+            existing_prs.expect(rname)
+
+        # clone repo; if exists, checkout the default branch & pull latest
+        clone_repo(root_dir, item["repo_path"], item["ssh_url"], item["dbranch"])
+        return item
 
-            repo_path = get_repo_path(rname, root_dir)
-            # clone repo; if exists, checkout the default branch & pull latest
-            clone_repo(root_dir, repo_path, ssh_url, dbranch)
-            branch_found = False
-            if not new_branch(repo_path, branch_name):
-                if commit_on_existing:
-                    branch_found = True
-                    checkout(repo_path, branch_name)
-                else:
-                    # this branch already exists
-                    LOG.info(f"Skipping {rname}, branch already exists")
+    def edit(item):
+        nonlocal count_skipped
+        rname, repo_path = item["rname"], item["repo_path"]
+        item["branch_found"] = False
+        if not new_branch(repo_path, branch_name):
+            if commit_on_existing:
+                item["branch_found"] = True
+                checkout(repo_path, branch_name)
+            else:
+                # this branch already exists
+                LOG.info(f"Skipping {rname}, branch already exists")
+                with lock:
                     f.write(f"BRANCH EXISTS: {rname}")
                     count_skipped += 1
-                    continue
-
-            full_dest_path = add_files(
-                repo_path,
-                src_file_path,
-                dest_file_path
-            )
-            swap_string_in_file("\$default-branch", dbranch, full_dest_path, repo_path)
-            if interactive:
-                try:
-                    interactive_commit(repo_path)
-                except RepoError:
-                    # move on to next repo
-                    continue
-
-            make_commit(repo_path, commit_msg)
-            if commit_on_existing and  branch_found:
+                raise Skip("branch exists")
+        item["branch_name"] = branch_name
+        # the branch may already have commits; only review this run's
+        item["base_sha"] = head_sha(repo_path)
+
+        full_dest_path = add_files(
+            repo_path,
+            src_file_path,
+            dest_file_path
+        )
+        swap_string_in_file("$default-branch", item["dbranch"], full_dest_path, repo_path)
+        if not has_changes(repo_path):
+            # the edit was a no-op; don't commit, push or open a PR
+            LOG.info(f"Skipping {item['rname']}, nothing changed")
+            if not item["branch_found"]:
+                drop_branch(repo_path, item["dbranch"], branch_name)
+            return None
+
+        item["sha"] = make_commit(repo_path, commit_msg)
+        return item
+
+    def open_prs(items):
+        nonlocal count_commits, count_failed
+        results = {}
+        to_open = []
+        for item in items:
+            rname = item["rname"]
+            if commit_on_existing and item["branch_found"]:
                 # If we're committing on an existing branch, assume we are
                 # updating the branches and don't need a new PR
-                time.sleep(5)
+                results[rname] = item
                 continue
+            existing = existing_prs.get(rname) if existing_prs else None
+            if existing:
+                # don't make a duplicate (GitHub would refuse it with a 422)
+                LOG.info(f"Reusing open PR {existing}")
+                item["pr_url"] = existing
+                with lock:
+                    f.write(f"SUCCESS: {rname}\nPR: {existing}")
+                    count_commits += 1
+                results[rname] = item
+                continue
+            to_open.append(item)
+
+        for item, result in zip(to_open, make_item_prs(gh_headers, org, to_open, pr_details)):
+            rname, dbranch = item["rname"], item["dbranch"]
+            if isinstance(result, PrCreationError):
+                # info you need to retry; the error journals this stage as
+                # failed, so a re-run retries the PR
+                LOG.info(f"Failed on {rname} with {result}")
+                with lock:
+                    f.write(f"FAILED: ({org}, {rname}, {branch_name}, {dbranch}, {pr_details})")
+                    count_failed += 1
+            else:
+                LOG.info(f"Successfully made {result['pr_url']}")
+                with lock:
+                    f.write(f"SUCCESS: {rname}\nPR: {result['pr_url']}")
+                    count_commits += 1
+            results[rname] = result
+        return [results[item["rname"]] for item in items]
 
-            try:
-                pr_url = make_pr(gh_headers, org, rname, branch_name, dbranch, pr_details)
-                f.write(f"SUCCESS: {rname}\nPR: {pr_url}")
-                LOG.info(f"Successfully made {pr_url}")
-                count_commits += 1
-            except PrCreationError as pr_err:
-                LOG.info(pr_err.__str__())
-                # info you need to retry
-                LOG.info(f"Failed on {rname} with {pr_err}")
-                f.write(f"FAILED: ({org}, {rname}, {branch_name}, {dbranch}, {pr_details})")
+    def not_on_list(rname):
+        nonlocal count_skipped
+        LOG.info(f"Skipping repo {rname}")
+        with lock:
+            count_skipped += 1
+            f.write(f"NOT ON LIST: {rname}\n")
+
+    # ask GraphQL which repos already have the branch, so those are never
+    # cloned
+    preflight_skipped = []
+
+    def skip_existing(repos):
+        return skip_existing_branches(
+            repos, gh_headers, org, branch_name, skipped=preflight_skipped
+        )
+
+    stages = campaign_stages(
+        [Stage("clone", clone, NETWORK), Stage("edit", edit, LOCAL)],
+        open_prs, interactive
+    )
+
+    with open(filename, "w") as f:
+        _, failed = run_campaign(
+            campaign or f"copy_file:{branch_name}", stages, root_dir,
+            lambda: get_repos(gh_headers, org, exclude_private),
+            work_queue=work_queue, order=order,
+            sizes=lambda: get_repo_sizes(gh_headers, org, exclude_private),
+            select_repos=select_repos, on_unselected=not_on_list,
+            skip_existing=None if commit_on_existing else skip_existing
+        )
+        for item, stage_name, err in failed:
+            if not isinstance(err, PrCreationError):
+                f.write(f"FAILED IN {stage_name}: {item['rname']} ({err})\n")
                 count_failed += 1
-            # Without, you hit secondary rate limits if you have more than ~30
-            # repos. I tried 3, too short. 30, totally worked. there's a good number
-            # in between that i'm sure
-            time.sleep(5)
+        for rname, status in preflight_skipped:
+            f.write(f"BRANCH EXISTS: {rname} ({status})\n")
+            count_skipped += 1
 
     LOG.info(
         f"Processed {count} repos; {count_commits} successes, {count_skipped} skipped, {count_failed} failures\n\nFull output logged in {filename}"
@@ -147,18 +230,20 @@ def add_files(repo_path, src_file_path, dest_file_path):
     full_dest_path = repo_path + dest_file_path
 
     cp(repo_path, src_file_path, full_dest_path)
+    if os.path.isdir(full_dest_path):
+        # cp put the file inside the directory
+        full_dest_path = os.path.join(full_dest_path, os.path.basename(src_file_path))
     return full_dest_path
 
 
 def swap_string_in_file(old_string, new_string, file_path, repo_path):
-    proc = subprocess.Popen(
-        f"/usr/bin/sed -i '' -e 's/{old_string}/{new_string}/g' {file_path}",
-        cwd=repo_path,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        shell=True        
-    )
-    _ = proc.communicate()
+    """
+    Replaces every occurrence of `old_string` in the file at `file_path` with
+    `new_string` (see `file_helpers.rewrite_file`). `repo_path` is only used
+    to resolve a relative `file_path`.
+    """
+    rewrite_file(os.path.join(repo_path, file_path), old_string, new_string)
+
 
 if __name__ == "__main__":
 
@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+"""
+Usage:
+    python daemon.py serve root_dir
+    python daemon.py ping | refresh [org] | repos org | grep [-o org] pattern | label org name color description repo [repo ...]
+
+Requires:
+    GITHUB_TOKEN in local environment (for the server)
+
+Description:
+    Long-running process that keeps the expensive parts of a script run warm
+    between runs: the GitHub auth headers and pooled HTTP connections, each
+    org's repo inventory, and an index of past `git grep` results over the
+    clones in root_dir. Scripts (or you, from the command line) send it jobs
+    over a Unix socket, one JSON line each way, so a small job answers in
+    milliseconds instead of paying for imports, auth and paging through the
+    org every time.
+
+    Jobs:
+    * ping: is it up, and since when
+    * refresh [org]: forget the cached inventory (and grep index), e.g. after
+      repos were added to the org
+    * repos org: the org's repos, as `github_helpers.get_repos` 5-tuples
+    * grep pattern: {"hits": {repo: matching lines}, "timed_out": [repo]}
+      over the clones in root_dir (or just the org's, with an org). A repo's
+      results are reused until the commit searched changes, or for a
+      working-tree search, until files are edited, staged or committed. A
+      repo whose search timed out is listed in "timed_out" and searched
+      again next time
+    * label org name color description repo...: runs apply-labels on just
+      these repos
+
+    `fleet_grep.py -D` sends its search here, and `github_helpers.get_repos`
+    lists an org from here when the daemon is up.
+"""
+import argparse
+import importlib.util
+import json
+import logging
+import os
+import socket
+import socketserver
+import sys
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+logging.basicConfig(stream=sys.stderr, level=logging.INFO)
+LOG = logging.getLogger(__name__)
+
+SOCKET_PATH = "output/daemon.sock"
+
+# Seconds `ask` waits on the daemon before giving up on it as if it were down
+ASK_TIMEOUT = 60
+
+
+class DaemonError(Exception):
+    pass
+
+
+class State:
+    """
+    Everything the daemon keeps between jobs. Built once, at start-up.
+
+    * root_dir (str): where the repos are cloned
+    """
+    def __init__(self, root_dir):
+        # imported here, so clients that only talk to the socket don't pay
+        # for github_helpers' imports
+        from github_helpers import get_github_headers
+
+        self.root_dir = root_dir
+        self.started = time.time()
+        self.gh_headers = get_github_headers()
+        self._lock = threading.Lock()
+        # (org, exclude_private) -> list of get_repos 5-tuples
+        self._inventory = {}
+        # grep arguments -> {repo: (stamp, matching lines)}
+        self._index = {}
+        self._labels = None
+
+    def repos(self, org, exclude_private=False):
+        # not get_repos, which would ask this daemon
+        from github_helpers import page_repos
+
+        key = (org, exclude_private)
+        with self._lock:
+            repos = self._inventory.get(key)
+        if repos is None:
+            # paged without the lock, so other jobs (e.g. a ping, or another
+            # org) aren't held up; if two jobs race, the first one in wins
+            repos = list(page_repos(self.gh_headers, org, exclude_private))
+            with self._lock:
+                repos = self._inventory.setdefault(key, repos)
+        return repos
+
+    def refresh(self, org=None):
+        with self._lock:
+            for key in list(self._inventory):
+                if org is None or key[0] == org:
+                    del self._inventory[key]
+            self._index = {}
+        return "ok"
+
+    def grep(
+            self, pattern, fixed=True, rev=None, include=None, exclude=None,
+            org=None, exclude_private=False, workers=16
+        ):
+        from fleet_grep import local_repos
+        from github_helpers import get_repo_path
+        from shell_helpers import CommandTimeout, grep_lines
+
+        key = json.dumps([pattern, fixed, rev, include, exclude])
+        with self._lock:
+            index = self._index.setdefault(key, {})
+        if org:
+            names = [repo[0] for repo in self.repos(org, exclude_private)]
+        else:
+            names = local_repos(self.root_dir)
+
+        def search(rname):
+            repo_path = get_repo_path(rname, self.root_dir)
+            if not os.path.exists(repo_path):
+                return rname, []
+            stamp = _stamp(repo_path, rev)
+            with self._lock:
+                cached = index.get(rname)
+            if stamp is not None and cached and cached[0] == stamp:
+                return rname, cached[1]
+            try:
+                hits = [
+                    list(hit) for hit in
+                    grep_lines(pattern, repo_path, fixed, rev, include, exclude)
+                ]
+            except CommandTimeout as err:
+                # not cached, and not reported as no hits
+                LOG.info(f" {rname}: {err}")
+                return rname, None
+            if stamp is not None:
+                with self._lock:
+                    index[rname] = (stamp, hits)
+            return rname, hits
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            results = dict(pool.map(search, names))
+        return {
+            "hits": {rname: hits for rname, hits in sorted(results.items()) if hits},
+            "timed_out": sorted(rname for rname, hits in results.items() if hits is None),
+        }
+
+    def label(self, org, repos, name, color, description):
+        if self._labels is None:
+            # apply-labels.py isn't importable by name, because of the dash
+            spec = importlib.util.spec_from_file_location(
+                "apply_labels",
+                os.path.join(os.path.dirname(os.path.abspath(__file__)), "apply-labels.py")
+            )
+            self._labels = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(self._labels)
+        for repo in repos:
+            self._labels.create_or_update_label(
+                self.gh_headers, org, repo, name, color, description
+            )
+        return repos
+
+    def ping(self):
+        return {"pid": os.getpid(), "up_since": self.started}
+
+
+def _stamp(repo_path, rev=None):
+    """
+    Returns what a grep over the repo depends on: the commit `rev` points at,
+    or for a working-tree grep, the commit HEAD points at plus every tracked
+    file that differs from it (with its mtime and size, so another edit to a
+    file that was already modified counts too). Returns None if that can't
+    be worked out, and the results shouldn't be cached.
+    """
+    from shell_helpers import git_run
+
+    result = git_run("rev-parse", ["--verify", "-q", f"{rev or 'HEAD'}^{{commit}}"], repo_path)
+    if result.returncode or result.timed_out:
+        return None
+    stamp = [result.stdout.decode().strip()]
+    if rev:
+        return stamp
+    # untracked files are left out, as git grep doesn't search them
+    result = git_run("status", ["--porcelain", "-z", "-uno"], repo_path)
+    if result.returncode or result.timed_out:
+        return None
+    for entry in filter(None, result.stdout.decode("utf-8", "replace").split("\0")):
+        try:
+            info = os.stat(os.path.join(repo_path, entry[3:]))
+            stamp.append([entry, info.st_mtime_ns, info.st_size])
+        except OSError:
+            # deleted, or the old name of a rename
+            stamp.append([entry])
+    return stamp
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        request = json.loads(self.rfile.readline())
+        job, args = request["job"], request.get("args", {})
+        start = time.monotonic()
+        try:
+            if job not in ("ping", "refresh", "repos", "grep", "label"):
+                raise DaemonError(f"unknown job {job!r}")
+            response = {"result": getattr(self.server.state, job)(**args)}
+        except Exception as err:
+            LOG.info(f" {job} failed: {err!r}")
+            response = {"error": repr(err)}
+        LOG.info(f" {job} took {time.monotonic() - start:.3f}s")
+        self.wfile.write(json.dumps(response).encode() + b"\n")
+
+
+def serve(root_dir, path=SOCKET_PATH):
+    """
+    Runs the daemon until it's interrupted. Jobs are handled on their own
+    threads, so a long grep doesn't hold up a ping.
+    """
+    if os.path.exists(path):
+        os.unlink(path)
+    with socketserver.ThreadingUnixStreamServer(path, _Handler) as server:
+        server.daemon_threads = True
+        server.state = State(root_dir)
+        LOG.info(f" Listening on {path}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.unlink(path)
+
+
+def ask(job, path=SOCKET_PATH, timeout=ASK_TIMEOUT, **args):
+    """
+    Sends a job to the daemon and returns its result. Raises DaemonError if
+    the daemon isn't running, doesn't answer within `timeout` seconds, or the
+    job failed.
+    """
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(timeout)
+            sock.connect(path)
+            sock.sendall(json.dumps({"job": job, "args": args}).encode() + b"\n")
+            with sock.makefile("rb") as f:
+                response = json.loads(f.readline())
+    except (FileNotFoundError, ConnectionRefusedError) as err:
+        raise DaemonError(f"daemon isn't running on {path} ({err})")
+    except (OSError, ValueError) as err:
+        # timed out, or went away mid-job; callers carry on without it
+        raise DaemonError(f"daemon on {path} didn't answer ({err!r})")
+    if "error" in response:
+        raise DaemonError(response["error"])
+    return response["result"]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Runs, or sends a job to, the daemon that keeps auth, repo\
+            inventories and grep results warm between script runs."
+    )
+    parser.add_argument(
+        "-s", "--socket",
+        help=f"Unix socket to listen/connect on (default {SOCKET_PATH})",
+        default=SOCKET_PATH
+    )
+    jobs = parser.add_subparsers(dest="job", required=True)
+
+    serve_p = jobs.add_parser("serve", help="Run the daemon")
+    serve_p.add_argument("root_dir", help="Directory the repos are cloned into")
+
+    jobs.add_parser("ping", help="Check the daemon is up")
+
+    refresh_p = jobs.add_parser("refresh", help="Drop cached inventories")
+    refresh_p.add_argument("org", nargs="?")
+
+    repos_p = jobs.add_parser("repos", help="List an org's repos")
+    repos_p.add_argument("org")
+    repos_p.add_argument("-P", "--exclude-private", action="store_true")
+
+    grep_p = jobs.add_parser("grep", help="Which repos contain a string")
+    grep_p.add_argument("pattern")
+    grep_p.add_argument("-o", "--org")
+    grep_p.add_argument("-E", "--regex", action="store_true")
+    grep_p.add_argument("-r", "--rev")
+
+    label_p = jobs.add_parser("label", help="Create or update a label on some repos")
+    label_p.add_argument("org")
+    label_p.add_argument("name")
+    label_p.add_argument("color")
+    label_p.add_argument("description")
+    label_p.add_argument("repos", nargs="+")
+
+    args = parser.parse_args()
+    if args.job == "serve":
+        serve(args.root_dir, args.socket)
+        sys.exit()
+
+    if args.job == "ping":
+        result = ask("ping", args.socket)
+    elif args.job == "refresh":
+        result = ask("refresh", args.socket, org=args.org)
+    elif args.job == "repos":
+        result = ask("repos", args.socket, org=args.org, exclude_private=args.exclude_private)
+    elif args.job == "grep":
+        found = ask(
+            "grep", args.socket, org=args.org, pattern=args.pattern,
+            fixed=not args.regex, rev=args.rev
+        )
+        result = {
+            "hits": {rname: len(lines) for rname, lines in found["hits"].items()},
+            "timed_out": found["timed_out"],
+        }
+    else:
+        result = ask(
+            "label", args.socket, org=args.org, repos=args.repos, name=args.name,
+            color=args.color, description=args.description
+        )
+    print(json.dumps(result, indent=4))
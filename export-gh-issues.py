@@ -15,12 +15,10 @@ import argparse
 from datetime import datetime
 import json
 import logging
-from pandas import json_normalize
 
-import requests
 import sys
 
-from github_helpers import get_github_headers
+from github_helpers import SESSION, get_github_headers
 
 logging.basicConfig(stream=sys.stderr, level=logging.INFO)
 LOG = logging.getLogger(__name__)
@@ -52,7 +50,7 @@ def get_and_filter_issues(all_repos, gh_headers, export_filename, raw, label=Non
     for repo in all_repos:
         LOG.info("grabbing repo {0}".format(repo))
         url = "https://api.github.com/repos/openedx/{repo}/issues".format(repo=repo)
-        all_issues = all_issues + requests.get(url, headers=gh_headers).json()
+        all_issues = all_issues + SESSION.get(url, headers=gh_headers).json()
 
     saved_issues = []
 
@@ -124,6 +122,8 @@ def get_and_filter_issues(all_repos, gh_headers, export_filename, raw, label=Non
         # Append the edited issue to the list of issues we're saving
         saved_issues.append(issue)
     if csv:
+        # pandas takes a while to import, and only the csv output needs it
+        from pandas import json_normalize
         issue_dataframe = json_normalize(saved_issues)
         issue_dataframe.to_csv(export_filename, index=False)
 
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+"""
+Helpers for rewriting files inside a checked-out repo in plain Python, rather
+than shelling out to `sed`.
+"""
+import math
+import mmap
+import multiprocessing
+import os
+import stat
+import tempfile
+import threading
+
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from itertools import repeat
+
+
+# Once a repo has more candidate files (or bytes) than this, `rewrite_files`
+# splits the work over a process pool instead of doing one file at a time
+PARALLEL_FILE_COUNT = 200
+PARALLEL_BYTE_COUNT = 64 * 1024 * 1024
+
+# One pool of cpu_count workers for the whole process, shared by every caller,
+# so pipeline stages rewriting several repos at once don't each start a pool
+# of their own. Workers are spawned rather than forked, as forking a process
+# with threads running can copy a held lock into the child.
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def is_binary(file_path, sniff_bytes=8000):
+    """
+    Returns bool: True if there's a NUL byte in the first `sniff_bytes` bytes
+    of the file (the same check git and grep use), else False
+    """
+    with open(file_path, "rb") as f:
+        return b"\0" in f.read(sniff_bytes)
+
+
+def rewrite_file(file_path, old_string, new_string):
+    """
+    Replaces every occurrence of `old_string` in the file at `file_path` with
+    `new_string`.
+
+    The file is mmap'd and searched in place, so it never gets copied into a
+    Python string. If there's a match, the new contents are streamed to a temp
+    file next to the original, given the original's mode bits, and moved over
+    it with `os.replace`, so a file is never left half-written. Symlinks are
+    left alone (the file they point to gets rewritten on its own if it's in
+    the repo).
+
+    Returns bool: True if the file was changed, else False
+    """
+    if os.path.islink(file_path):
+        return False
+
+    old = old_string.encode()
+    new = new_string.encode()
+    with open(file_path, "rb") as f:
+        st = os.fstat(f.fileno())
+        # can't mmap an empty file, and there's nothing to swap in one anyway
+        if st.st_size == 0:
+            return False
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            pos = mm.find(old)
+            if pos == -1:
+                return False
+
+            fd, tmp_path = tempfile.mkstemp(
+                dir=os.path.dirname(file_path), prefix=".swap-"
+            )
+            try:
+                # writing memoryview slices hands the mapped pages straight to
+                # write() without copying them into bytes objects first
+                with os.fdopen(fd, "wb") as tmp, memoryview(mm) as view:
+                    start = 0
+                    while pos != -1:
+                        tmp.write(view[start:pos])
+                        tmp.write(new)
+                        start = pos + len(old)
+                        pos = mm.find(old, start)
+                    tmp.write(view[start:])
+                os.chmod(tmp_path, stat.S_IMODE(st.st_mode))
+                os.replace(tmp_path, file_path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+    return True
+
+
+def rewrite_files(file_paths, old_string, new_string, processes=None):
+    """
+    Runs `rewrite_file` over every file in `file_paths`.
+
+    Small repos are done serially. Once the number of files or their total
+    size goes over PARALLEL_FILE_COUNT / PARALLEL_BYTE_COUNT, the files are
+    split over a process pool: the one shared by every caller in the process
+    (one worker per core), or a pool of its own with `processes` workers.
+    The workers are spawned, so they import the calling script afresh; its
+    top-level code needs the usual `if __name__ == "__main__":` guard.
+
+    Returns a sorted list of the files that were changed.
+    """
+    file_paths = list(file_paths)
+    total_bytes = sum(os.lstat(path).st_size for path in file_paths)
+
+    if len(file_paths) < PARALLEL_FILE_COUNT and total_bytes < PARALLEL_BYTE_COUNT:
+        results = [rewrite_file(path, old_string, new_string) for path in file_paths]
+    else:
+        workers = processes or os.cpu_count() or 1
+        # a few chunks per worker keeps them busy without paying for a round
+        # trip to the pool per file
+        chunksize = max(1, math.ceil(len(file_paths) / (workers * 4)))
+        args = (rewrite_file, file_paths, repeat(old_string), repeat(new_string))
+        if processes:
+            with _new_pool(processes) as pool:
+                results = list(pool.map(*args, chunksize=chunksize))
+        else:
+            pool = _shared_pool()
+            try:
+                results = list(pool.map(*args, chunksize=chunksize))
+            except BrokenProcessPool:
+                # a worker died; start a fresh pool for the next caller
+                _drop_pool(pool)
+                raise
+
+    return sorted(path for path, changed in zip(file_paths, results) if changed)
+
+
+def _new_pool(workers):
+    return ProcessPoolExecutor(
+        max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+    )
+
+
+def _shared_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = _new_pool(os.cpu_count() or 1)
+        return _pool
+
+
+def _drop_pool(pool):
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False)
@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+"""
+Usage:
+    python fleet_grep.py -h
+
+Description:
+    Searches every repo cloned under `root_dir` at the same time, and streams
+    one JSON line per match to stdout as results come in:
+
+        {"repo": ..., "file": ..., "line": ..., "column": ..., "text": ...}
+
+    Once every repo is done, logs a hit count per repo, and the repos whose
+    search timed out (to stderr, so stdout stays pure JSONL).
+
+    The output can be fed back into the replace scripts with `repos_with_hits`,
+    e.g. as `select_repos` for `replace_string.main` or
+    `copy_file_to_repos.main`.
+
+    With --org, only repos that belong to the org (per the GitHub API, which
+    needs GITHUB_TOKEN) are searched; otherwise every git repo in root_dir is.
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+import threading
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from shell_helpers import CommandTimeout, grep_lines
+
+
+logging.basicConfig(stream=sys.stderr, level=logging.INFO)
+LOG = logging.getLogger(__name__)
+
+
+def main(
+        root_dir, pattern, fixed=True, rev=None, include=None, exclude=None,
+        org=None, exclude_private=False, workers=16, out=sys.stdout,
+        daemon=False
+    ):
+    """
+    Searches every clone under root_dir for `pattern`, writing JSONL matches
+    to `out` as they come in.
+
+    * root_dir (str): path to the directory the repos are cloned into
+    * pattern (str): what to look for
+    * fixed (bool): if True, pattern is a literal string, else a regex
+    * rev (str): optional; search this rev (e.g. `origin/HEAD`) instead of
+      each working tree
+    * include, exclude (list): optional git pathspecs to limit the search
+    * org (str): optional; only search clones of this org's repos
+    * exclude_private (bool): with `org`, skips the org's private repos
+    * workers (int): how many repos to search at once
+    * daemon (bool): if True, have a running daemon.py do the search, reusing
+      its cached results for repos that haven't changed since its last search
+
+    Returns a dict of {repo name: number of matching lines}. Repos whose
+    search timed out are left out (their matches so far are still written).
+    """
+    if daemon:
+        from daemon import ask
+        found = ask(
+            "grep", pattern=pattern, fixed=fixed, rev=rev, include=include,
+            exclude=exclude, org=org, exclude_private=exclude_private,
+            workers=workers
+        )
+        hits = found["hits"]
+        if found["timed_out"]:
+            LOG.info(f" TIMED OUT (not searched): {', '.join(found['timed_out'])}")
+        for rname, lines in hits.items():
+            for path, line_no, column, text in lines:
+                record = {
+                    "repo": rname, "file": path, "line": line_no,
+                    "column": column, "text": text
+                }
+                out.write(json.dumps(record) + "\n")
+        return {rname: len(lines) for rname, lines in hits.items()}
+
+    repo_names = local_repos(root_dir)
+    if org:
+        from github_helpers import get_github_headers, get_repos_plus_keys
+        in_org = {
+            repo[0] for repo in
+            get_repos_plus_keys(get_github_headers(), org, exclude_private)
+        }
+        repo_names = [name for name in repo_names if name in in_org]
+
+    LOG.info(f" Searching {len(repo_names)} repos for {pattern!r}")
+    lock = threading.Lock()
+
+    def search(rname):
+        hits = 0
+        repo_path = os.path.join(root_dir, rname)
+        for path, line_no, column, text in grep_lines(
+                pattern, repo_path, fixed, rev, include, exclude
+            ):
+            record = {
+                "repo": rname, "file": path, "line": line_no,
+                "column": column, "text": text
+            }
+            with lock:
+                out.write(json.dumps(record) + "\n")
+                out.flush()
+            hits += 1
+        return hits
+
+    counts = {}
+    timed_out = []
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(search, rname): rname for rname in repo_names}
+        for future in as_completed(futures):
+            try:
+                counts[futures[future]] = future.result()
+            except CommandTimeout as err:
+                # one huge or wedged repo shouldn't cost the rest
+                LOG.info(f" {futures[future]}: {err}")
+                timed_out.append(futures[future])
+
+    hit_repos = {rname: n for rname, n in sorted(counts.items()) if n}
+    for rname, n in hit_repos.items():
+        LOG.info(f"  {rname}: {n}")
+    LOG.info(
+        f" {sum(hit_repos.values())} matching lines in {len(hit_repos)} of {len(counts)} repos"
+    )
+    if timed_out:
+        LOG.info(f" TIMED OUT (not fully searched): {', '.join(sorted(timed_out))}")
+    return counts
+
+
+def local_repos(root_dir):
+    """
+    Returns a sorted list of the names of the git repos directly under root_dir
+    """
+    return sorted(
+        name for name in os.listdir(root_dir)
+        if os.path.exists(os.path.join(root_dir, name, ".git"))
+    )
+
+
+def repos_with_hits(jsonl_path):
+    """
+    Reads the output of a fleet_grep run and returns a sorted list of the
+    repos that had at least one match.
+    """
+    repos = set()
+    with open(jsonl_path) as f:
+        for line in f:
+            if line.strip():
+                repos.add(json.loads(line)["repo"])
+    return sorted(repos)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Searches every repo cloned under root_dir in parallel and\
+            streams the matching lines as JSONL (repo, file, line, column,\
+            text), then logs a hit count per repo."
+    )
+
+    parser.add_argument(
+        "root_dir",
+        help="Directory the repos are cloned into"
+    )
+
+    parser.add_argument(
+        "pattern",
+        help="String (or with -E, regex) to search for"
+    )
+
+    parser.add_argument(
+        "-E", "--regex",
+        help="Treat the pattern as an extended regex instead of a literal string",
+        action="store_true"
+    )
+
+    parser.add_argument(
+        "-r", "--rev",
+        help="Search this rev (e.g. origin/HEAD) instead of the working trees"
+    )
+
+    parser.add_argument(
+        "-i", "--include",
+        help="Git pathspec to limit the search to; can be given more than once",
+        action="append"
+    )
+
+    parser.add_argument(
+        "-x", "--exclude",
+        help="Git pathspec to leave out of the search; can be given more than once",
+        action="append"
+    )
+
+    parser.add_argument(
+        "-o", "--org",
+        help="Only search clones of this org's repos (needs GITHUB_TOKEN)"
+    )
+
+    parser.add_argument(
+        "-P", "--exclude-private",
+        help="With --org, skip the org's private repos",
+        action="store_true"
+    )
+
+    parser.add_argument(
+        "-j", "--workers",
+        help="How many repos to search at once (default 16)",
+        type=int,
+        default=16
+    )
+
+    parser.add_argument(
+        "-D", "--daemon",
+        help="Have the running daemon.py do the search (root_dir is the daemon's)",
+        action="store_true"
+    )
+
+    args = parser.parse_args()
+    main(
+        args.root_dir, args.pattern, fixed=not args.regex, rev=args.rev,
+        include=args.include, exclude=args.exclude, org=args.org,
+        exclude_private=args.exclude_private, workers=args.workers,
+        daemon=args.daemon
+    )
@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+"""
+Usage:
+    python fleet_sync.py [-h] [--full] [-j WORKERS] [-s STATE] org root_dir
+
+Requires:
+    GITHUB_TOKEN in local environment
+
+Description:
+    Keeps the clones in root_dir current without pulling every repo. Polls the
+    org's events feed (`/orgs/{org}/events`) with the ETag from last time, so
+    an unchanged feed costs one request that doesn't count against the rate
+    limit. From the PushEvents, CreateEvents and RepositoryEvents since the
+    last sync it works out which repos changed, and fetches just those
+    (cloning new ones). Repos that were created, renamed, archived or deleted
+    are noted in the inventory kept in the state file.
+
+    Repos whose fetch fails or times out are kept as pending in the state
+    file and fetched on the next run, and the cursor isn't moved past their
+    events until they've synced.
+
+    The feed only goes back 300 events. If the last event we saw has fallen
+    out of it (or there's no state yet, or --full is given), every repo in
+    the org is fetched instead.
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from github_helpers import SESSION, get_github_headers, get_repo_path, get_repos
+from shell_helpers import git_run
+
+
+logging.basicConfig(stream=sys.stderr, level=logging.INFO)
+LOG = logging.getLogger(__name__)
+
+DEFAULT_PATH = "output/fleet_sync.json"
+
+# The events API hands out at most 3 pages of 100
+EVENT_PAGES = 3
+
+# Events that mean a repo has new commits or refs to fetch
+CHANGE_EVENTS = {"PushEvent", "CreateEvent", "DeleteEvent"}
+
+
+def main(org, root_dir, full=False, workers=8, path=DEFAULT_PATH):
+    """
+    Syncs root_dir with `org`, fetching only what changed since the last run
+    where the events feed allows it.
+
+    * org (str): GitHub organization
+    * root_dir (str): where the repos are cloned
+    * full (bool): if True, fetch every repo regardless of the feed
+    * workers (int): how many repos to fetch at once
+    * path (str): where the sync state (cursor, ETag, inventory, repos still
+      to sync) is kept
+
+    Returns the sorted list of repos that were fetched or cloned.
+    """
+    gh_headers = get_github_headers()
+    state = load_state(path)
+    org_state = state.setdefault(
+        org, {"etag": None, "cursor": None, "inventory": {}, "pending": []}
+    )
+    pending = set(org_state.get("pending", []))
+
+    # read the feed even for a full sync, to set the cursor for next time
+    had_cursor = bool(org_state["cursor"])
+    changed, newest, complete = changed_repos(gh_headers, org, org_state)
+
+    if full or not had_cursor or not complete:
+        LOG.info(f" Full sync of {org}")
+        names = [repo[0] for repo in get_repos(gh_headers, org, False)]
+    else:
+        LOG.info(
+            f" {len(changed)} repos changed since the last sync,"
+            f" {len(pending - set(changed))} more left from before"
+        )
+        names = sorted(set(changed) | pending)
+
+    inventory = org_state["inventory"]
+    names = [
+        name for name in names
+        if inventory.get(name, {}).get("status") not in ("deleted", "renamed")
+    ]
+
+    def sync(name):
+        repo_path = get_repo_path(name, root_dir)
+        if os.path.exists(repo_path):
+            result = git_run("fetch", ["origin", "--prune"], repo_path)
+        else:
+            result = git_run("clone", [f"git@github.com:{org}/{name}.git"], root_dir)
+        if result.timed_out or result.returncode:
+            reason = "timed out" if result.timed_out else (
+                result.stderr.decode("utf-8", "replace").strip()
+            )
+            LOG.info(f" {name}: {result.args[1]} failed ({reason})")
+            return None
+        return name
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        synced = sorted(name for name in pool.map(sync, names) if name)
+
+    failed = set(names) - set(synced)
+    org_state["pending"] = sorted(failed)
+    # repos that were already pending are remembered there, so only a new
+    # failure holds the cursor back (a repo that always fails mustn't push
+    # the cursor out of the feed and force full syncs)
+    held = [int(changed[name]) for name in failed - pending if name in changed]
+    if held:
+        # read the failed repos' events again next time; the feed has to be
+        # fetched in full for that, so forget the ETag
+        org_state["cursor"] = str(min(held) - 1)
+        org_state["etag"] = None
+    else:
+        org_state["cursor"] = newest
+
+    save_state(state, path)
+    LOG.info(f" Synced {len(synced)} repos, {len(failed)} left pending")
+    return synced
+
+
+def changed_repos(gh_headers, org, org_state):
+    """
+    Reads the org's events feed back to the cursor (the newest event id seen
+    on the last sync), updating the ETag and inventory in org_state. The
+    cursor is left for the caller to move once the repos have synced.
+
+    Returns a 3-tuple of:
+    - changed (dict): {repo name: id of its oldest event since the cursor}
+      for every repo with something to fetch
+    - newest (str): id of the newest event in the feed
+    - complete (bool): False if the feed doesn't reach back to the cursor,
+      and a full sync is needed
+    """
+    url = f"https://api.github.com/orgs/{org}/events"
+    headers = dict(gh_headers)
+    if org_state["etag"]:
+        headers["If-None-Match"] = org_state["etag"]
+    response = SESSION.get(url, headers=headers, params={"per_page": 100})
+    if response.status_code == 304:
+        # nothing new; 304s don't count against the rate limit
+        return {}, org_state["cursor"], True
+    response.raise_for_status()
+    org_state["etag"] = response.headers.get("ETag")
+
+    cursor = org_state["cursor"]
+    events = response.json()
+    new_cursor = events[0]["id"] if events else cursor
+
+    # the feed is newest first; gather everything after the cursor, then
+    # replay it oldest first so e.g. a delete wins over an earlier push
+    since_cursor = []
+    reached_cursor = False
+    pages = 1
+    while True:
+        for event in events:
+            if cursor and int(event["id"]) <= int(cursor):
+                reached_cursor = True
+                break
+            since_cursor.append(event)
+        if reached_cursor or pages >= EVENT_PAGES or "next" not in response.links:
+            break
+        response = SESSION.get(response.links["next"]["url"], headers=gh_headers)
+        response.raise_for_status()
+        events = response.json()
+        pages += 1
+
+    changed = {}
+    for event in reversed(since_cursor):
+        _apply_event(event, changed, org_state["inventory"])
+
+    if cursor and not reached_cursor:
+        LOG.info(" The events feed doesn't reach back to the last sync")
+        return changed, new_cursor, False
+    return changed, new_cursor, True
+
+
+def _apply_event(event, changed, inventory):
+    """
+    Adds the event's repo to `changed` (with the event's id, if it's the
+    first for the repo) if it has something to fetch, and notes
+    created/renamed/archived/deleted repos in `inventory`
+    """
+    name = event["repo"]["name"].split("/", 1)[1]
+    now = time.strftime("%Y-%m-%dT%H:%M:%S")
+    if event["type"] in CHANGE_EVENTS:
+        changed.setdefault(name, event["id"])
+    elif event["type"] == "RepositoryEvent":
+        action = event["payload"].get("action")
+        if action == "renamed":
+            old = event["payload"]["changes"]["repository"]["name"]["from"]
+            inventory.setdefault(old, {}).update(
+                {"status": "renamed", "renamed_to": name, "seen": now}
+            )
+            inventory.setdefault(name, {}).update({"status": "active", "seen": now})
+            changed.setdefault(name, event["id"])
+        elif action in ("created", "archived", "unarchived", "deleted"):
+            status = {"created": "active", "unarchived": "active"}.get(action, action)
+            inventory.setdefault(name, {}).update({"status": status, "seen": now})
+            if action == "deleted":
+                changed.pop(name, None)
+            else:
+                changed.setdefault(name, event["id"])
+
+
+def load_state(path=DEFAULT_PATH):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def save_state(state, path=DEFAULT_PATH):
+    with open(path, "w") as f:
+        json.dump(state, f, indent=4, sort_keys=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Fetches only the repos that changed since the last sync,\
+            per the org's events feed, falling back on fetching everything\
+            when the feed doesn't reach back far enough."
+    )
+
+    parser.add_argument(
+        "org",
+        help="Name of the organization"
+    )
+
+    parser.add_argument(
+        "root_dir",
+        help="Directory the repos are cloned into"
+    )
+
+    parser.add_argument(
+        "--full",
+        help="Fetch every repo, whatever the events feed says",
+        action="store_true"
+    )
+
+    parser.add_argument(
+        "-j", "--workers",
+        help="How many repos to fetch at once (default 8)",
+        type=int,
+        default=8
+    )
+
+    parser.add_argument(
+        "-s", "--state",
+        help=f"Sync state file (default {DEFAULT_PATH})",
+        default=DEFAULT_PATH
+    )
+
+    args = parser.parse_args()
+    print(json.dumps(main(args.org, args.root_dir, args.full, args.workers, args.state), indent=4))
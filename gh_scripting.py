@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""
+Usage:
+    python gh_scripting.py [-h] command [args ...]
+
+Description:
+    One entry point for the command-line scripts in this repo. Each command
+    runs the script it wraps exactly as `python <script> [args ...]` would,
+    but only that script is imported, so `python gh_scripting.py journal ...`
+    doesn't pay for pandas or the GitHub client. Run
+    `python gh_scripting.py <command> -h` for a command's own arguments.
+
+    `python gh_scripting.py imports` times how long the shared modules take
+    to import, and exits non-zero if one is over its budget in IMPORT_BUDGETS.
+
+    Tip: `alias gh-scripting="python /path/to/gh_scripting.py"`
+"""
+import os
+import runpy
+import subprocess
+import sys
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# command -> (script it runs, what it does)
+COMMANDS = {
+    "labels": ("apply-labels.py", "Create or update a label on every repo in an org"),
+    "merge-prs": ("bulk_merge_prs.py", "Merge each PR in a json list of PRs"),
+    "export-issues": ("export-gh-issues.py", "Export a repo's issues to json or csv"),
+    "licenses": ("licensing-check.py", "Report which repos have which licenses"),
+    "pr-query": ("parse_pr_query.py", "List the repos & branches of a PR search"),
+    "grep": ("fleet_grep.py", "Search every clone at once"),
+    "journal": ("journal.py", "Show how far a campaign got"),
+    "queue": ("workqueue.py", "Fill or check a shared campaign work queue"),
+    "daemon": ("daemon.py", "Run, or send a job to, the warm-state daemon"),
+    "ratelimit": ("ratelimit.py", "Watch the rate limits, and which scripts are using them"),
+    "clone-all": ("checkout_all.py", "Clone (or pull) every repo in the org"),
+    "sync": ("fleet_sync.py", "Fetch just the repos that changed since the last sync"),
+}
+
+# Most seconds each module may take to import in a fresh interpreter.
+# Anything that talks to the GitHub API pays for `requests`; the rest should
+# stay well under that.
+IMPORT_BUDGETS = {
+    "journal": 0.05,
+    "workqueue": 0.05,
+    "daemon": 0.05,
+    "shell_helpers": 0.06,
+    "fleet_grep": 0.08,
+    "github_helpers": 0.25,
+    "pipeline": 0.3,
+}
+
+
+def usage():
+    lines = [__doc__.strip(), "", "Commands:"]
+    width = max(len(name) for name in COMMANDS)
+    for name, (script, text) in COMMANDS.items():
+        lines.append(f"    {name.ljust(width)}  {text} ({script})")
+    lines.append(f"    {'imports'.ljust(width)}  Check import times against their budgets")
+    return "\n".join(lines)
+
+
+def run_command(name, args):
+    """
+    Runs the script behind `name` as __main__, with `args` as its arguments
+    """
+    script = os.path.join(HERE, COMMANDS[name][0])
+    sys.argv = [script] + args
+    sys.path.insert(0, HERE)
+    runpy.run_path(script, run_name="__main__")
+
+
+def import_time(module):
+    """
+    Returns how many seconds `module` takes to import (including everything
+    it imports) in a fresh interpreter, per `python -X importtime`
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=HERE, capture_output=True, text=True, check=True
+    )
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        parts = [part.strip() for part in line.split("|")]
+        if len(parts) == 3 and parts[2] == module:
+            return int(parts[1]) / 1e6
+    raise RuntimeError(f"no import time reported for {module}")
+
+
+def check_imports():
+    """
+    Prints each module's import time next to its budget. Returns the number
+    of modules over budget.
+    """
+    over = 0
+    for module, budget in IMPORT_BUDGETS.items():
+        seconds = import_time(module)
+        status = "ok"
+        if seconds > budget:
+            status = "OVER"
+            over += 1
+        print(f"{module:16} {seconds * 1000:7.1f}ms  (budget {budget * 1000:.0f}ms)  {status}")
+    return over
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] in ("-h", "--help"):
+        print(usage())
+        sys.exit(0)
+
+    command, args = sys.argv[1], sys.argv[2:]
+    if command == "imports":
+        sys.exit(1 if check_imports() else 0)
+    if command not in COMMANDS:
+        sys.exit(f"Unknown command {command!r}\n\n{usage()}")
+    run_command(command, args)
@@ -4,20 +4,79 @@ Wrappers for calls to the github api, as well as shell commands that
  begin with `git`.
 """
 
-import github as gh_api
+import hashlib
+import json
 import logging
 import os
 import requests
-import subprocess
 import sys
+import threading
+import time
 
-from  shell_helpers import git
+from  http_metrics import RECORDER as HTTP_METRICS
+from  shell_helpers import found_in_rev, git, run
 
 
 # Switch to DEBUG for additional debugging info
 logging.basicConfig(stream=sys.stderr, level=logging.INFO)
 LOG = logging.getLogger(__name__)
 
+# Shared by every API call, so they reuse pooled connections to api.github.com
+# (which matters most in a long-lived process, see daemon.py)
+SESSION = requests.Session()
+
+# Every API response's rate limit headers get a line here, tagged with the
+# script that made the call, so `ratelimit.py` can say who's spending what.
+# Set to None to turn it off. Once it's over USAGE_LOG_MAX_BYTES it's moved to
+# USAGE_LOG + ".1" (replacing the one before) and a new log is started.
+USAGE_LOG = "output/api_usage.jsonl"
+USAGE_LOG_MAX_BYTES = 5 * 1024 * 1024
+_usage_lock = threading.Lock()
+
+
+def token_id(token):
+    """
+    Returns a short, non-reversible id for a token, to tell credentials
+    apart in logs without writing the token itself
+    """
+    return hashlib.sha1(token.encode()).hexdigest()[:8]
+
+
+def _log_usage(response, *args, **kwargs):
+    """
+    SESSION response hook: appends the response's rate limit headers to
+    USAGE_LOG. Polls of /rate_limit are left out, as they're free and
+    `ratelimit.py --watch` makes a lot of them.
+    """
+    headers = response.headers
+    if not USAGE_LOG or "X-RateLimit-Resource" not in headers:
+        return
+    if response.url.split("?")[0].endswith("/rate_limit"):
+        return
+    auth = response.request.headers.get("Authorization", "")
+    entry = {
+        "time": time.time(),
+        "script": os.path.basename(sys.argv[0]) or "python",
+        "token": token_id(auth.split()[-1]) if auth else None,
+        "resource": headers["X-RateLimit-Resource"],
+        "used": int(headers.get("X-RateLimit-Used", 0)),
+        "remaining": int(headers.get("X-RateLimit-Remaining", 0)),
+        "limit": int(headers.get("X-RateLimit-Limit", 0)),
+        "reset": int(headers.get("X-RateLimit-Reset", 0)),
+    }
+    try:
+        with _usage_lock, open(USAGE_LOG, "a") as f:
+            f.write(json.dumps(entry) + "\n")
+            if f.tell() > USAGE_LOG_MAX_BYTES:
+                os.replace(USAGE_LOG, USAGE_LOG + ".1")
+    except OSError:
+        # e.g. no output/ directory where the script was run from
+        pass
+
+
+SESSION.hooks["response"].append(_log_usage)
+SESSION.hooks["response"].append(HTTP_METRICS.record)
+
 def get_repo_names(gh_headers, org, exclude_private):
     """
     Generator
@@ -27,24 +86,21 @@ def get_repo_names(gh_headers, org, exclude_private):
     params = {"page": 1}
     if exclude_private:
         params["type"] = "public"
-    response = requests.get(org_url, headers=gh_headers, params=params).json()
+    response = SESSION.get(org_url, headers=gh_headers, params=params).json()
     while len(response) > 0:
         for repo_data in response:
             assert not repo_data['private']
             yield repo_data['name']
         params["page"] = params["page"] + 1
-        response = requests.get(org_url, headers=gh_headers, params=params).json()
+        response = SESSION.get(org_url, headers=gh_headers, params=params).json()
 
 
 def get_github_headers() -> dict:
     """
-    Load GH personal access token from file.
+    Returns the request headers for the GitHub API, authenticated with the
+    personal access token in the GITHUB_TOKEN environment variable.
     """
     gh_token = os.environ["GITHUB_TOKEN"]
-    LOG.info(" Authenticating.")
-    gh_client = gh_api.Github(gh_token)
-    LOG.info(" Authenticated.")
-
     gh_headers = {"AUTHORIZATION": f"token {gh_token}"}
     return gh_headers
 
@@ -60,13 +116,31 @@ def get_repos(gh_headers, org, exclude_private):
     - count (running count of number of repos given)
 
     * exclude_private (bool): if True, excludes private repos
+
+    If daemon.py is running, the repos come from its cached inventory (see
+    `daemon.py refresh` to re-list them); otherwise they're paged from the API.
+    """
+    from daemon import DaemonError, ask
+
+    try:
+        repos = ask("repos", org=org, exclude_private=exclude_private)
+    except DaemonError:
+        yield from page_repos(gh_headers, org, exclude_private)
+        return
+    for repo in repos:
+        yield tuple(repo)
+
+
+def page_repos(gh_headers, org, exclude_private):
+    """
+    Like `get_repos`, but always pages through the API
     """
     org_url = "https://api.github.com/orgs/{0}/repos".format(org)
     params = {"page": 1}
     if exclude_private:
         params["type"] = "public"
     count = 0
-    response = requests.get(org_url, headers=gh_headers, params=params).json()
+    response = SESSION.get(org_url, headers=gh_headers, params=params).json()
     while len(response) > 0:
        for repo_data in response:
            count += 1
@@ -78,7 +152,7 @@ def get_repos(gh_headers, org, exclude_private):
                count
            )
        params["page"] = params["page"] + 1
-       response = requests.get(org_url, headers=gh_headers, params=params).json()
+       response = SESSION.get(org_url, headers=gh_headers, params=params).json()
 
 
 def get_repos_plus_keys(gh_headers, org, exclude_private, keys=None):
@@ -96,7 +170,7 @@ def get_repos_plus_keys(gh_headers, org, exclude_private, keys=None):
     params = {"page": 1}
     if exclude_private:
         params["type"] = "public"
-    response = requests.get(org_url, headers=gh_headers, params=params).json()
+    response = SESSION.get(org_url, headers=gh_headers, params=params).json()
     while len(response) > 0:
         for repo_data in response:
             result = [repo_data['name']]
@@ -105,7 +179,15 @@ def get_repos_plus_keys(gh_headers, org, exclude_private, keys=None):
                     result.append(repo_data[key])
             yield result
         params["page"] = params["page"] + 1
-        response = requests.get(org_url, headers=gh_headers, params=params).json()
+        response = SESSION.get(org_url, headers=gh_headers, params=params).json()
+
+
+def get_repo_sizes(gh_headers, org, exclude_private):
+    """
+    Returns a dict of {repo name: size in KB} for every repo in `org`, from
+    the API's `size` field (see schedule.py)
+    """
+    return dict(get_repos_plus_keys(gh_headers, org, exclude_private, ["size"]))
 
 
 def clone_repo(root_dir, repo_path, ssh_url, default_branch):
@@ -124,22 +206,65 @@ def clone_repo(root_dir, repo_path, ssh_url, default_branch):
         git("pull", [], repo_path)
 
 
+def fetch_repo(root_dir, repo_path, ssh_url, default_branch, branches=()):
+    """
+    Makes sure the latest commit on the repo's default_branch is in the local
+    object database, without touching the working tree. If not already cloned
+    into root_dir, clones the repo with no checkout; if cloned, fetches
+    default_branch from origin, plus any of `branches` (e.g. a campaign's
+    existing branch) that origin has.
+
+    Returns the rev that was fetched (`origin/<default_branch>`), which can be
+    searched with `found_in_rev` and then checked out with `checkout_fetched`
+    only if the repo needs to be edited.
+    """
+    if not os.path.exists(repo_path):
+        git("clone", ["--no-checkout", ssh_url], root_dir)
+    else:
+        git("fetch", ["origin", default_branch], repo_path)
+        for branch in branches:
+            # fetched on their own, since a branch the repo doesn't have
+            # fails the whole fetch
+            git("fetch", ["origin", branch], repo_path)
+    return f"origin/{default_branch}"
+
+
+def checkout_fetched(repo_path, default_branch):
+    """
+    Checks out default_branch at the commit last fetched by `fetch_repo`. Also
+    fills in the working tree of a `--no-checkout` clone. Doesn't go back out
+    to the network.
+    """
+    git("checkout", ["-B", default_branch, f"origin/{default_branch}"], repo_path)
+
+
 def new_branch(repo_path, branch_name):
     """
-    Creates and pushes to remote a new branch called branch_name
+    Creates (locally) and checks out a new branch called branch_name. Nothing
+    is pushed until `push_branch` is called, once the branch's commits are all
+    made.
 
     Returns False if branch_name already exists
     """
-    _, err = git("checkout", ["-b", branch_name], repo_path)
-    err = err.decode('utf-8')
-    branch_error = f"fatal: a branch named '{branch_name}' already exists"
-    if branch_error in err:
+    # ask git directly rather than parsing its (localized, version-dependent)
+    # error message
+    out, _ = git("branch", ["--list", branch_name], repo_path)
+    if out.strip():
         return False
-
-    git("push", ["-u", "origin", branch_name], repo_path)
+    git("checkout", ["-b", branch_name], repo_path)
     return True
 
 
+def drop_branch(repo_path, default_branch, branch_name):
+    """
+    Undoes `new_branch`: switches back to default_branch, throwing away any
+    uncommitted changes, and deletes branch_name locally. Used when an edit
+    came to nothing, so a later run can make the branch afresh.
+    """
+    git("checkout", ["-f", default_branch], repo_path)
+    git("branch", ["-D", branch_name], repo_path)
+
+
 def checkout(repo_path, branch_name):
     """
     Checks out the git branch `branch_name` within the repo denoted
@@ -150,35 +275,96 @@ def checkout(repo_path, branch_name):
 
 def checkout_branch(repo_path, branch_name):
     """
-    Tries to check out existing branch, branch_name
+    Tries to check out existing branch, branch_name. A branch that's only on
+    origin (as of the last fetch) is checked out as a new local branch
+    tracking it.
 
     Returns False if branch_name does not exist
     """
-    _, err = git("checkout", [branch_name], repo_path)
-    err = err.decode('utf-8')
-    branch_error = f"error: pathspec '{branch_name}' did not match any file(s) known to git"
-    if branch_error in err:
-        return False
+    # ask git directly rather than parsing its (localized, version-dependent)
+    # error message, as new_branch does
+    out, _ = git("branch", ["--list", branch_name], repo_path)
+    if not out.strip():
+        out, _ = git(
+            "rev-parse", ["--verify", "-q", f"refs/remotes/origin/{branch_name}"], repo_path
+        )
+        if not out.strip():
+            return False
+    git("checkout", [branch_name], repo_path)
     return True
 
 
-def make_commit(repo_path, commit_msg, force=False):
+def head_sha(repo_path):
+    """
+    Returns the SHA (str) of the commit checked out in the repo at repo_path
     """
-    Commits every new file & change in the repo, with the given commit_msg,
-    and pushes to origin
+    out, _ = git("rev-parse", ["HEAD"], repo_path)
+    return out.decode("utf-8").strip()
 
-    if `force` is True, will execute a force-push of the commits.
+
+def has_changes(repo_path):
+    """
+    Returns True if the repo at repo_path has anything to commit (modified,
+    deleted or untracked files), else False. Cheap: one `git status`.
     """
+    out, _ = git("status", ["--porcelain"], repo_path)
+    return len(out) > 0
+
+
+def make_commit(repo_path, commit_msg):
+    """
+    Commits every new file & change in the repo, with the given commit_msg.
+    The commit stays local; call `push_branch` once all of the branch's
+    commits are made, so a campaign does one push per repo.
+
+    Returns the SHA of the new commit, or None if there was nothing to commit
+    (the edit was a no-op), in which case no commit is made.
+    """
+    if not has_changes(repo_path):
+        return None
     git("add", ["."], repo_path)
     git(
         "commit",
         ["-a", "-m", commit_msg],
         repo_path
     )
+    return head_sha(repo_path)
+
+
+class PushError(Exception):
+    def __init__(self, branch_name, err):
+        self.branch_name = branch_name
+        self.err = err
+
+    def __str__(self):
+        return "Problem pushing branch {}: {}".format(self.branch_name, self.err)
+
+
+def push_branch(repo_path, branch_name=None, force=False):
+    """
+    Pushes branch_name (default: the checked-out branch) to origin, setting it
+    as the upstream. Meant to be called once per repo, after all of the
+    branch's commits are made and right before the PR is opened.
+
+    if `force` is True, will execute a force-push of the commits.
+
+    Raises PushError if origin didn't end up with the branch's commits.
+    """
+    if not branch_name:
+        out, _ = git("rev-parse", ["--abbrev-ref", "HEAD"], repo_path)
+        branch_name = out.decode("utf-8").strip()
+    args = ["-u", "origin", branch_name]
     if force:
-        git("push", ["-f"], repo_path)
-    else:
-        git("push", [], repo_path)
+        args.insert(0, "-f")
+    _, err = git("push", args, repo_path)
+
+    # a successful push moves our remote-tracking ref to the branch's tip
+    local, _ = git("rev-parse", ["--verify", "-q", branch_name], repo_path)
+    remote, _ = git(
+        "rev-parse", ["--verify", "-q", f"refs/remotes/origin/{branch_name}"], repo_path
+    )
+    if not local.strip() or local.strip() != remote.strip():
+        raise PushError(branch_name, err.decode("utf-8").strip())
 
 
 class PrCreationError(Exception):
@@ -207,7 +393,7 @@ def make_pr(gh_headers, org, rname, branch_name, dbranch, pr_details):
         "base": dbranch
     }
     params.update(pr_details)
-    response = requests.post(post_url, headers=gh_headers, json=params)
+    response = SESSION.post(post_url, headers=gh_headers, json=params)
     if response.status_code != 201:
         raise PrCreationError(response.status_code, response.json())
 
@@ -228,32 +414,453 @@ def gh_search_query(gh_headers, query_string):
     post_url = f"https://api.github.com/search/issues?q={query_string}"
     print(f"{post_url}")
     params = {"page": 1}
-    r = requests.get(post_url, headers=gh_headers, params=params).json()
+    r = SESSION.get(post_url, headers=gh_headers, params=params).json()
     items = r["items"]
     response = items
     while len(items) > 0:
         params["page"] += 1
-        r = requests.get(post_url, headers=gh_headers, params=params).json()
+        r = SESSION.get(post_url, headers=gh_headers, params=params).json()
         items = r["items"]
         response.extend(items)
     return response
 
 
+
+# The code search API returns at most 1000 results, 100 to a page
+CODE_SEARCH_PER_PAGE = 100
+CODE_SEARCH_MAX_RESULTS = 1000
+
+
+def _wait_for_rate_limit(response):
+    """
+    If `response` was turned away by a rate limit, sleeps until the limit
+    resets (or for as long as GitHub's Retry-After says) and returns True, so
+    the caller can retry the request. Otherwise returns False.
+    """
+    if response.status_code not in (403, 429):
+        return False
+    if "Retry-After" in response.headers:
+        wait = int(response.headers["Retry-After"])
+    elif response.headers.get("X-RateLimit-Remaining") == "0":
+        wait = max(0, int(response.headers["X-RateLimit-Reset"]) - int(time.time())) + 1
+    else:
+        return False
+    LOG.info(f" Rate limited; waiting {wait}s")
+    time.sleep(wait)
+    return True
+
+
+def code_search_repos(gh_headers, org, string):
+    """
+    Asks the code search API which repos in `org` contain `string` on their
+    default branch, paging through the results and waiting out the search
+    rate limit (10 requests a minute) as needed.
+
+    Returns the set of repo names, or None if the search couldn't give a
+    complete answer (GitHub said the results were incomplete, or there were
+    more matching files than the API will return).
+    """
+    url = "https://api.github.com/search/code"
+    params = {
+        "q": f"{json.dumps(string)} org:{org}",
+        "per_page": CODE_SEARCH_PER_PAGE,
+        "page": 1
+    }
+    rnames = set()
+    while True:
+        response = SESSION.get(url, headers=gh_headers, params=params)
+        if _wait_for_rate_limit(response):
+            continue
+        response.raise_for_status()
+        rjson = response.json()
+        if rjson["incomplete_results"] or rjson["total_count"] > CODE_SEARCH_MAX_RESULTS:
+            LOG.info(
+                f" Code search for {string!r} can't list every match"
+                f" ({rjson['total_count']} files, incomplete: {rjson['incomplete_results']})"
+            )
+            return None
+        rnames.update(item["repository"]["name"] for item in rjson["items"])
+        if "next" not in response.links:
+            return rnames
+        params["page"] += 1
+
+
+def prefilter_repos(repos, gh_headers, org, strings, root_dir=None, skipped=None):
+    """
+    Generator
+    Passes through only the repos (5-tuples from `get_repos`) that code
+    search says contain at least one of `strings`, so a campaign doesn't
+    clone or pull every repo in the org just to find out it has nothing to
+    change. The campaign should still check each repo itself: code search
+    matches words rather than exact strings, and skips files it hasn't
+    indexed (very large ones, or a repo that was pushed to moments ago).
+
+    If any search can't give a complete answer, every repo is passed through.
+
+    * root_dir (str): optional; also pass through repos the search left out
+      whose existing clone in root_dir has a string on the last-fetched
+      default branch. Checked locally, without fetching
+    * skipped (list): optional; gets the name of each repo that's filtered out
+    """
+    candidates = set()
+    for string in strings:
+        rnames = code_search_repos(gh_headers, org, string)
+        if rnames is None:
+            LOG.info(" Not prefiltering; checking every repo")
+            yield from repos
+            return
+        candidates |= rnames
+    LOG.info(f" Code search found {len(candidates)} candidate repos")
+
+    for repo in repos:
+        (rname, _, dbranch, _, _) = repo
+        if rname in candidates:
+            yield repo
+            continue
+        if root_dir:
+            repo_path = get_repo_path(rname, root_dir)
+            if os.path.exists(repo_path) and any(
+                    found_in_rev(string, repo_path, f"origin/{dbranch}")
+                    for string in strings
+                ):
+                LOG.info(f" {rname}: not in code search results, but found locally")
+                yield repo
+                continue
+        if skipped is not None:
+            skipped.append(rname)
+
+GRAPHQL_URL = "https://api.github.com/graphql"
+
+# Repos per GraphQL query when looking things up for many repos at once
+GRAPHQL_BATCH_SIZE = 100
+
+
+class GraphQLError(Exception):
+    def __init__(self, errors):
+        self.errors = errors
+
+    def __str__(self):
+        return f"GraphQL errors: {self.errors}"
+
+
+def graphql(gh_headers, query):
+    """
+    Runs a GraphQL query and returns its `data`. Raises GraphQLError if the
+    query failed outright; errors on some fields only (e.g. a repo that
+    doesn't exist) come back as None in `data`, and are logged.
+    """
+    response = SESSION.post(GRAPHQL_URL, headers=gh_headers, json={"query": query})
+    response.raise_for_status()
+    rjson = response.json()
+    if rjson.get("errors"):
+        if not rjson.get("data"):
+            raise GraphQLError(rjson["errors"])
+        LOG.info(f" GraphQL partial errors: {rjson['errors']}")
+    return rjson["data"]
+
+
+# What `branch_statuses` says about a repo's campaign branch
+BRANCH_NEW = "new"            # no such branch, and no merged PR from it
+BRANCH_EXISTING = "existing"  # the branch is there, not merged yet
+BRANCH_MERGED = "merged"      # a PR from the branch was merged
+
+
+def branch_statuses(gh_headers, org, rnames, branch_name, batch_size=GRAPHQL_BATCH_SIZE):
+    """
+    Looks up `branch_name` on every repo in `rnames`, `batch_size` repos per
+    GraphQL query, before anything is cloned.
+
+    Returns a dict of {repo name: BRANCH_NEW, BRANCH_EXISTING or
+    BRANCH_MERGED}. Repos the query couldn't see are left out.
+    """
+    rnames = list(rnames)
+    branch = json.dumps(branch_name)
+    statuses = {}
+    for start in range(0, len(rnames), batch_size):
+        batch = rnames[start:start + batch_size]
+        fields = "\n".join(
+            f"""r{i}: repository(owner: {json.dumps(org)}, name: {json.dumps(rname)}) {{
+                ref(qualifiedName: {json.dumps("refs/heads/" + branch_name)}) {{ name }}
+                pullRequests(headRefName: {branch}, states: MERGED, first: 1) {{ totalCount }}
+            }}"""
+            for i, rname in enumerate(batch)
+        )
+        data = graphql(gh_headers, f"query {{ {fields} }}")
+        for i, rname in enumerate(batch):
+            repo = data.get(f"r{i}")
+            if repo is None:
+                continue
+            if repo["pullRequests"]["totalCount"]:
+                statuses[rname] = BRANCH_MERGED
+            elif repo["ref"]:
+                statuses[rname] = BRANCH_EXISTING
+            else:
+                statuses[rname] = BRANCH_NEW
+    return statuses
+
+
+def skip_existing_branches(
+        repos, gh_headers, org, branch_name, skip=(BRANCH_EXISTING, BRANCH_MERGED),
+        skipped=None, batch_size=GRAPHQL_BATCH_SIZE
+    ):
+    """
+    Generator
+    Pre-flight for campaigns that open a new branch: passes through the repos
+    (5-tuples from `get_repos`) whose `branch_name` status isn't in `skip`,
+    checking a batch at a time with `branch_statuses`, so skipped repos are
+    never cloned or pulled.
+
+    * skipped (list): optional; gets a (repo name, status) pair for each repo
+      that's skipped
+    """
+    batch = []
+    for repo in repos:
+        batch.append(repo)
+        if len(batch) == batch_size:
+            yield from _preflight_batch(batch, gh_headers, org, branch_name, skip, skipped)
+            batch = []
+    if batch:
+        yield from _preflight_batch(batch, gh_headers, org, branch_name, skip, skipped)
+
+
+def _preflight_batch(batch, gh_headers, org, branch_name, skip, skipped):
+    statuses = branch_statuses(gh_headers, org, [repo[0] for repo in batch], branch_name)
+    for repo in batch:
+        status = statuses.get(repo[0], BRANCH_NEW)
+        if status in skip:
+            LOG.info(f" Skipping {repo[0]}, branch {branch_name} is {status}")
+            if skipped is not None:
+                skipped.append((repo[0], status))
+            continue
+        yield repo
+
+
+def open_prs(gh_headers, org, rnames, branch_name, batch_size=GRAPHQL_BATCH_SIZE):
+    """
+    Looks up open PRs from `branch_name` on every repo in `rnames`,
+    `batch_size` repos per GraphQL query.
+
+    Returns a dict of {repo name: PR url} for the repos that have one.
+    """
+    rnames = list(rnames)
+    urls = {}
+    for start in range(0, len(rnames), batch_size):
+        batch = rnames[start:start + batch_size]
+        fields = "\n".join(
+            f"""r{i}: repository(owner: {json.dumps(org)}, name: {json.dumps(rname)}) {{
+                pullRequests(headRefName: {json.dumps(branch_name)}, states: OPEN, first: 1) {{
+                    nodes {{ url }}
+                }}
+            }}"""
+            for i, rname in enumerate(batch)
+        )
+        data = graphql(gh_headers, f"query {{ {fields} }}")
+        for i, rname in enumerate(batch):
+            repo = data.get(f"r{i}")
+            if repo and repo["pullRequests"]["nodes"]:
+                urls[rname] = repo["pullRequests"]["nodes"][0]["url"]
+    return urls
+
+
+class OpenPrs:
+    """
+    Open PRs from a campaign's branch, looked up in batches as they're needed,
+    so a campaign can reuse a PR that's already open instead of having
+    `make_pr` fail on it with a 422.
+
+    Call `expect(rname)` as each repo enters the campaign, and `get(rname)`
+    just before making its PR; the first `get` of a batch looks up every
+    expected repo not looked up yet in one query (see `open_prs`).
+    """
+    def __init__(self, gh_headers, org, branch_name):
+        self.gh_headers = gh_headers
+        self.org = org
+        self.branch_name = branch_name
+        self._lock = threading.Lock()
+        self._pending = []
+        self._urls = {}
+        self._looked_up = set()
+
+    def expect(self, rname):
+        with self._lock:
+            if rname not in self._looked_up:
+                self._pending.append(rname)
+
+    def get(self, rname):
+        """
+        Returns the url of the open PR from the branch on `rname`, or None
+        """
+        with self._lock:
+            if rname not in self._looked_up:
+                batch = list(dict.fromkeys(self._pending + [rname]))
+                self._pending = []
+                self._urls.update(open_prs(self.gh_headers, self.org, batch, self.branch_name))
+                self._looked_up.update(batch)
+            return self._urls.get(rname)
+
+
+# PRs per createPullRequest mutation document. `make_prs` halves this when
+# GitHub's secondary rate limit pushes back, and grows it back one at a time.
+PR_BATCH_SIZE = 10
+
+# Seconds between mutation documents, and how long to back off when
+# pushed back on (content-creation limits don't send a Retry-After)
+PR_BATCH_PAUSE = 5
+SECONDARY_LIMIT_WAIT = 60
+
+# Give up on the remaining PRs after this many push-backs in a row
+SECONDARY_LIMIT_STRIKES = 5
+
+# What GitHub says when a request runs into a secondary rate limit
+SECONDARY_LIMIT_MESSAGES = ("secondary rate limit", "submitted too quickly")
+
+
+def repository_ids(gh_headers, org, rnames, batch_size=GRAPHQL_BATCH_SIZE):
+    """
+    Returns a dict of {repo name: GraphQL node id} for the repos in `rnames`,
+    `batch_size` repos per query. Repos the query couldn't see are left out.
+    """
+    rnames = list(rnames)
+    ids = {}
+    for start in range(0, len(rnames), batch_size):
+        batch = rnames[start:start + batch_size]
+        fields = "\n".join(
+            f"r{i}: repository(owner: {json.dumps(org)}, name: {json.dumps(rname)}) {{ id }}"
+            for i, rname in enumerate(batch)
+        )
+        data = graphql(gh_headers, f"query {{ {fields} }}")
+        for i, rname in enumerate(batch):
+            if data.get(f"r{i}"):
+                ids[rname] = data[f"r{i}"]["id"]
+    return ids
+
+
+def _secondary_limited(message):
+    message = message.lower()
+    return any(text in message for text in SECONDARY_LIMIT_MESSAGES)
+
+
+def make_prs(gh_headers, org, prs, batch_size=PR_BATCH_SIZE):
+    """
+    Opens many PRs in `org` with a handful of requests: the repos' node ids
+    are looked up in bulk, then `batch_size` createPullRequest mutations go
+    out per GraphQL document, each under its own alias so a failure only
+    costs its own repo. When GitHub's secondary rate limit pushes back, the
+    PRs that didn't go through are retried in smaller batches after a wait.
+
+    * prs (list): (repo name, branch name, base branch, pr_details) entries;
+      pr_details is a dict with the keys "title" and/or "body", as for
+      `make_pr` (the title defaults to the branch name)
+
+    Returns (urls, failed): a dict of {repo name: PR url} for the PRs that
+    were opened, and a dict of {repo name: error message} for those that
+    weren't. A request that errors out only fails its own batch, so what was
+    opened before it is always returned.
+    """
+    urls = {}
+    failed = {}
+    try:
+        ids = repository_ids(gh_headers, org, [pr[0] for pr in prs])
+    except (requests.RequestException, GraphQLError, ValueError) as err:
+        LOG.info(f" Couldn't look up the repos to open PRs in: {err}")
+        return urls, {pr[0]: f"repository lookup failed: {err}" for pr in prs}
+    todo = []
+    for pr in prs:
+        if pr[0] in ids:
+            todo.append(pr)
+        else:
+            failed[pr[0]] = "repository not found"
+
+    size = batch_size
+    strikes = 0
+    while todo:
+        batch, todo = todo[:size], todo[size:]
+        fields = "\n".join(
+            f"""p{i}: createPullRequest(input: {{
+                repositoryId: {json.dumps(ids[rname])},
+                headRefName: {json.dumps(branch_name)},
+                baseRefName: {json.dumps(dbranch)},
+                title: {json.dumps(pr_details.get("title", branch_name))},
+                body: {json.dumps(pr_details.get("body", ""))}
+            }}) {{ pullRequest {{ url }} }}"""
+            for i, (rname, branch_name, dbranch, pr_details) in enumerate(batch)
+        )
+        try:
+            response = SESSION.post(
+                GRAPHQL_URL, headers=gh_headers, json={"query": f"mutation {{ {fields} }}"}
+            )
+            if response.status_code in (403, 429) and _secondary_limited(response.text):
+                rjson = None
+            else:
+                response.raise_for_status()
+                rjson = response.json()
+        except (requests.RequestException, ValueError) as err:
+            # network error, 5xx, or a body that isn't JSON; the batch may or
+            # may not have gone through, so report it rather than retry and
+            # risk duplicate PRs
+            LOG.info(f" PR batch of {len(batch)} failed: {err}")
+            for pr in batch:
+                failed[pr[0]] = f"request failed: {err}"
+            if todo:
+                time.sleep(PR_BATCH_PAUSE)
+            continue
+
+        if rjson is None:
+            limited = batch
+            wait = int(response.headers.get("Retry-After", SECONDARY_LIMIT_WAIT))
+        else:
+            data = rjson.get("data") or {}
+            # errors name the alias they belong to in their path
+            errors = {}
+            for error in rjson.get("errors") or []:
+                alias = (error.get("path") or [None])[0]
+                errors.setdefault(alias, error.get("message", str(error)))
+            limited = []
+            wait = SECONDARY_LIMIT_WAIT
+            for i, pr in enumerate(batch):
+                created = data.get(f"p{i}")
+                if created and created.get("pullRequest"):
+                    urls[pr[0]] = created["pullRequest"]["url"]
+                    LOG.info("PR success: {}".format(urls[pr[0]]))
+                    continue
+                # a document-wide error (no path) counts against every alias
+                message = errors.get(f"p{i}", errors.get(None, "no pull request returned"))
+                if _secondary_limited(message):
+                    limited.append(pr)
+                else:
+                    LOG.info(f" PR for {pr[0]} failed: {message}")
+                    failed[pr[0]] = message
+
+        if limited:
+            strikes += 1
+            if strikes > SECONDARY_LIMIT_STRIKES:
+                for pr in limited + todo:
+                    failed[pr[0]] = "secondary rate limit"
+                break
+            size = max(1, size // 2)
+            LOG.info(
+                f" Secondary rate limit: retrying {len(limited)} PRs"
+                f" {size} at a time in {wait}s"
+            )
+            todo = limited + todo
+            time.sleep(wait)
+            continue
+
+        strikes = 0
+        size = min(batch_size, size + 1)
+        if todo:
+            time.sleep(PR_BATCH_PAUSE)
+    return urls, failed
+
+
 def git_reset_hard(num_commits, repo_path):
     """
     Does "git reset --hard HEAD~{num_commits}
     """
     # For the life of me I cannot figure out why using git() wasn't working -
     # it was not passing through the "--" on the "--hard" arg. :shrug:
-    proc = subprocess.Popen(
-        f"git reset --hard HEAD~{num_commits}",
-        cwd=repo_path,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        shell=True
-    )
-    out = proc.communicate()
-    return out
+    result = run(f"git reset --hard HEAD~{num_commits}", repo_path, "git", shell=True)
+    return result.stdout, result.stderr
 
 
 def get_repo_path(repo, root_dir):
@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+"""
+Records every GitHub API request made through `github_helpers.SESSION`:
+method, route (the URL with its owner, repo, numbers etc. swapped for
+placeholders, e.g. `/repos/{owner}/{repo}/labels/{name}`), status, latency,
+bytes, retries, whether it was answered from cache (a 304), and the rate
+limit headers.
+
+When the script exits it logs a table of p50/p95/p99 latency per route and
+the repos that took the most calls, to find chatty call patterns and slow
+endpoints. Only running totals and latency histograms are kept in memory,
+so a long-lived process (see daemon.py) doesn't grow with every request;
+the percentiles are estimated from the histograms. With
+GH_HTTP_METRICS=<path> in the environment every request is also written to
+that file as a JSON line, for digging into afterwards.
+
+The median latency of each kind of call (REST, GraphQL, search) is saved
+for `plan.py` to estimate runs with.
+"""
+import atexit
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import time
+
+from collections import Counter, defaultdict
+from urllib.parse import urlsplit
+
+
+logging.basicConfig(stream=sys.stderr, level=logging.INFO)
+LOG = logging.getLogger(__name__)
+
+# Where to write a JSON line per request (None to not)
+JSONL_PATH = os.environ.get("GH_HTTP_METRICS")
+
+# Log the summary table when the script exits
+SUMMARY_AT_EXIT = True
+
+# Most failed requests to remember while waiting to see if they're retried
+RETRY_WATCH = 1000
+
+# Upper bounds (seconds) of the latency histogram buckets
+BUCKETS = [0.05, 0.1, 0.25, 0.5, 0.75, 1, 1.5, 2.5, 5, 10, 30, 60]
+
+# Path segments that are always followed by a name, and what to call it
+_NAMED = {
+    "orgs": "{org}",
+    "users": "{user}",
+    "labels": "{name}",
+    "branches": "{branch}",
+    "contents": "{path}",
+}
+_SHA = re.compile(r"^[0-9a-f]{40}$")
+
+
+def route(url):
+    """
+    Returns the route template for a GitHub API url, e.g.
+    `https://api.github.com/repos/openedx/XBlock/pulls/12/merge` ->
+    `/repos/{owner}/{repo}/pulls/{number}/merge`
+    """
+    parts = urlsplit(url).path.strip("/").split("/")
+    template = []
+    for i, part in enumerate(parts):
+        if i == 1 and parts[0] == "repos":
+            template.append("{owner}")
+        elif i == 2 and parts[0] == "repos":
+            template.append("{repo}")
+        elif i and parts[i - 1] in _NAMED:
+            template.append(_NAMED[parts[i - 1]])
+            if parts[i - 1] == "contents":
+                # the rest of the path is the file's
+                break
+        elif part.isdigit():
+            template.append("{number}")
+        elif _SHA.match(part):
+            template.append("{sha}")
+        else:
+            template.append(part)
+    return "/" + "/".join(template)
+
+
+def kind(url):
+    """
+    Returns which kind of call (as counted by plan.py) the url is
+    """
+    path = urlsplit(url).path
+    if path.startswith("/graphql"):
+        return "graphql"
+    if path.startswith("/search/code"):
+        return "code_search"
+    if path.startswith("/search/"):
+        return "search"
+    return "rest"
+
+
+def percentile(bounds, buckets, pct, top):
+    """
+    Estimates the `pct` percentile of a histogram, where `buckets[i]` values
+    were at most `bounds[i]` (and over the bound before it), and the last
+    bucket holds the ones over every bound. Interpolates within the bucket,
+    like Prometheus' histogram_quantile, but never past `top`, the largest
+    value seen.
+    """
+    count = sum(buckets)
+    if not count:
+        return 0
+    rank = pct / 100 * count
+    seen = 0
+    for i, n in enumerate(buckets):
+        if n and seen + n >= rank:
+            if i == len(bounds):
+                return top
+            lower = bounds[i - 1] if i else 0
+            return min(top, lower + (bounds[i] - lower) * (rank - seen) / n)
+        seen += n
+    return top
+
+
+class Stats:
+    """
+    Running totals for the requests to one route (or of one kind): calls,
+    errors, retries, 304s, bytes, and a latency histogram
+    """
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.errors = 0
+        self.retried = 0
+        self.cached = 0
+        self.bytes = 0
+
+    def add(self, entry):
+        latency = entry["latency"]
+        index = next((i for i, bound in enumerate(BUCKETS) if latency <= bound), len(BUCKETS))
+        self.buckets[index] += 1
+        self.count += 1
+        self.sum += latency
+        self.max = max(self.max, latency)
+        self.errors += entry["status"] >= 400
+        self.retried += bool(entry["retries"])
+        self.cached += entry["cached"]
+        self.bytes += entry["bytes"]
+
+    def percentile(self, pct):
+        return percentile(BUCKETS, self.buckets, pct, self.max)
+
+
+class Recorder:
+    """
+    Keeps running totals of the requests. `record` fits a requests response
+    hook.
+    """
+    def __init__(self, jsonl_path=None):
+        self.jsonl_path = jsonl_path
+        self.count = 0
+        # (method, route) -> Stats, and kind -> Stats
+        self.routes = defaultdict(Stats)
+        self.kinds = defaultdict(Stats)
+        self.repos = Counter()
+        self._lock = threading.Lock()
+        # status of the last failed response for each (method, url), and how
+        # many times it's been retried, to spot retries; dropped once the
+        # request goes through (or after RETRY_WATCH newer failures)
+        self._last_status = {}
+        self._retries = Counter()
+
+    def record(self, response, *args, **kwargs):
+        request = response.request
+        key = (request.method, request.url)
+        headers = response.headers
+        # urllib3's own retries, if the adapter was set up with any...
+        raw_retries = getattr(getattr(response.raw, "retries", None), "history", None) or ()
+        with self._lock:
+            # ...plus ours: the same request again after a rate limit or an
+            # error (e.g. make_prs, code_search_repos)
+            if key in self._last_status:
+                self._retries[key] += 1
+            retries = self._retries[key] + len(raw_retries)
+            if response.status_code in (403, 429) or response.status_code >= 500:
+                self._last_status[key] = response.status_code
+                if len(self._last_status) > RETRY_WATCH:
+                    # the oldest is the least likely to still be retried
+                    oldest = next(iter(self._last_status))
+                    del self._last_status[oldest]
+                    self._retries.pop(oldest, None)
+            else:
+                self._last_status.pop(key, None)
+                self._retries.pop(key, None)
+
+        path = urlsplit(request.url).path.strip("/").split("/")
+        entry = {
+            "time": time.time(),
+            "method": request.method,
+            "route": route(request.url),
+            "kind": kind(request.url),
+            "repo": "/".join(path[1:3]) if path[0] == "repos" and len(path) > 2 else None,
+            "status": response.status_code,
+            # time until the response headers came back
+            "latency": response.elapsed.total_seconds(),
+            "bytes": int(headers.get("Content-Length") or len(response.content)),
+            "retries": retries,
+            "cached": response.status_code == 304 or bool(getattr(response, "from_cache", False)),
+            "ratelimit_resource": headers.get("X-RateLimit-Resource"),
+            "ratelimit_remaining": _int(headers.get("X-RateLimit-Remaining")),
+            "ratelimit_used": _int(headers.get("X-RateLimit-Used")),
+            "ratelimit_reset": _int(headers.get("X-RateLimit-Reset")),
+        }
+        with self._lock:
+            self.count += 1
+            self.routes[(entry["method"], entry["route"])].add(entry)
+            self.kinds[entry["kind"]].add(entry)
+            if entry["repo"]:
+                self.repos[entry["repo"]] += 1
+            if self.jsonl_path:
+                try:
+                    with open(self.jsonl_path, "a") as f:
+                        f.write(json.dumps(entry) + "\n")
+                except OSError as err:
+                    LOG.info(f" Not writing request metrics to {self.jsonl_path}: {err}")
+                    self.jsonl_path = None
+
+    def summary(self, top_repos=10):
+        """
+        Returns the printable table: calls, errors, retries, 304s, bytes and
+        p50/p95/p99 latency per route, then the repos with the most calls
+        """
+        with self._lock:
+            lines = [
+                f"{self.count} GitHub API requests",
+                f"  {'calls':>6} {'errors':>6} {'retry':>5} {'304':>4} {'KB':>8}"
+                f" {'p50':>7} {'p95':>7} {'p99':>7}  route",
+            ]
+            for (method, path), stats in sorted(
+                    self.routes.items(), key=lambda item: -item[1].sum
+                ):
+                lines.append(
+                    f"  {stats.count:>6} {stats.errors:>6} {stats.retried:>5}"
+                    f" {stats.cached:>4} {stats.bytes / 1024:>8.0f}"
+                    f" {stats.percentile(50):>6.2f}s"
+                    f" {stats.percentile(95):>6.2f}s"
+                    f" {stats.percentile(99):>6.2f}s"
+                    f"  {method} {path}"
+                )
+            per_repo = Counter(self.repos)
+
+        if per_repo:
+            lines.append(
+                f"  {sum(per_repo.values()) / len(per_repo):.1f} calls per repo over"
+                f" {len(per_repo)} repos; most:"
+            )
+            for repo, count in per_repo.most_common(top_repos):
+                lines.append(f"    {count:>5}  {repo}")
+        return "\n".join(lines)
+
+    def median_latencies(self):
+        """
+        Returns {kind: median seconds} over the requests recorded
+        """
+        with self._lock:
+            return {k: stats.percentile(50) for k, stats in self.kinds.items()}
+
+    def finish(self):
+        """
+        Logs the summary and saves the median latencies for plan.py
+        """
+        if not self.count:
+            return
+        if SUMMARY_AT_EXIT:
+            LOG.info("\n" + self.summary())
+        from plan import save_latencies
+        save_latencies(self.median_latencies())
+
+
+def _int(value):
+    return int(value) if value is not None else None
+
+
+RECORDER = Recorder(JSONL_PATH)
+atexit.register(RECORDER.finish)
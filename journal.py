@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+"""
+Usage:
+    python journal.py [-h] [-p PATH] campaign
+
+Description:
+    Append-only record of how far each repo has got through a campaign's
+    stages, kept in SQLite (WAL mode) so it survives rate limits, crashes and
+    Ctrl-C. Every stage a repo finishes is written as soon as it happens, along
+    with the commit SHA and PR URL if there is one.
+
+    Handing a Journal to `pipeline.run_pipeline` makes a campaign resumable:
+    re-running it with the same campaign name skips repos that already
+    finished (or were skipped for good), and picks partly-done repos back up
+    at the first stage they hadn't finished. Repos a stage only dropped for
+    this run (e.g. a string not found yet) are tried again.
+
+    Run from the command line, prints a summary of a campaign plus its PR URLs.
+"""
+import argparse
+import datetime
+import json
+import sqlite3
+import threading
+
+
+DEFAULT_PATH = "output/journal.sqlite3"
+
+DONE = "done"
+SKIPPED = "skipped"
+DROPPED = "dropped"
+FAILED = "failed"
+
+
+class Journal:
+    """
+    The progress of one campaign (e.g. "copy_file:tcril/some-branch").
+
+    * campaign (str): name that ties the runs of one campaign together
+    * path (str): optional; where the SQLite file lives
+    """
+    def __init__(self, campaign, path=DEFAULT_PATH):
+        self.campaign = campaign
+        # stages run on several threads, so they share the connection
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS events (
+                id INTEGER PRIMARY KEY,
+                campaign TEXT NOT NULL,
+                repo TEXT NOT NULL,
+                stage TEXT NOT NULL,
+                status TEXT NOT NULL,
+                sha TEXT,
+                pr_url TEXT,
+                item TEXT,
+                ts TEXT NOT NULL
+            )"""
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS events_repo ON events (campaign, repo)"
+        )
+        self._conn.commit()
+
+    def record(self, rname, stage, status, item=None):
+        """
+        Appends an entry for `rname` at `stage`. `status` is one of DONE,
+        SKIPPED (never try the repo again), DROPPED (left out of this run
+        only) or FAILED. `item` is the pipeline item after the stage; its
+        `sha` and `pr_url` keys (if set) get their own columns, and the rest is
+        saved so a resumed run can pick up where this one stopped.
+        """
+        item = item or {}
+        # keys starting with _ are pipeline bookkeeping, not repo data
+        saved = {k: v for k, v in item.items() if not k.startswith("_")}
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO events (campaign, repo, stage, status, sha, pr_url, item, ts)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    self.campaign, rname, stage, status,
+                    item.get("sha"), item.get("pr_url"),
+                    json.dumps(saved, default=str),
+                    datetime.datetime.now().isoformat(timespec="seconds")
+                )
+            )
+            self._conn.commit()
+
+    def state(self, rname):
+        """
+        Returns a 2-tuple for `rname`:
+        - done (dict): stage name -> the item as it was saved after that stage
+        - skipped (bool): True if a stage decided to skip the repo for good
+
+        DROPPED and FAILED entries leave the repo to be tried again from the
+        stage they were recorded at.
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT stage, status, item FROM events"
+                " WHERE campaign = ? AND repo = ? ORDER BY id",
+                (self.campaign, rname)
+            ).fetchall()
+        done = {}
+        skipped = False
+        for stage, status, item in rows:
+            if status == DONE:
+                done[stage] = json.loads(item)
+            elif status == SKIPPED:
+                skipped = True
+        return done, skipped
+
+    def summary(self):
+        """
+        Returns a dict of {repo name: (last stage, its status, sha, pr_url)}
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT repo, stage, status, sha, pr_url FROM events"
+                " WHERE campaign = ? ORDER BY id",
+                (self.campaign,)
+            ).fetchall()
+        latest = {}
+        for repo, stage, status, sha, pr_url in rows:
+            _, _, last_sha, last_pr = latest.get(repo, (None, None, None, None))
+            latest[repo] = (stage, status, sha or last_sha, pr_url or last_pr)
+        return latest
+
+    def pr_urls(self):
+        """
+        Returns a sorted list of every PR URL recorded for the campaign
+        """
+        return sorted(
+            pr_url for (_, _, _, pr_url) in self.summary().values() if pr_url
+        )
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Prints how far each repo got in a campaign, and the PR\
+            URLs it made."
+    )
+
+    parser.add_argument(
+        "campaign",
+        help="Name of the campaign, e.g. copy_file:tcril/some-branch"
+    )
+
+    parser.add_argument(
+        "-p", "--path",
+        help=f"Journal file (default {DEFAULT_PATH})",
+        default=DEFAULT_PATH
+    )
+
+    args = parser.parse_args()
+    journal = Journal(args.campaign, args.path)
+    counts = {}
+    for repo, (stage, status, sha, pr_url) in sorted(journal.summary().items()):
+        print(f"{repo}: {stage} {status} {sha or ''} {pr_url or ''}".rstrip())
+        counts[status] = counts.get(status, 0) + 1
+    print(json.dumps(counts))
+    print(json.dumps(journal.pr_urls(), indent=4))
+    journal.close()
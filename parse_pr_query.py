@@ -20,10 +20,10 @@ import argparse
 import datetime
 import json
 import os
-import requests
 import sys
 
 from github_helpers import (
+    SESSION,
     get_github_headers,
     gh_search_query
 )
@@ -64,7 +64,7 @@ def parse_prs(search_query=False, branch_name=False, foutput=False):
 
         result = [pr_url, repo_name]
         if branch_name:
-            response = requests.get(
+            response = SESSION.get(
                 get_pr_url.format(repo_name, pr_number),
                 headers=gh_headers
             )
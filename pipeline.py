@@ -0,0 +1,491 @@
+#!/usr/bin/env python3
+"""
+Runs a per-repo campaign as a series of stages (e.g. clone -> edit -> push ->
+PR), with repos flowing through the stages concurrently instead of one repo
+at a time.
+
+Every stage has a kind:
+* NETWORK: talks to the git remote (clone, fetch, push)
+* LOCAL: works on the local clone (scan, edit, commit)
+* API: writes to the GitHub API (PRs, labels, merges)
+* REVIEW: waits on a person (see review.py)
+
+Each kind has its own concurrency limit, shared by every stage of that kind,
+and stages are joined by bounded queues so a fast stage can't run too far
+ahead of a slow one. A campaign then takes about as long as its slowest stage,
+rather than the sum of every stage's latency.
+
+`campaign_stages` and `run_campaign` hold the wiring the campaign scripts
+share (review, push and PR stages; journal, schedule and work queue), so a
+script only declares its own stages.
+"""
+import logging
+import os
+import queue
+import sys
+import threading
+import time
+
+from github_helpers import (
+    PR_BATCH_PAUSE, PR_BATCH_SIZE, PrCreationError, get_repo_path, make_prs, push_branch
+)
+from journal import DONE, DROPPED, FAILED, SKIPPED, Journal
+
+
+logging.basicConfig(stream=sys.stderr, level=logging.INFO)
+LOG = logging.getLogger(__name__)
+
+NETWORK = "network"
+LOCAL = "local"
+API = "api"
+REVIEW = "review"
+
+# How many calls of each kind can be in flight at once. API writes default to
+# one at a time, since GitHub's secondary rate limit punishes bursts of them,
+# and there's only one person doing the reviewing.
+DEFAULT_LIMITS = {
+    NETWORK: 8,
+    LOCAL: os.cpu_count() or 1,
+    API: 1,
+    REVIEW: 1,
+}
+
+# Seconds the PR stage waits for a full batch of PRs before opening what it
+# has
+PR_BATCH_WAIT = 10
+
+# Marks the end of a stage's input
+_DONE = object()
+
+
+class Skip(Exception):
+    """
+    Raised by a stage function to drop an item for good. The journal records
+    the repo as SKIPPED, so re-running the campaign leaves it alone. Only for
+    reasons that hold for the whole campaign (e.g. the branch already exists);
+    a stage that returns None drops the item from this run only.
+    """
+
+
+class Cancel(Exception):
+    """
+    Raised by a stage function to stop the run (e.g. the reviewer quit). No
+    more items are fed in, and this stage and the ones before it drop what
+    they still hold without journaling it, so the next run picks those repos
+    up again. Items already past this stage carry on to the end.
+    """
+
+
+class Stage:
+    """
+    One step of a per-repo campaign.
+
+    * name (str): used in logs and failure reports
+    * func: called with each item (a dict of repo data, see `repo_items`).
+      Returns the item (changed or not) to hand it to the next stage, or None
+      to drop it from this run. Raises Skip to drop it from the campaign, or
+      Cancel to stop the run.
+    * kind (str): one of NETWORK, LOCAL, API or REVIEW
+    * delay (float): optional; seconds to wait after each call, while still
+      holding the stage's slot. Used to pace GitHub writes.
+    * batch (int): optional; if set, `func` is called with a list of up to
+      this many items, gathered from whatever is waiting (for up to
+      `batch_wait` seconds after the first), and returns a list with an entry
+      for each: the item, None, or the exception (e.g. Skip) that it would
+      have raised for that item on its own. Each entry is journaled as it
+      would be for a single item.
+    """
+    def __init__(self, name, func, kind=LOCAL, delay=0, batch=0, batch_wait=0):
+        self.name = name
+        self.func = func
+        self.kind = kind
+        self.delay = delay
+        self.batch = batch
+        self.batch_wait = batch_wait
+
+
+def repo_items(repos, root_dir):
+    """
+    Generator
+    Turns the 5-tuples from `github_helpers.get_repos` into the item dicts
+    that are passed between stages, with keys `rname`, `ssh_url`, `dbranch`,
+    `has_issues`, `count` and `repo_path`.
+    """
+    for (rname, ssh_url, dbranch, has_issues, count) in repos:
+        yield {
+            "rname": rname,
+            "ssh_url": ssh_url,
+            "dbranch": dbranch,
+            "has_issues": has_issues,
+            "count": count,
+            "repo_path": get_repo_path(rname, root_dir),
+        }
+
+
+def push(item):
+    """
+    Stage function (NETWORK) that publishes a repo's commits in one push, via
+    `github_helpers.push_branch`. Pushes `item["branch_name"]` if a previous
+    stage set it, otherwise the checked-out branch.
+    """
+    push_branch(item["repo_path"], item.get("branch_name"))
+    return item
+
+
+def make_item_prs(gh_headers, org, items, pr_details):
+    """
+    For a batch "pr" stage (see `campaign_stages`): opens a PR for each of
+    `items`, from `item["branch_name"]` into `item["dbranch"]`, with one
+    `github_helpers.make_prs`.
+
+    * pr_details: the "title"/"body" dict for every PR (as for `make_pr`), or
+      a function that returns it for an item
+
+    Returns a list with, for each item, the item with "pr_url" set, or a
+    PrCreationError if its PR wasn't opened.
+    """
+    if not items:
+        return []
+    details = pr_details if callable(pr_details) else lambda item: pr_details
+    urls, failed = make_prs(gh_headers, org, [
+        (item["rname"], item["branch_name"], item["dbranch"], details(item))
+        for item in items
+    ])
+    results = []
+    for item in items:
+        if item["rname"] in urls:
+            item["pr_url"] = urls[item["rname"]]
+            results.append(item)
+        else:
+            message = failed.get(item["rname"], "no pull request returned")
+            results.append(PrCreationError(None, {"message": message}))
+    return results
+
+
+def campaign_stages(stages, open_prs, interactive=False, pr_delay=PR_BATCH_PAUSE):
+    """
+    Returns a campaign's full list of Stages: its own `stages` (e.g. clone and
+    edit), then a review queue if `interactive` (see review.py), a push, and
+    a "pr" stage that runs `open_prs` on batches of pushed items (see
+    Stage's `batch`), e.g. with `make_item_prs`.
+
+    * pr_delay (float): seconds to wait after each batch of PRs
+    """
+    from review import ReviewQueue
+
+    stages = list(stages)
+    if interactive:
+        # diffs wait for review while later repos are fetched and edited
+        stages.extend(ReviewQueue().stages())
+    stages.extend([
+        Stage("push", push, NETWORK),
+        # PRs go out a batch per GraphQL document instead of a POST each, and
+        # the batches are paced; GitHub's secondary rate limit punishes
+        # bursts of content creation
+        Stage(
+            "pr", open_prs, API, delay=pr_delay, batch=PR_BATCH_SIZE,
+            batch_wait=PR_BATCH_WAIT
+        ),
+    ])
+    return stages
+
+
+def run_campaign(
+        campaign, stages, root_dir, list_repos, work_queue=None, order=None,
+        sizes=None, select_repos=None, on_unselected=None, skip_existing=None
+    ):
+    """
+    Runs a campaign script's stages over its repos, journaling progress under
+    `campaign`, and returns `run_pipeline`'s (finished, failed).
+
+    * campaign (str): name to journal progress under (see journal.py).
+      Re-running with the same name skips repos that already finished and
+      resumes partly-done ones. Also keys the repos' past durations (see
+      schedule.History)
+    * stages (list): the Stages to run, e.g. from `campaign_stages`
+    * root_dir (str): path to directory to clone repos
+    * list_repos: called with no arguments for the repos to run (5-tuples
+      from `github_helpers.get_repos`)
+    * work_queue (str): optional; name of a shared queue (see workqueue.py)
+      to claim repos from instead of calling list_repos, so several workers
+      can split the campaign. Repos are ordered and checked when they're
+      enqueued, so `order` and `skip_existing` don't apply
+    * order (str): optional; schedule.LARGEST_FIRST (keeps the pipeline busy
+      to the end) or schedule.SMALLEST_FIRST (early results). Default is the
+      order list_repos gives
+    * sizes: with order, called with no arguments for {repo name: size in
+      KB} (e.g. `github_helpers.get_repo_sizes`); repos missing from it are
+      sized by their clone
+    * select_repos (list): optional; if set, only these repos are run. The
+      rest are passed to `on_unselected(rname)`, if set, and left out of the
+      journal, so a later run with a different list still does them
+    * skip_existing: optional; called with the repos to drop those that
+      already have the campaign's branch, e.g. with
+      `github_helpers.skip_existing_branches`, so they're never cloned
+    """
+    from schedule import History, order_repos
+    from workqueue import WorkQueue
+
+    journal = Journal(campaign)
+    history = History(campaign)
+    shared = WorkQueue(work_queue) if work_queue else None
+
+    def on_list(repos):
+        for repo in repos:
+            if repo[0] in select_repos:
+                yield repo
+                continue
+            if on_unselected:
+                on_unselected(repo[0])
+            if shared:
+                shared.finish({"rname": repo[0]})
+
+    try:
+        repos = shared.claim_repos() if shared else list_repos()
+        if select_repos:
+            repos = on_list(repos)
+        if not shared:
+            if order:
+                repos = order_repos(repos, sizes() if sizes else {}, order, history, root_dir)
+            if skip_existing:
+                repos = skip_existing(repos)
+        return run_pipeline(
+            repo_items(repos, root_dir), stages, journal=journal, history=history,
+            on_exit=shared.finish if shared else None
+        )
+    finally:
+        journal.close()
+        if shared:
+            shared.close()
+
+
+def run_pipeline(
+        items, stages, limits=None, queue_size=16, journal=None, history=None,
+        on_exit=None
+    ):
+    """
+    Feeds every item through `stages`, in order.
+
+    * items: iterable of item dicts; consumed lazily, so it can be a generator
+      that pages through the GitHub API
+    * stages (list): the Stages to run each item through
+    * limits (dict): optional; overrides DEFAULT_LIMITS for some kinds, e.g.
+      `{NETWORK: 4}`
+    * queue_size (int): how many items can wait between two stages
+    * journal (journal.Journal): optional; records every stage each repo
+      finishes (or skips, drops, or fails). Repos the journal already has as
+      finished or skipped are dropped up front, and partly-done repos skip the
+      stages they already finished, so re-running a campaign picks up where it
+      left off.
+    * history (schedule.History): optional; records how long each repo spent
+      in the stages, so the next run can be scheduled by it (see schedule.py).
+      Saved at the end of the run.
+    * on_exit: optional; called as `on_exit(item, err)` as each item leaves
+      the pipeline, whether it made it through every stage, was dropped or
+      skipped by a stage, or was skipped by the journal (err is None), or a
+      stage raised or the run was cancelled (err is the exception). Used by
+      workqueue.py to report back per repo.
+
+    A stage that raises (anything but Skip or Cancel) doesn't stop the run;
+    the item is dropped and reported in `failed`.
+
+    Returns a 2-tuple of:
+    - finished (list): the items that made it through every stage
+    - failed (list): (item, stage name, exception) for each item that raised
+    """
+    limits = {**DEFAULT_LIMITS, **(limits or {})}
+    slots = {kind: threading.BoundedSemaphore(n) for kind, n in limits.items()}
+    queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+    # the last queue collects finished items, so it never blocks
+    queues.append(queue.Queue())
+    failed = []
+    lock = threading.Lock()
+    # (index, exception) of the furthest stage that raised Cancel; it and
+    # every stage before it drop their items
+    cancelled = [-1, None]
+
+    threads = []
+    for i, stage in enumerate(stages):
+        workers = limits[stage.kind]
+        remaining = [workers]
+        for _ in range(workers):
+            thread = threading.Thread(
+                target=_work,
+                args=(
+                    i, stage, queues[i], queues[i + 1], slots[stage.kind],
+                    remaining, lock, failed, cancelled, journal, history,
+                    on_exit if i == len(stages) - 1 else None, on_exit
+                ),
+                daemon=True
+            )
+            thread.start()
+            threads.append(thread)
+
+    if journal:
+        items = _resume(items, stages[-1].name, journal, on_exit)
+    # the flag is checked before each item is taken (or claimed) rather than
+    # after, so nothing is pulled once the run is cancelled; one pulled while
+    # it was being cancelled still goes in, for the first stage to drop and
+    # report to on_exit
+    items = iter(items)
+    while cancelled[0] < 0:
+        item = next(items, _DONE)
+        if item is _DONE:
+            break
+        queues[0].put(item)
+    queues[0].put(_DONE)
+
+    for thread in threads:
+        thread.join()
+    if history:
+        history.save()
+
+    finished = []
+    while not queues[-1].empty():
+        item = queues[-1].get()
+        if item is not _DONE:
+            finished.append(item)
+    return finished, failed
+
+
+def _resume(items, last_stage, journal, on_exit):
+    """
+    Generator
+    Drops the items that `journal` already has as finished or skipped, and
+    restores the saved state of partly-done ones (marking which stages they
+    can pass straight through).
+    """
+    for item in items:
+        done, skipped = journal.state(item["rname"])
+        if skipped or last_stage in done:
+            LOG.info(f" {item['rname']}: already handled by this campaign, skipping")
+            if on_exit:
+                on_exit(item, None)
+            continue
+        for saved in done.values():
+            item.update(saved)
+        item["_done"] = set(done)
+        yield item
+
+
+def _work(
+        index, stage, inbox, outbox, slot, remaining, lock, failed, cancelled,
+        journal, history, on_finish, on_drop
+    ):
+    """
+    Worker thread for one stage: takes items off `inbox`, runs them through
+    the stage (a batch at a time, for a batch stage), and puts the results on
+    `outbox`. The last of a stage's workers to finish tells the next stage
+    that there's nothing more coming.
+
+    `on_drop` (if set) is called for items this stage drops or fails, and
+    `on_finish` (only set for the last stage) for the ones it passes on.
+    Once a stage at or after `index` has cancelled the run, items are dropped
+    without running the stage.
+    """
+    while True:
+        item = inbox.get()
+        if item is _DONE:
+            # put it back so the stage's other workers see it too
+            inbox.put(_DONE)
+            with lock:
+                remaining[0] -= 1
+                last = remaining[0] == 0
+            if last:
+                outbox.put(_DONE)
+            return
+
+        batch = [item]
+        if stage.batch:
+            batch.extend(_gather(inbox, stage.batch - 1, stage.batch_wait))
+
+        ready = []
+        for item in batch:
+            if cancelled[0] >= index:
+                # not journaled, so the next run starts it from where it was
+                if on_drop:
+                    on_drop(item, cancelled[1])
+            elif stage.name in item.get("_done", ()):
+                # finished on an earlier run
+                outbox.put(item)
+                if on_finish:
+                    on_finish(item, None)
+            else:
+                ready.append(item)
+        if not ready:
+            continue
+
+        with slot:
+            start = time.monotonic()
+            try:
+                results = stage.func(ready) if stage.batch else [stage.func(ready[0])]
+            except Exception as err:
+                results = [err] * len(ready)
+            elapsed = time.monotonic() - start
+            outcomes = [
+                _record(index, stage, item, result, lock, failed, cancelled, journal)
+                for item, result in zip(ready, results)
+            ]
+            # time spent waiting on a reviewer says nothing about the repo
+            if history and stage.kind != REVIEW:
+                for item in ready:
+                    history.add(item["rname"], elapsed / len(ready))
+            if stage.delay:
+                time.sleep(stage.delay)
+
+        for item, (result, error) in zip(ready, outcomes):
+            if result is not None:
+                outbox.put(result)
+                if on_finish:
+                    on_finish(result, None)
+            elif on_drop:
+                on_drop(item, error)
+
+
+def _gather(inbox, most, wait):
+    """
+    Takes up to `most` more items off `inbox`, waiting up to `wait` seconds
+    in all for them. Stops early at the end of the input, leaving _DONE there.
+    """
+    items = []
+    deadline = time.monotonic() + wait
+    while len(items) < most:
+        try:
+            item = inbox.get(timeout=max(0, deadline - time.monotonic()))
+        except queue.Empty:
+            break
+        if item is _DONE:
+            inbox.put(_DONE)
+            break
+        items.append(item)
+    return items
+
+
+def _record(index, stage, item, result, lock, failed, cancelled, journal):
+    """
+    Journals what the stage made of one item: `result` is what it returned
+    for the item, or the exception it raised. Returns (item to pass on or
+    None, exception to report to on_drop or None).
+    """
+    if isinstance(result, Cancel):
+        LOG.info(f" {stage.name} cancelled the run at {item.get('rname')}: {result}")
+        with lock:
+            if index > cancelled[0]:
+                cancelled[:] = [index, result]
+        return None, result
+    if isinstance(result, Skip):
+        LOG.info(f" {item.get('rname')}: skipped for good ({result})")
+        if journal:
+            journal.record(item["rname"], stage.name, SKIPPED, item)
+        return None, None
+    if isinstance(result, Exception):
+        LOG.info(f" {stage.name} failed on {item.get('rname')}: {result}")
+        with lock:
+            failed.append((item, stage.name, result))
+        if journal:
+            journal.record(item["rname"], stage.name, FAILED, item)
+        return None, result
+    if journal:
+        status = DROPPED if result is None else DONE
+        journal.record(item["rname"], stage.name, status, result or item)
+    return result, None
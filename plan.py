@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+"""
+Works out what a campaign will cost before it's run: how many REST, GraphQL
+and search calls and git network operations it'll make, whether those fit
+in what's left of the rate limits (per the live `/rate_limit`, which doesn't
+count against them), and roughly how long it'll take.
+
+Campaign entry points build a Plan in their plan mode (e.g.
+`python apply-labels.py --plan ...`, `bulk_merge_prs.py --plan`,
+`replace_string.main(..., plan=True)`) instead of doing any work, print its
+report, and reject the run (exit non-zero, or raise PlanError from `check`)
+if it would stall on a rate limit reset. The report also says how many of
+the targets fit in the current window, for sizing a run down to one that
+does.
+
+Targets are listed from the daemon's cached inventory when it's running
+(see daemon.py), so planning doesn't page through the org again. Calls are
+timed at the latencies measured on past runs (see http_metrics.py), where
+there are any.
+"""
+import json
+import logging
+import math
+import statistics
+import sys
+import time
+
+from collections import Counter
+
+
+logging.basicConfig(stream=sys.stderr, level=logging.INFO)
+LOG = logging.getLogger(__name__)
+
+# Kinds of operation a campaign makes
+REST = "rest"
+GRAPHQL = "graphql"
+SEARCH = "search"
+CODE_SEARCH = "code_search"
+GIT_NETWORK = "git-network"
+GIT_LOCAL = "git"
+
+# The `/rate_limit` bucket each kind of API call spends
+BUCKETS = {
+    REST: "core",
+    GRAPHQL: "graphql",
+    SEARCH: "search",
+    CODE_SEARCH: "code_search",
+}
+
+# Seconds each kind of operation takes when there's nothing better to go on.
+# Code search is held to 10 requests a minute, so it's paced at 6s a call.
+DEFAULT_SECONDS = {
+    REST: 0.5,
+    GRAPHQL: 1.5,
+    SEARCH: 1.0,
+    CODE_SEARCH: 6.0,
+    GIT_NETWORK: 5.0,
+    GIT_LOCAL: 0.2,
+}
+
+# Median seconds per kind of operation measured on past runs (by
+# http_metrics.py), used in place of DEFAULT_SECONDS
+LATENCIES_PATH = "output/latencies.json"
+
+# How long a bucket's window is, in seconds
+WINDOWS = {
+    "core": 60 * 60,
+    "graphql": 60 * 60,
+    "search": 60,
+    "code_search": 60,
+}
+
+
+class PlanError(Exception):
+    pass
+
+
+class Plan:
+    """
+    Expected cost of one campaign run.
+
+    * name (str): what's being planned, for the report
+    * targets (int): how many repos (or PRs) the run works through
+    """
+    def __init__(self, name, targets=0):
+        self.name = name
+        self.targets = targets
+        # calls made once per run, and once per target
+        self.fixed = Counter()
+        self.each = Counter()
+        self.seconds = dict(DEFAULT_SECONDS)
+        self.seconds.update(load_latencies())
+        # how many of each kind run at once (see pipeline.DEFAULT_LIMITS)
+        self.parallel = {}
+        # seconds of deliberate pauses over the run (e.g. between PRs)
+        self.pause = 0
+        # seconds per target from past runs, in place of the git estimate
+        self.per_target_seconds = None
+        self.notes = []
+
+    def add(self, kind, count=1):
+        """
+        Adds `count` calls of `kind` made once for the whole run
+        """
+        self.fixed[kind] += count
+
+    def per_target(self, kind, count=1):
+        """
+        Adds `count` calls of `kind` made for each target
+        """
+        self.each[kind] += count
+
+    def note(self, text):
+        self.notes.append(text)
+
+    def use_history(self, history, names):
+        """
+        Estimates the git side of each target from how long these repos took
+        on their last run (a schedule.History), where they have one; the
+        repos that don't are put down as the median of those that do
+        """
+        known = [history[name] for name in names if name in history]
+        if known:
+            median = statistics.median(known)
+            self.per_target_seconds = (sum(known) + median * (len(names) - len(known))) / max(1, len(names))
+            self.note(f"{len(known)} of {len(names)} repos timed on a past run")
+
+    def calls(self, targets=None):
+        """
+        Returns a Counter of {kind: calls} for `targets` targets (default all)
+        """
+        targets = self.targets if targets is None else targets
+        total = Counter(self.fixed)
+        for kind, count in self.each.items():
+            total[kind] += count * targets
+        return total
+
+    def duration(self):
+        """
+        Returns the expected seconds of work, not counting rate limit stalls
+        """
+        calls = self.calls()
+        seconds = 0
+        for kind, count in calls.items():
+            if self.per_target_seconds is not None and kind in (GIT_NETWORK, GIT_LOCAL):
+                continue
+            seconds += count * self.seconds[kind] / self.parallel.get(kind, 1)
+        if self.per_target_seconds is not None:
+            seconds += self.targets * self.per_target_seconds / self.parallel.get(GIT_NETWORK, 1)
+        return seconds + self.pause
+
+    def budget(self, limits, now=None):
+        """
+        Compares the calls against `limits` (from `rate_limits`).
+
+        Returns a dict of {bucket: {"needed", "remaining", "limit", "stall"}},
+        where stall is how many seconds the run will sit waiting on resets.
+        """
+        now = now or time.time()
+        needed = Counter()
+        for kind, count in self.calls().items():
+            if kind in BUCKETS:
+                needed[BUCKETS[kind]] += count
+        result = {}
+        for bucket, count in needed.items():
+            limit = limits.get(bucket, {"remaining": 0, "limit": 0, "reset": now})
+            stall = 0
+            if count > limit["remaining"]:
+                if not limit["limit"]:
+                    stall = math.inf
+                else:
+                    # wait for this window to end, then as many more as it takes
+                    windows = math.ceil((count - limit["remaining"]) / limit["limit"])
+                    stall = max(0, limit["reset"] - now) + (windows - 1) * WINDOWS[bucket]
+            result[bucket] = {
+                "needed": count,
+                "remaining": limit["remaining"],
+                "limit": limit["limit"],
+                "stall": stall,
+            }
+        return result
+
+    def fitting_targets(self, limits):
+        """
+        Returns how many targets fit in what's left of the current windows
+        """
+        fit = self.targets
+        for bucket in {BUCKETS[kind] for kind in self.each if kind in BUCKETS}:
+            per_target = sum(c for k, c in self.each.items() if BUCKETS.get(k) == bucket)
+            fixed = sum(c for k, c in self.fixed.items() if BUCKETS.get(k) == bucket)
+            remaining = limits.get(bucket, {}).get("remaining", 0)
+            if per_target:
+                fit = min(fit, max(0, (remaining - fixed) // per_target))
+        return fit
+
+    def report(self, limits, now=None):
+        """
+        Returns a printable summary of the plan against `limits`
+        """
+        budget = self.budget(limits, now)
+        stall = max([b["stall"] for b in budget.values()] + [0])
+        lines = [f"Plan: {self.name} ({self.targets} targets)"]
+        for kind, count in sorted(self.calls().items()):
+            lines.append(f"  {kind:12} {count:7} calls")
+        for bucket, b in sorted(budget.items()):
+            status = "ok" if not b["stall"] else f"stalls {_minutes(b['stall'])}"
+            lines.append(
+                f"  {bucket:12} needs {b['needed']}, {b['remaining']}/{b['limit']} left: {status}"
+            )
+        lines.append(f"  expected duration: {_minutes(self.duration() + stall)}")
+        if stall:
+            lines.append(
+                f"  only {self.fitting_targets(limits)} of {self.targets} targets"
+                " fit in the current rate limit windows"
+            )
+        lines.extend(f"  note: {note}" for note in self.notes)
+        return "\n".join(lines)
+
+    def check(self, limits, allow_stall=False, now=None):
+        """
+        Raises PlanError if the run would stall on a rate limit reset (unless
+        `allow_stall`). Returns the report.
+        """
+        report = self.report(limits, now)
+        stalled = [
+            bucket for bucket, b in self.budget(limits, now).items() if b["stall"]
+        ]
+        if stalled and not allow_stall:
+            raise PlanError(f"{self.name} doesn't fit the {', '.join(stalled)} rate limit\n{report}")
+        return report
+
+
+def _minutes(seconds):
+    if seconds == math.inf:
+        return "forever"
+    if seconds < 120:
+        return f"{seconds:.0f}s"
+    return f"{seconds / 60:.0f}m"
+
+
+def load_latencies(path=LATENCIES_PATH):
+    """
+    Returns the measured {kind: median seconds} saved by past runs
+    """
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def save_latencies(latencies, path=LATENCIES_PATH):
+    """
+    Saves this run's {kind: median seconds} over the ones saved before
+    """
+    saved = load_latencies(path)
+    saved.update(latencies)
+    try:
+        with open(path, "w") as f:
+            json.dump(saved, f, indent=4, sort_keys=True)
+    except OSError:
+        # e.g. no output/ directory where the script was run from
+        pass
+
+
+def rate_limits(gh_headers):
+    """
+    Returns the live rate limits as {bucket: {"limit", "remaining", "reset"}}.
+    Asking doesn't count against them.
+    """
+    from github_helpers import SESSION
+
+    response = SESSION.get("https://api.github.com/rate_limit", headers=gh_headers)
+    response.raise_for_status()
+    return response.json()["resources"]
+
+
+def list_repos(gh_headers, org, exclude_private, plan):
+    """
+    Returns the org's repos (5-tuples from `github_helpers.get_repos`), from
+    the daemon's cache if it's running. Otherwise they're listed from the
+    API, and the pages are counted as part of the run.
+    """
+    from daemon import DaemonError, ask
+
+    try:
+        repos = ask("repos", org=org, exclude_private=exclude_private)
+        plan.note("repos listed from the daemon's cache")
+    except DaemonError:
+        from github_helpers import get_repos
+        repos = list(get_repos(gh_headers, org, exclude_private))
+    # the run lists them again, 30 to a page plus the empty page at the end
+    plan.add(REST, len(repos) // 30 + 1)
+    return repos
@@ -1,13 +1,177 @@
+#!/usr/bin/env python3
 """
-what limit do i have left
+Usage:
+    python ratelimit.py [-h] [-w SECONDS] [-m MINUTES] [-l LOG]
+
+Requires:
+    GITHUB_TOKEN in local environment; optionally GITHUB_TOKENS, a
+    comma-separated list of more tokens (or name=token pairs) to watch
+
+Description:
+    Shows what's left of the core, search, graphql and code_search rate
+    limits for each configured token: remaining/limit, how long until the
+    bucket resets, and how fast it's being used up over the last MINUTES.
+    Asking GitHub for the limits doesn't count against them.
+
+    The consumption comes from the usage log (`github_helpers.USAGE_LOG`)
+    that every script appends to as it makes API calls, so it's split up by
+    the script that spent it. A bucket that'll run dry before it resets at
+    the current rate is flagged.
+
+    With -w, redraws every SECONDS until interrupted.
+
+    Doesn't show the secondary rate limits, which GitHub doesn't expose.
 """
+import argparse
 import json
-import requests
+import os
+import sys
+import time
+
+from collections import Counter, defaultdict
+
+from github_helpers import USAGE_LOG, token_id
+from plan import rate_limits
+
+
+BUCKETS = ("core", "search", "graphql", "code_search")
+
+
+def credentials():
+    """
+    Returns a list of (name, token) for GITHUB_TOKEN and each entry of
+    GITHUB_TOKENS
+    """
+    creds = []
+    if os.environ.get("GITHUB_TOKEN"):
+        creds.append(("GITHUB_TOKEN", os.environ["GITHUB_TOKEN"]))
+    for i, entry in enumerate(filter(None, os.environ.get("GITHUB_TOKENS", "").split(",")), 1):
+        name, _, token = entry.strip().rpartition("=")
+        creds.append((name or f"GITHUB_TOKENS[{i}]", token))
+    return creds
+
+
+def usage(path, since):
+    """
+    Reads the usage log (and the one it was last rotated to, see
+    `github_helpers.USAGE_LOG_MAX_BYTES`), and returns a dict of
+    {(token id, bucket): Counter of {script: calls' worth of limit used}}
+    since `since`.
+
+    Each entry records the bucket's `used` count after the call, so the
+    difference from the entry before it (in the same window) is what the
+    call cost, which for GraphQL can be more than 1.
+    """
+    spent = defaultdict(Counter)
+    last = {}
+    for name in (path + ".1", path):
+        try:
+            f = open(name)
+        except FileNotFoundError:
+            continue
+        with f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # a line cut short by a script that was killed mid-write
+                    continue
+                key = (entry["token"], entry["resource"])
+                prev = last.get(key)
+                last[key] = entry
+                if entry["time"] < since:
+                    continue
+                if prev and prev["reset"] == entry["reset"]:
+                    # free calls (304s) leave `used` as it was
+                    cost = max(0, entry["used"] - prev["used"])
+                else:
+                    cost = 1
+                if cost:
+                    spent[key][entry["script"]] += cost
+    return spent
+
+
+def report(creds, minutes, path=USAGE_LOG, now=None):
+    """
+    Returns the printable table for every credential
+    """
+    now = now or time.time()
+    spent = usage(path, now - minutes * 60)
+    lines = []
+    for name, token in creds:
+        tid = token_id(token)
+        lines.append(f"{name} ({tid})")
+        lines.append(
+            f"  {'bucket':12} {'left':>13}  {'resets in':>9}  {f'used/min ({minutes}m)':>16}"
+        )
+        try:
+            limits = rate_limits({"AUTHORIZATION": f"token {token}"})
+        except Exception as err:
+            lines.append(f"  couldn't read the limits: {err}")
+            continue
+        for bucket in BUCKETS:
+            if bucket not in limits:
+                continue
+            limit = limits[bucket]
+            reset_in = max(0, limit["reset"] - now)
+            scripts = spent.get((tid, bucket), Counter())
+            rate = sum(scripts.values()) / minutes
+            flag = ""
+            if rate and limit["remaining"] / rate * 60 < reset_in:
+                flag = "  runs out in " + _duration(limit["remaining"] / rate * 60)
+            lines.append(
+                f"  {bucket:12} {limit['remaining']:>6}/{limit['limit']:<6}"
+                f"  {_duration(reset_in):>9}  {rate:>16.1f}{flag}"
+            )
+            for script, count in scripts.most_common():
+                lines.append(f"      {script}: {count}")
+        lines.append("")
+    return "\n".join(lines)
+
+
+def _duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    return f"{minutes}m{seconds:02d}s"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Shows the remaining rate limits for each configured\
+            token, when they reset, and which scripts are using them up."
+    )
+
+    parser.add_argument(
+        "-w", "--watch",
+        help="Redraw every this many seconds",
+        type=int
+    )
+
+    parser.add_argument(
+        "-m", "--minutes",
+        help="Measure consumption over this many minutes (default 15)",
+        type=int,
+        default=15
+    )
 
-from github_helpers import get_github_headers
+    parser.add_argument(
+        "-l", "--log",
+        help=f"Usage log to read (default {USAGE_LOG})",
+        default=USAGE_LOG
+    )
 
-gh_headers = get_github_headers()
-response = requests.get('https://api.github.com/rate_limit', headers=gh_headers)
+    args = parser.parse_args()
+    creds = credentials()
+    if not creds:
+        sys.exit("*** ERROR ***\nGITHUB_TOKEN must be defined in this environment")
 
-rjson = response.json()
-print(json.dumps(rjson, indent=3, sort_keys=True))
+    if not args.watch:
+        print(report(creds, args.minutes, args.log))
+        sys.exit()
+    try:
+        while True:
+            table = report(creds, args.minutes, args.log)
+            # clear the screen, then draw
+            print("\033[2J\033[H" + time.strftime("%H:%M:%S") + "\n" + table, flush=True)
+            time.sleep(args.watch)
+    except KeyboardInterrupt:
+        pass
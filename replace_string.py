@@ -19,19 +19,26 @@ Notes:
     There is a small amount of hardcoded functionality and variable definitions
     at the end of the file, in the `__main__` section. It may be difficult to
     make this script fully generic, but this is pretty close.
-
-    `swap_strings` (in shell_helpers.py) has hardcoded shell commands that are
-    wonky due to OSX. If you're not on OSX you should examine and change them.
 """
 
 import datetime
 import json
 import logging
+import os
 import sys
-import time
+import threading
 
 from github_helpers import *
+from journal import DONE, SKIPPED, Journal
 from parse_pr_query import parse_prs
+from pipeline import (
+    DEFAULT_LIMITS, LOCAL, NETWORK, Skip, Stage, campaign_stages, make_item_prs,
+    run_campaign
+)
+from plan import (
+    CODE_SEARCH, GIT_LOCAL, GIT_NETWORK, GRAPHQL, Plan, PlanError, list_repos, rate_limits
+)
+from schedule import History
 from shell_helpers import *
 
 ### TODO ###
@@ -52,12 +59,19 @@ LOG = logging.getLogger(__name__)
 
 def main(
         org_or_query,  # is either a string `org_name` or a PR query (see parse-pr-query.py)
-        string_pairs,  # a list of pairs (old_string, new_string, commit_msg)
+        string_pairs,  # a list of pairs (old_string, new_string, commit_msg), optionally with a 4th pathspec dict
         branch_name,  # if opening a new branch, else None
         pr_details,  # when opening the pr. dict of {"title": "title text", "body": "body_text"} or None if not creating a PR
         root_dir,
         exclude_private=False,
-        interactive=False
+        interactive=False,
+        select_repos=None,
+        campaign=None,
+        order=None,
+        work_queue=None,
+        prefilter=False,
+        prefilter_local=False,
+        plan=False
     ):
     """
     Goes through all repos in an org, clones them (or switches to the default
@@ -70,12 +84,39 @@ def main(
       `/Users/<uname>/path/to/dir`
     * old_string: what string we're looking to see if each repo has
     * new_string: if old_string is found, what we should replace it with
+    * string_pairs: each entry may have an optional 4th item, a dict of git
+      pathspecs `{"include": [...], "exclude": [...]}` that limits where that
+      pair is searched for and swapped, e.g. `{"include": [".github/workflows/"]}`
     * exclude_private (bool): if True, script skips private repos (default
       False)
-    * interactive (bool): if True, pauses before committing files upstream and
-      awaits user confirmation
+    * interactive (bool): if True, each repo's commits wait in a review queue
+      (see review.py) and are only pushed once approved
+    * select_repos (list): optional; if set, only these repos will be processed
+      (e.g. `fleet_grep.repos_with_hits(<fleet_grep output>)`)
+    * campaign, order, work_queue: optional; see `pipeline.run_campaign`.
+      The campaign defaults to one per branch_name
+    * prefilter (bool): if True, only fetch the repos that GitHub code search
+      says contain one of the old strings (see
+      `github_helpers.prefilter_repos`), instead of every repo in the org.
+      Org runs only
+    * prefilter_local (bool): with prefilter, also keep repos the search
+      missed whose existing clone has one of the old strings
+    * plan (bool): if True, only print what the run would cost (see
+      `make_plan`), raising PlanError if it won't fit the rate limit. Org runs
+      only
     """
     gh_headers = get_github_headers()
+    if "is:pr" in org_or_query:
+        # the PRs are opened in the org the query searched
+        org = next(
+            (term[len("org:"):] for term in org_or_query.split() if term.startswith("org:")),
+            None
+        )
+        if pr_details and not org:
+            raise ValueError("Opening PRs from a PR query needs an org: qualifier in it")
+    else:
+        org = org_or_query
+    campaign = campaign or f"replace_string:{branch_name}"
 
     summary = {
         "commits": 0,    # number of commits made (intentionally not making a PR)
@@ -85,77 +126,203 @@ def main(
     }
     overall_output = {}
 
-    if "is:pr" in org_or_query:
-        LOG.info(f" Found pr query: {org_or_query}")
-        # repo name, ssh_url, default branch, _, count
-        loop_iterator = parse_prs(org_or_query) # TODO fix this return value
-        
-    else:
+    # every pair gets a (possibly empty) dict of include/exclude pathspecs
+    pairs = [
+        (pair[0], pair[1], pair[2], pair[3] if len(pair) > 3 else {})
+        for pair in string_pairs
+    ]
+
+    if plan:
+        journal = Journal(campaign)
+        try:
+            if work_queue or "is:pr" in org_or_query:
+                raise PlanError("Only runs over an org can be planned")
+            run_plan = make_plan(
+                gh_headers, org_or_query, pairs, pr_details, root_dir, journal,
+                exclude_private, select_repos, prefilter, prefilter_local
+            )
+            print(run_plan.check(rate_limits(gh_headers)))
+        finally:
+            journal.close()
+        return
+
+    def list_org_repos():
+        if "is:pr" in org_or_query:
+            LOG.info(f" Found pr query: {org_or_query}")
+            # repo name, ssh_url, default branch, _, count
+            return parse_prs(org_or_query) # TODO fix this return value
+
         LOG.info(f" Found org: {org_or_query}")
-        loop_iterator = get_repos(gh_headers, org_or_query, exclude_private)
+        repos = get_repos(gh_headers, org_or_query, exclude_private)
+        if prefilter:
+            repos = prefilter_repos(
+                repos, gh_headers, org_or_query, [old for (old, _, _, _) in pairs],
+                root_dir=root_dir if prefilter_local else None
+            )
+        return repos
+
+    def sizes():
+        # a PR query has no org to ask for sizes; go by the local clones
+        if "is:pr" in org_or_query:
+            return {}
+        return get_repo_sizes(gh_headers, org_or_query, exclude_private)
+
+    # stage functions run on several threads at once, so the shared summary
+    # and output are only touched while holding this
+    lock = threading.Lock()
+    count = 0
+
+    # a repo can only have an open PR from the branch if the preflight in
+    # run_campaign didn't drop it for already having the branch
+    existing_prs = (
+        OpenPrs(gh_headers, org, branch_name) if work_queue and branch_name and pr_details
+        else None
+    )
 
-    try:
-        for repo_data in loop_iterator:
-            (rname, ssh_url, dbranch, _, count) = repo_data
-            single_output = []
-            LOG.info("\n\n******* CHECKING REPO: {} ({}) ************".format(rname, count))
-            repo_path = get_repo_path(rname, root_dir)
-
-            # clone repo; if exists, checkout the default branch & pull latest
-            clone_repo(root_dir, repo_path, ssh_url, dbranch)
-
-            # # TODO: Figure out how to handle new branches vs existing ones
-            # # Checkout the already-existing branch_name -- maybe a new arg
-            # branch_created = False
-            # if not checkout_branch(repo_path, branch_name):
-            #     # this branch was never created, or already merged, so
-            #     # create it for the new commit
-            #     new_branch(repo_path, branch_name)
-            #     branch_created = True
-
-            # Go thru and s/old string/new string/g in the repo, then make a commit.
-            # If multiple swaps, does one commit for each swap.
-            for (old_string, new_string, commit_msg) in string_pairs:
-                # Search for the string; fail fast if none exist
-                if not found(old_string, repo_path):
-                    LOG.info(" Did not find string {}".format(old_string))
-                    summary["skipped"] += 1
-                    single_output.append(f"Did not find string {old_string}")
-                    continue
-
-                # Swap old string for new string
-                swap_strings(old_string, new_string, repo_path)
-
-                if interactive:
-                    try:
-                        interactive_commit(repo_path)
-                    except RepoError:
-                        # move on to next repo
-                        continue
-
-                make_commit(repo_path, commit_msg)
-                single_output.append(f"CREATED: {commit_msg}\n")
-
-            if pr_details:
-                try:
-                    LOG.info(f" Making a pull request")
-                    pr_url = make_pr(gh_headers, org, rname, branch_name, dbranch, pr_details)
-                    single_output.append(f"  PR: {pr_url}\n")
+    def skip(item, message):
+        LOG.info(f" {item['rname']}: {message}")
+        with lock:
+            summary["skipped"] += 1
+
+    def not_on_list(rname):
+        LOG.info(f" {rname}: not on list")
+        with lock:
+            summary["skipped"] += 1
+
+    def fetch(item):
+        # clone (without checkout) or fetch the repo, then search the fetched
+        # default branch; only repos that have a string get checked out
+        nonlocal count
+        rname, repo_path = item["rname"], item["repo_path"]
+        LOG.info("\n\n******* CHECKING REPO: {} ({}) ************".format(rname, item["count"]))
+        with lock:
+            count = max(count, item["count"])
+        if existing_prs:
+            existing_prs.expect(rname)
+        rev = fetch_repo(root_dir, repo_path, item["ssh_url"], item["dbranch"])
+        if not any(
+                found_in_rev(old, repo_path, rev, **paths)
+                for (old, _, _, paths) in pairs
+            ):
+            skip(item, "did not find any of the strings")
+            return None
+        return item
+
+    def edit(item):
+        repo_path = item["repo_path"]
+        item["output"] = []
+        checkout_fetched(repo_path, item["dbranch"])
+        if branch_name:
+            # commits go on the new branch, which is what gets pushed (with
+            # no branch_name they go straight on the default branch)
+            if not new_branch(repo_path, branch_name):
+                skip(item, "branch already exists")
+                raise Skip("branch exists")
+            item["branch_name"] = branch_name
+
+        # Go thru and s/old string/new string/g in the repo, then make a commit.
+        # If multiple swaps, does one commit for each swap.
+        for (old_string, new_string, commit_msg, paths) in pairs:
+            # Search for the string; fail fast if none exist
+            if not found(old_string, repo_path, **paths):
+                # only noted; the repo counts as skipped if no pair changes it
+                LOG.info(" {}: did not find string {}".format(item["rname"], old_string))
+                item["output"].append(f"Did not find string {old_string}")
+                continue
+
+            # Swap old string for new string
+            swap_strings(old_string, new_string, repo_path, **paths)
+            if not has_changes(repo_path):
+                item["output"].append(f"No change for {old_string}")
+                continue
+
+            item["sha"] = make_commit(repo_path, commit_msg)
+            item["output"].append(f"CREATED: {commit_msg}\n")
+
+        if not item.get("sha"):
+            # none of the swaps changed anything; don't push or open a PR
+            skip(item, "nothing changed")
+            with lock:
+                overall_output[item["rname"]] = item["output"]
+            if branch_name:
+                drop_branch(repo_path, item["dbranch"], branch_name)
+            return None
+        return item
+
+    def open_prs(items):
+        to_open = []
+        for item in items:
+            existing = existing_prs.get(item["rname"]) if existing_prs else None
+            if existing:
+                # don't make a duplicate (GitHub would refuse it with a 422)
+                LOG.info(f" Reusing open PR {existing}")
+                item["pr_url"] = existing
+                item["output"].append(f"  PR: {existing}\n")
+                with lock:
                     summary["pr_success"] += 1
-                except PrCreationError as pr_err:
-                    LOG.info(pr_err.__str__())
-                    # info you need to retry
-                    single_output.append(
-                        f"FAIL REPO INFO: {org}, {rname}, {branch_name}, {dbranch}, {pr_details}\n"
-                    )
-                    summary["pr_failure"] += 1
-
-                time.sleep(5)
+            elif pr_details:
+                to_open.append(item)
             else:
                 LOG.info(f"  committed to branch with no PR")
-                summary["commits"] += 1
+                with lock:
+                    summary["commits"] += 1
+
+        if to_open:
+            LOG.info(f" Making pull requests for {', '.join(item['rname'] for item in to_open)}")
+        results = dict(zip(
+            [item["rname"] for item in to_open],
+            make_item_prs(gh_headers, org, to_open, pr_details)
+        ))
+        for item in items:
+            rname = item["rname"]
+            result = results.get(rname, item)
+            if isinstance(result, PrCreationError):
+                # info you need to retry; the error journals this stage as
+                # failed, so a re-run retries the PR
+                LOG.info(result.__str__())
+                item["output"].append(
+                    f"FAIL REPO INFO: {org}, {rname}, {branch_name}, {item['dbranch']}, {pr_details}\n"
+                )
+                with lock:
+                    summary["pr_failure"] += 1
+            elif rname in results:
+                item["output"].append(f"  PR: {item['pr_url']}\n")
+                with lock:
+                    summary["pr_success"] += 1
+            with lock:
+                overall_output[rname] = item["output"]
+        return [results.get(item["rname"], item) for item in items]
 
-            overall_output["rname"] = single_output
+    stages = campaign_stages(
+        [Stage("fetch", fetch, NETWORK), Stage("edit", edit, LOCAL)],
+        open_prs, interactive, pr_delay=PR_BATCH_PAUSE if pr_details else 0
+    )
+
+    # ask GraphQL which repos already have the branch, so those are never
+    # fetched
+    preflight_skipped = []
+
+    def skip_existing(repos):
+        return skip_existing_branches(
+            repos, gh_headers, org, branch_name, skipped=preflight_skipped
+        )
+
+    if work_queue:
+        LOG.info(f" Claiming repos from work queue: {work_queue}")
+    try:
+        _, failed = run_campaign(
+            campaign, stages, root_dir, list_org_repos, work_queue=work_queue,
+            order=order, sizes=sizes, select_repos=select_repos,
+            on_unselected=not_on_list,
+            # a PR query without an org: qualifier can't be checked
+            skip_existing=skip_existing if branch_name and org else None
+        )
+        for rname, status in preflight_skipped:
+            overall_output[rname] = [f"BRANCH EXISTS ({status})"]
+            summary["skipped"] += 1
+        for item, stage_name, err in failed:
+            if not isinstance(err, PrCreationError):
+                overall_output[item["rname"]] = [f"FAILED IN {stage_name}: {err}"]
 
     except KeyboardInterrupt:
         LOG.info(" Received interrupt, cancelling out")
@@ -165,21 +332,84 @@ def main(
         filename = f"output/replace_existing_branch_{ts}.json"
         with open(filename, "w") as f:
             f.write(json.dumps(overall_output, indent=4))
-        print(f"Output of {count-1} repos written to {filename}")
+        print(f"Output of {count} repos written to {filename}")
         LOG.info(
-            f" Processed {count} repos; PRs successfully made and {summary['pr_failure']} failures occurred when making PRs."
+            f" Processed {count} repos; {summary['pr_success']} PRs successfully made and {summary['pr_failure']} failures occurred when making PRs."
         )
         LOG.info(f"  {summary['commits']} commits created on existing branches.")
         LOG.info(f"  Skipped {summary['skipped']} repos")
 
 
+
+def make_plan(
+        gh_headers, org, pairs, pr_details, root_dir, journal, exclude_private=False,
+        select_repos=None, prefilter=False, prefilter_local=False
+    ):
+    """
+    Returns a plan.Plan for running the campaign over an org. Every repo is
+    fetched and searched; the ones that change are committed to, pushed and
+    (with pr_details) get a PR. Which repos change is judged from their
+    existing clones as of their last fetch, and repos that aren't cloned yet
+    are counted as changing. Repos the journal has as finished are left out,
+    as the run would skip them.
+    """
+    run_plan = Plan(f"replace strings in {org}")
+    repos = list_repos(gh_headers, org, exclude_private, run_plan)
+    if prefilter:
+        strings = [old for (old, _, _, _) in pairs]
+        repos = list(prefilter_repos(
+            repos, gh_headers, org, strings, root_dir if prefilter_local else None
+        ))
+        run_plan.add(CODE_SEARCH, len(strings))
+        run_plan.note("code search pages past the first aren't counted")
+
+    summary = journal.summary()
+    repos = [
+        repo for repo in repos
+        if (not select_repos or repo[0] in select_repos)
+        and summary.get(repo[0], (None, None))[1] != SKIPPED
+        and summary.get(repo[0], (None, None))[:2] != ("pr", DONE)
+    ]
+
+    changing = 0
+    for (rname, _, dbranch, _, _) in repos:
+        repo_path = get_repo_path(rname, root_dir)
+        if not os.path.exists(repo_path) or any(
+                found_in_rev(old, repo_path, f"origin/{dbranch}", **paths)
+                for (old, _, _, paths) in pairs
+            ):
+            changing += 1
+
+    run_plan.targets = len(repos)
+    # a fetch and a search per repo...
+    run_plan.per_target(GIT_NETWORK, 1)
+    run_plan.per_target(GIT_LOCAL, len(pairs))
+    # ...then a checkout, a search, swap and commit per pair, and a push
+    run_plan.add(GIT_LOCAL, changing * (1 + 3 * len(pairs)))
+    run_plan.add(GIT_NETWORK, changing)
+    if pr_details:
+        # PRs go out PR_BATCH_SIZE to a mutation, after a lookup of the repos'
+        # ids (see github_helpers.make_prs)
+        batches = -(-changing // PR_BATCH_SIZE)
+        run_plan.add(GRAPHQL, 2 * batches)
+        run_plan.pause = PR_BATCH_PAUSE * batches
+    run_plan.parallel = {GIT_NETWORK: DEFAULT_LIMITS[NETWORK], GIT_LOCAL: DEFAULT_LIMITS[LOCAL]}
+    run_plan.use_history(History(journal.campaign), [repo[0] for repo in repos])
+    run_plan.note(f"{changing} repos expected to change, going by their existing clones")
+    return run_plan
+
 if __name__ == "__main__":
     # is either a string `org_name` or a PR query (see parse-pr-query.py)
     org_or_query =  "author:sarina is:pr is:open org:openedx" #"openedx"
 
-    # a list of pairs (old_string, new_string, commit_msg)
+    # a list of pairs (old_string, new_string, commit_msg), each optionally
+    # followed by a dict of {"include": [pathspecs], "exclude": [pathspecs]}
     string_pairs = [
-        ("uses: edx/.github", "uses: openedx/.github", "fix: update path to .github workflows to read from openedx org")
+        (
+            "uses: edx/.github", "uses: openedx/.github",
+            "fix: update path to .github workflows to read from openedx org",
+            {"include": [".github/workflows/"]}
+        )
     ]
 
     # if opening a new branch or recommitting on existing branch. Put "None" if providing pr_data lists
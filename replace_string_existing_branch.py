@@ -13,10 +13,6 @@ Description:
     Checks out existing branch (or re-creates if existing was already merged)
     and performs another string swap with the new strings, and makes a new
     commit.
-
-Note:
-    `swap_strings` (in shell_helpers.py) has hardcoded shell commands that are
-    wonky due to OSX. If you're not on OSX you should examine and change them.
 """
 
 ## Steps
@@ -26,11 +22,13 @@ Note:
 
 import datetime
 import logging
-import subprocess
 import sys
-import time
+import threading
 
 from github_helpers import *
+from pipeline import (
+    LOCAL, NETWORK, Skip, Stage, campaign_stages, make_item_prs, run_campaign
+)
 from shell_helpers import *
 
 
@@ -38,7 +36,11 @@ from shell_helpers import *
 logging.basicConfig(stream=sys.stderr, level=logging.INFO)
 LOG = logging.getLogger(__name__)
 
-def main(org, root_dir, old_string, new_string, exclude_private=False, interactive=False):
+def main(
+        org, root_dir, old_string, new_string, exclude_private=False,
+        interactive=False, include=None, exclude=None, campaign=None, order=None,
+        work_queue=None
+    ):
     """
     Goes through all repos in an org, clones them (or switches to the default
     branch and then pulls latest changes), searches for the specified string, if
@@ -52,11 +54,16 @@ def main(org, root_dir, old_string, new_string, exclude_private=False, interacti
     * new_string: if old_string is found, what we should replace it with
     * exclude_private (bool): if True, script skips private repos (default
       False)
-    * interactive (bool): if True, pauses before committing files upstream and
-      awaits user confirmation
+    * interactive (bool): if True, each repo's commits wait in a review queue
+      (see review.py) and are only pushed once approved
+    * include (list): optional; git pathspecs to limit the search & swap to,
+      e.g. `[".github/workflows/"]`. Default is the whole repo
+    * exclude (list): optional; git pathspecs to leave out of the search & swap
+    * campaign, order, work_queue: optional; see `pipeline.run_campaign`
     """
     gh_headers = get_github_headers()
     branch_name = "tcril/fix-gh-org-url"
+    existing_prs = OpenPrs(gh_headers, org, branch_name)
     commit_msg = "fix: update path to .github workflows to read from openedx org"
     pr_details = {
         "title": "Fix github url strings in .github workflows",
@@ -66,62 +73,123 @@ def main(org, root_dir, old_string, new_string, exclude_private=False, interacti
     count_commits = 0
     count_prs = 0
     count_skipped = 0
+    count = 0
 
     ts = str(datetime.datetime.now())[:19]
     filename = f"output/replace_existing_branch_{ts}.json"
-    with open(filename, "w") as f:
-        for repo_data in get_repos(gh_headers, org, exclude_private):
-            (rname, ssh_url, dbranch, _, count) = repo_data
-            LOG.info("\n\n******* CHECKING REPO: {} ({}) ************".format(rname, count))
-            if rname == "cs_comments_service":
-                LOG.info(" skipping (was test repo)")
-                continue
-            repo_path = get_repo_path(rname, root_dir)
-            # clone repo; if exists, checkout the default branch & pull latest
-            clone_repo(root_dir, repo_path, ssh_url, dbranch)
-
-            # Search for the string; fail fast if none exist
-            if not found(old_string, repo_path):
-                LOG.info("Did not find string {}".format(old_string))
+    # stage functions run on several threads at once, so the output file and
+    # counters are only touched while holding this
+    lock = threading.Lock()
+
+    def fetch(item):
+        nonlocal count, count_skipped
+        rname, repo_path = item["rname"], item["repo_path"]
+        LOG.info("\n\n******* CHECKING REPO: {} ({}) ************".format(rname, item["count"]))
+        with lock:
+            count = max(count, item["count"])
+        existing_prs.expect(rname)
+        if rname == "cs_comments_service":
+            LOG.info(" skipping (was test repo)")
+            raise Skip("was test repo")
+        # clone (without checkout) or fetch the repo, and search the fetched
+        # default branch; fail fast if none exist
+        # the campaign branch too, so edit starts from what was last pushed
+        rev = fetch_repo(
+            root_dir, repo_path, item["ssh_url"], item["dbranch"], branches=[branch_name]
+        )
+        if not found_in_rev(old_string, repo_path, rev, include, exclude):
+            LOG.info("Did not find string {}".format(old_string))
+            with lock:
                 count_skipped += 1
                 f.write(f"NO STRING: {rname}\n")
-                continue
-
-            # Checkout the already-existing branch_name
-            branch_created = False
-            if not checkout_branch(repo_path, branch_name):
-                # this branch was never created, or already merged, so
-                # create it for the new commit
-                new_branch(repo_path, branch_name)
-                branch_created = True
-
-            # Swap old string for new string
-            swap_strings(old_string, new_string, repo_path)
-            if interactive:
-                try:
-                    interactive_commit(repo_path)
-                except RepoError:
-                    # move on to next repo
-                    continue
-
-            make_commit(repo_path, commit_msg)
-
-            if branch_created:
-                try:
-                    LOG.info(f" Making a pull request")
-                    pr_url = make_pr(gh_headers, org, rname, branch_name, dbranch, pr_details)
-                    f.write(f"CREATED PR: {pr_url}\n")
-                    count_prs += 1
-                except PrCreationError as pr_err:
-                    LOG.info(pr_err.__str__())
-                    # info you need to retry
-                    f.write(f"FAILED TO MAKE PR: {org}, {rname}, {branch_name}, {dbranch}, {pr_details}\n")
+            return None
+        return item
+
+    def edit(item):
+        repo_path = item["repo_path"]
+        checkout_fetched(repo_path, item["dbranch"])
+
+        # Checkout the already-existing branch_name
+        item["branch_created"] = False
+        if not checkout_branch(repo_path, branch_name):
+            # this branch was never created, or already merged, so
+            # create it for the new commit
+            new_branch(repo_path, branch_name)
+            item["branch_created"] = True
+        else:
+            # catch a local branch from an earlier run up with what's been
+            # pushed since; a no-op if it's current or origin doesn't have it
+            git("merge", ["--ff-only", f"origin/{branch_name}"], repo_path)
+        item["branch_name"] = branch_name
+        # the branch may already have commits; only review this run's
+        item["base_sha"] = head_sha(repo_path)
+
+        # Swap old string for new string
+        swap_strings(old_string, new_string, repo_path, include=include, exclude=exclude)
+        if not has_changes(repo_path):
+            # the edit was a no-op; don't commit, push or open a PR
+            LOG.info(f"Skipping {item['rname']}, nothing changed")
+            if item["branch_created"]:
+                drop_branch(repo_path, item["dbranch"], branch_name)
+            return None
+
+        item["sha"] = make_commit(repo_path, commit_msg)
+        return item
+
+    def open_prs(items):
+        nonlocal count_prs, count_commits
+        results = {}
+        to_open = []
+        for item in items:
+            rname = item["rname"]
+            existing = existing_prs.get(rname) if item["branch_created"] else None
+            if existing:
+                # don't make a duplicate (GitHub would refuse it with a 422)
+                LOG.info(f" Reusing open PR {existing}")
+                item["pr_url"] = existing
+                with lock:
+                    f.write(f"EXISTING PR: {existing}\n")
+                results[rname] = item
+            elif item["branch_created"]:
+                to_open.append(item)
             else:
                 LOG.info(f" committed to existing branch")
-                f.write(f"CREATED COMMIT: {rname}\n")
-                count_commits += 1
+                with lock:
+                    f.write(f"CREATED COMMIT: {rname}\n")
+                    count_commits += 1
+                results[rname] = item
+
+        if to_open:
+            LOG.info(f" Making {len(to_open)} pull requests")
+        for item, result in zip(to_open, make_item_prs(gh_headers, org, to_open, pr_details)):
+            rname, dbranch = item["rname"], item["dbranch"]
+            with lock:
+                if isinstance(result, PrCreationError):
+                    # info you need to retry; the error journals this stage
+                    # as failed, so a re-run retries the PR
+                    LOG.info(result.__str__())
+                    f.write(f"FAILED TO MAKE PR: {org}, {rname}, {branch_name}, {dbranch}, {pr_details}\n")
+                else:
+                    f.write(f"CREATED PR: {result['pr_url']}\n")
+                    count_prs += 1
+            results[rname] = result
+        return [results[item["rname"]] for item in items]
 
-            time.sleep(5)
+    stages = campaign_stages(
+        [Stage("fetch", fetch, NETWORK), Stage("edit", edit, LOCAL)],
+        open_prs, interactive
+    )
+
+    with open(filename, "w") as f:
+        _, failed = run_campaign(
+            campaign or f"replace_string_existing_branch:{branch_name}", stages,
+            root_dir, lambda: get_repos(gh_headers, org, exclude_private),
+            work_queue=work_queue, order=order,
+            sizes=lambda: get_repo_sizes(gh_headers, org, exclude_private)
+        )
+        for item, stage_name, err in failed:
+            if not isinstance(err, PrCreationError):
+                f.write(f"FAILED IN {stage_name}: {item['rname']} ({err})\n")
 
     LOG.info(
         f"Processed {count} repos; {count_prs} PRs successfully made and {count_commits} commits created on existing branches"
@@ -133,4 +201,9 @@ if __name__ == "__main__":
     root_dir = "/Users/sarinacanelake/openedx/"
     old_string = "uses: edx/.github"
     new_string = "uses: openedx/.github"
-    main("openedx", root_dir, old_string, new_string, exclude_private=False, interactive=False)
+    # workflow references only live under .github/workflows
+    include = [".github/workflows/"]
+    main(
+        "openedx", root_dir, old_string, new_string,
+        exclude_private=False, interactive=False, include=include
+    )
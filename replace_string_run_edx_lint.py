@@ -13,10 +13,6 @@ Description:
     For each repo in your org, first looks to see if one of the edx_lint files
     is present; if so, rolls back your branch, runs edx_lint, then re-runs
     the core logic to swap strings defined in `replace_string_with_another`.
-
-Note:
-    swap_strings has hardcoded shell commands that are wonky due to OSX. If
-    you're not on OSX you should examine and change them.
 """
 
 ## TODO
@@ -33,7 +29,6 @@ Note:
 
 import datetime
 import logging
-import subprocess
 import sys
 import time
 
@@ -42,12 +37,23 @@ from github_helpers import (
     clone_repo,
     get_github_headers,
     get_repo_path,
+    get_repos,
     git_reset_hard,
-    make_commit
+    has_changes,
+    head_sha,
+    make_commit,
+    prefilter_repos,
+    push_branch,
+    PushError
 )
 from shell_helpers import (
+    CommandTimeout,
+    found,
+    git,
     interactive_commit,
-    RepoError
+    RepoError,
+    run,
+    swap_strings
 )
 
 
@@ -55,7 +61,11 @@ from shell_helpers import (
 logging.basicConfig(stream=sys.stderr, level=logging.INFO)
 LOG = logging.getLogger(__name__)
 
-def main(org, root_dir, old_string, new_string, exclude_private=False, interactive=False):
+def main(
+        org, root_dir, old_string, new_string, exclude_private=False,
+        interactive=False, include=None, exclude=None, prefilter=False,
+        prefilter_local=False
+    ):
     """
     Goes through all repos in an org, clones them (or switches to the default
     branch and then pulls latest changes), searches for the specified string, if
@@ -71,6 +81,13 @@ def main(org, root_dir, old_string, new_string, exclude_private=False, interacti
       False)
     * interactive (bool): if True, pauses before committing files upstream and
       awaits user confirmation
+    * include (list): optional; git pathspecs to limit the search & swap to,
+      e.g. `[".github/workflows/"]`. Default is the whole repo
+    * exclude (list): optional; git pathspecs to leave out of the search & swap
+    * prefilter (bool): if True, only pull the repos that GitHub code search
+      says contain old_string (see `github_helpers.prefilter_repos`)
+    * prefilter_local (bool): with prefilter, also keep repos the search
+      missed whose existing clone has old_string
     """
     gh_headers = get_github_headers()
     branch_name = "tcril/fix-gh-org-url"
@@ -87,7 +104,13 @@ def main(org, root_dir, old_string, new_string, exclude_private=False, interacti
     ts = str(datetime.datetime.now())[:19]
     filename = f"output/run_edxlint_{ts}.json"
     with open(filename, "w") as f:
-        for repo_data in get_repos(gh_headers, org, exclude_private):
+        repos = get_repos(gh_headers, org, exclude_private)
+        if prefilter:
+            repos = prefilter_repos(
+                repos, gh_headers, org, [old_string],
+                root_dir=root_dir if prefilter_local else None
+            )
+        for repo_data in repos:
             (rname, ssh_url, dbranch, _, count) = repo_data
             LOG.info("\n\n******* CHECKING REPO: {} ({}) ************".format(rname, count))
             # used these as my two testing repos, they don't need to be reprocessed
@@ -96,59 +119,88 @@ def main(org, root_dir, old_string, new_string, exclude_private=False, interacti
                 count_skipped += 1
                 continue
 
-            repo_path = get_repo_path(rname, root_dir)
-            # clone repo; if exists, checkout the default branch & pull latest
-            clone_repo(root_dir, repo_path, ssh_url, dbranch)
-
-            # Search for the string; fail fast if none exist
-            if not found(old_string, repo_path):
-                LOG.info("Did not find string {}".format(old_string))
-                count_skipped += 1
-                f.write(f"NO STRING: {rname}\n")
-                continue
-
-            # Search for the files we need to re-do. Move on if
-            # none of them exist.
-            exists = False
-            for fname in edx_lint_files:
-                if find_file(fname, repo_path):
-                    LOG.info(f"found {fname}")
-                    exists = True
-            if not exists:
-                LOG.info("Did not find any of the edx_lint files")
-                f.write(f"NO LINT FILES: {rname}\n")
-                count_skipped += 1
-                continue
+            branch_sha = None
+            try:
+                repo_path = get_repo_path(rname, root_dir)
+                # clone repo; if exists, checkout the default branch & pull latest
+                clone_repo(root_dir, repo_path, ssh_url, dbranch)
+
+                # Search for the string; fail fast if none exist
+                if not found(old_string, repo_path, include=include, exclude=exclude):
+                    LOG.info("Did not find string {}".format(old_string))
+                    count_skipped += 1
+                    f.write(f"NO STRING: {rname}\n")
+                    continue
 
-            # Checkout the already-existing branch_name
-            if not checkout_branch(repo_path, branch_name):
-                # this branch was never created - sort it out later
-                LOG.info(f"Skipping {rname}, branch does not exist")
-                count_skipped += 1
-                f.write(f"BRANCH !EXISTS: {rname}\n")
-                continue
+                # Search for the files we need to re-do. Move on if
+                # none of them exist.
+                exists = False
+                for fname in edx_lint_files:
+                    if find_file(fname, repo_path):
+                        LOG.info(f"found {fname}")
+                        exists = True
+                if not exists:
+                    LOG.info("Did not find any of the edx_lint files")
+                    f.write(f"NO LINT FILES: {rname}\n")
+                    count_skipped += 1
+                    continue
 
-            # Reset the branch to remove last autogen commit
-            git_reset_hard(1, repo_path)
+                # Checkout the already-existing branch_name
+                if not checkout_branch(repo_path, branch_name):
+                    # this branch was never created - sort it out later
+                    LOG.info(f"Skipping {rname}, branch does not exist")
+                    count_skipped += 1
+                    f.write(f"BRANCH !EXISTS: {rname}\n")
+                    continue
 
-            # Go through each special file and run edx_lint on them
-            for fname in edx_lint_files:
-                if find_file(fname, repo_path):
-                    run_edx_lint(fname, repo_path)
+                # Reset the branch to remove last autogen commit
+                branch_sha = head_sha(repo_path)
+                git_reset_hard(1, repo_path)
+
+                # Go through each special file and run edx_lint on them
+                for fname in edx_lint_files:
+                    if find_file(fname, repo_path):
+                        run_edx_lint(fname, repo_path)
+
+                if interactive:
+                    try:
+                        interactive_commit(repo_path)
+                    except RepoError:
+                        # put the branch back as it was and move on to next repo
+                        git("reset", ["--hard", branch_sha], repo_path)
+                        continue
+
+                # Make a commit for the edx_lint update
+                lint_sha = make_commit(repo_path, "chore: run `edx_lint` update with the current version of the repo.")
+
+                # # Swap old string for new string
+                swap_strings(old_string, new_string, repo_path, include=include, exclude=exclude)
+                swap_sha = make_commit(repo_path, commit_msg)
+                if not (lint_sha or swap_sha):
+                    LOG.info(f"Skipping {rname}, nothing changed")
+                    f.write(f"NO CHANGE: {rname}\n")
+                    count_skipped += 1
+                    # nothing to push, so keep the autogen commit that's there
+                    git("reset", ["--hard", branch_sha], repo_path)
+                    continue
 
-            if interactive:
+                # The branch was rewritten, so both commits go up in one force-push
                 try:
-                    interactive_commit(repo_path)
-                except RepoError:
-                    # move on to next repo
+                    push_branch(repo_path, branch_name, force=True)
+                except PushError as push_err:
+                    LOG.info(push_err.__str__())
+                    f.write(f"PUSH FAILED: {rname}\n")
+                    count_skipped += 1
                     continue
-
-            # Make a commit for the edx_lint update
-            make_commit(repo_path, "chore: run `edx_lint` update with the current version of the repo.")
-
-            # # Swap old string for new string
-            swap_strings(old_string, new_string, repo_path)
-            make_commit(repo_path, commit_msg, force=True)
+            except CommandTimeout as err:
+                # any git command or edx_lint itself can hang; put the branch
+                # back as it was, autogen commit and all, and move on
+                LOG.info(f"Skipping {rname}: {err}")
+                if branch_sha:
+                    git("reset", ["--hard", branch_sha], repo_path)
+                count_skipped += 1
+                f.write(f"TIMED OUT: {rname}\n")
+                continue
 
             f.write(f"SUCCESS: {rname}\n")
             count_commits += 1
@@ -164,86 +216,25 @@ def main(org, root_dir, old_string, new_string, exclude_private=False, interacti
     LOG.info(f"Skipped {count_skipped} repos as branch was non-existant or string didn't exist")
 
 
-def found(old_string, repo_path):
-    """
-    Looks through the repo specified by `repo_path` to see if there are any
-    occurances of `old_string`
-
-    Returns bool: True if the string is found, else False
-    """
-    # grep -r old_string . returns an array of which files match the string.
-    proc = subprocess.Popen(
-        f"grep -r {old_string} .",
-        cwd=repo_path,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        shell=True
-    )
-    res, _ = proc.communicate()
-    return len(res) > 0
-
-
-def swap_strings(old_string, new_string, repo_path):
-    """
-    Replaces all occurances of `old_string` in the repo with `new_string`
-    recursively starting in the root directory given by `repo_path`
-
-    Does not inspect the `.git/` directory.
-    """
-    # Command one: Look for files with the old_string
-    c1 = f'/usr/bin/grep -rl --exclude-dir=.git "{old_string}"'
-
-    # Command two: Swap!
-    # delimiter for sed; rather than escape we'll use _ if we're replacing a URL
-    d = "/"
-    if "/" in old_string or "/" in new_string:
-        d = "_"
-    # NOTE!!! This is the OSX command, drop `LC_ALL=C` and `'' -e` if not OSX!
-    c2 = f"LC_ALL=C /usr/bin/xargs /usr/bin/sed -i '' -e 's{d}{old_string}{d}{new_string}{d}g'"
-
-    # Now chain those calls together in a subprocess wheee
-    chained = c1 + " | " + c2
-    proc = subprocess.Popen(
-        chained,
-        cwd=repo_path,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        shell=True
-    )
-
-    _ = proc.communicate()
-
 def find_file(fname, repo_path):
     """
     Returns True if fname exists in repo path
 
     fname (str) is the exact filename of a file you seek
     """
-    proc = subprocess.Popen(
-        f"ls {fname}",
-        cwd=repo_path,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        shell=True
-    )
     # Results will be either ("filename", '') or ('', does not exist error msg)
-    out, _ = proc.communicate()
+    result = run(f"ls {fname}", repo_path, shell=True)
 
-    return len(out) > 0
+    return len(result.stdout) > 0
 
 
 def run_edx_lint(fname, repo_path):
     """
     Runs `edx_lint write <fname>`
     """
-    proc = subprocess.Popen(
-        f"edx_lint write {fname}",
-        cwd=repo_path,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        shell=True
-    )
-    _ = proc.communicate()
+    result = run(f"edx_lint write {fname}", repo_path, shell=True)
+    if result.timed_out:
+        raise CommandTimeout(result)
 
 if __name__ == "__main__":
     root_dir = "/Users/sarinacanelake/openedx/"
@@ -9,19 +9,14 @@ Requires:
 Description:
     For each repo in your org, looks for a given string. If the string exists,
     switches to a new branch, replaces the string with a new string, commits
-    changes, and opens a PR. Everything currently hard-coded.
-
-Note:
-    swap_strings has hardcoded shell commands that are wonky due to OSX. If
-    you're not on OSX you should examine and change them.
+    changes and pushes; once every repo is done, opens the PRs in batches.
+    Everything currently hard-coded.
 """
 
 import datetime
 import json
 import logging
-import subprocess
 import sys
-import time
 
 from github_helpers import *
 from shell_helpers import *
@@ -31,7 +26,11 @@ from shell_helpers import *
 logging.basicConfig(stream=sys.stderr, level=logging.INFO)
 LOG = logging.getLogger(__name__)
 
-def main(org, root_dir, old_string, new_string, exclude_private=False, interactive=False):
+def main(
+        org, root_dir, old_string, new_string, exclude_private=False,
+        interactive=False, include=None, exclude=None, prefilter=False,
+        prefilter_local=False
+    ):
     """
     Goes through all repos in an org, clones them (or switches to the default
     branch and then pulls latest changes), searches for the specified string, if
@@ -47,6 +46,13 @@ def main(org, root_dir, old_string, new_string, exclude_private=False, interacti
       False)
     * interactive (bool): if True, pauses before committing files upstream and
       awaits user confirmation
+    * include (list): optional; git pathspecs to limit the search & swap to,
+      e.g. `[".github/workflows/"]`. Default is the whole repo
+    * exclude (list): optional; git pathspecs to leave out of the search & swap
+    * prefilter (bool): if True, only fetch the repos that GitHub code search
+      says contain old_string (see `github_helpers.prefilter_repos`)
+    * prefilter_local (bool): with prefilter, also keep repos the search
+      missed whose existing clone has old_string
     """
     gh_headers = get_github_headers()
     branch_name = "tcril/fix-gh-org-url"
@@ -59,59 +65,90 @@ def main(org, root_dir, old_string, new_string, exclude_private=False, interacti
     prs = []
     pr_failed = []
     repos_skipped = []
-
-    for repo_data in get_repos(gh_headers, org, exclude_private):
+    to_open = []
+
+    # ask GraphQL which repos already have the branch, so those are never
+    # fetched
+    preflight_skipped = []
+    repos = get_repos(gh_headers, org, exclude_private)
+    if prefilter:
+        repos = prefilter_repos(
+            repos, gh_headers, org, [old_string],
+            root_dir=root_dir if prefilter_local else None
+        )
+    repos = skip_existing_branches(
+        repos, gh_headers, org, branch_name, skipped=preflight_skipped
+    )
+    for repo_data in repos:
         (rname, ssh_url, dbranch, _, count) = repo_data
         LOG.info("\n\n******* CHECKING REPO: {} ({}) ************".format(rname, count))
 
-        repo_path = get_repo_path(rname, root_dir)
-        # clone repo; if exists, checkout the default branch & pull latest
-        clone_repo(root_dir, repo_path, ssh_url, dbranch)
+        try:
+            repo_path = get_repo_path(rname, root_dir)
+            # clone (without checkout) or fetch the repo, and search the fetched
+            # default branch; fail fast if none exist
+            rev = fetch_repo(root_dir, repo_path, ssh_url, dbranch)
+            if not found_in_rev(old_string, repo_path, rev, include, exclude):
+                LOG.info("Did not find string {}".format(old_string))
+                continue
+            checkout_fetched(repo_path, dbranch)
 
-        # Search for the string; fail fast if none exist
-        if not found(old_string, repo_path):
-            LOG.info("Did not find string {}".format(old_string))
-            continue
+            if not new_branch(repo_path, branch_name):
+                # this branch already exists
+                LOG.info("Skipping {}, branch already exists".format(rname))
+                repos_skipped.append([rname, "branch exists"])
+                continue
 
-        if not new_branch(repo_path, branch_name):
-            # this branch already exists
-            LOG.info("Skipping {}, branch already exists".format(rname))
-            repos_skipped.append([rname, "branch exists"])
-            continue
+            # Swap old string for new string
+            swap_strings(old_string, new_string, repo_path, include=include, exclude=exclude)
+            if not has_changes(repo_path):
+                # the swap was a no-op; don't commit, push, open a PR or sleep
+                LOG.info("Skipping {}, nothing changed".format(rname))
+                repos_skipped.append([rname, "no change"])
+                continue
 
-        # Swap old string for new string
-        swap_strings(old_string, new_string, repo_path)
+            if interactive:
+                try:
+                    interactive_commit(repo_path)
+                except RepoError:
+                    # move on to next repo
+                    continue
 
-        if interactive:
+            make_commit(repo_path, commit_msg)
             try:
-                interactive_commit(repo_path)
-            except RepoError:
-                # move on to next repo
+                # one push for the whole branch, right before the PR
+                push_branch(repo_path, branch_name)
+            except PushError as push_err:
+                LOG.info(push_err.__str__())
+                repos_skipped.append([rname, "push failed"])
                 continue
+            # the PRs are opened together once every branch is pushed
+            to_open.append((rname, branch_name, dbranch, pr_details))
+        except CommandTimeout as err:
+            # any git command can hang (a push most likely); give up on this
+            # repo, not the run
+            LOG.info("Skipping {}: {}".format(rname, err))
+            repos_skipped.append([rname, "timed out"])
+            continue
 
-        make_commit(repo_path, commit_msg)
-        try:
-            pr_url = make_pr(gh_headers, org, rname, branch_name, dbranch, pr_details)
-            prs.append(pr_url)
-        except PrCreationError as pr_err:
-            LOG.info(pr_err.__str__())
+    # A PR a time needed ~30s between PRs to stay clear of the secondary
+    # rate limit for notification-triggering content; make_prs batches them
+    # into GraphQL mutations and backs off on its own when pushed back.
+    urls, errors = make_prs(gh_headers, org, to_open)
+    for (rname, _, dbranch, _) in to_open:
+        if rname in urls:
+            prs.append(urls[rname])
+        else:
+            LOG.info("PR for {} failed: {}".format(rname, errors.get(rname)))
             # info you need to retry
             pr_failed.append((org, rname, branch_name, dbranch, pr_details))
-        # Without, you hit secondary rate limits if you have more than ~30
-        # repos. I tried 3, too short. 5, got through 80. 30, totally worked.
-        # there's a good number in between that i'm sure but they don't help
-        # much. From GH docs: Requests that create content which triggers
-        # notifications, such as issues, comments and pull requests, may be
-        # further limited and will not include a Retry-After header in the
-        # response. Please create this content at a reasonable pace to avoid
-        # further limiting.
-        time.sleep(30)
 
     LOG.info(
         "Processed {} repos; see output/prs.json ({}) and output/failed.json ({})".format(
             count, len(prs), len(pr_failed)
         )
     )
+    repos_skipped.extend([rname, "branch exists"] for rname, _ in preflight_skipped)
     LOG.info("Skipped these repos as branch was already defined: {}".format(repos_skipped))
 
     ts = str(datetime.datetime.now())[:19]
@@ -121,55 +158,6 @@ def main(org, root_dir, old_string, new_string, exclude_private=False, interacti
     with open(f"output/failed_{ts}.json", "w") as f2:
         f2.write(json.dumps(pr_failed))
 
-def found(old_string, repo_path):
-    """
-    Looks through the repo specified by `repo_path` to see if there are any
-    occurances of `old_string`
-
-    Returns bool: True if the string is found, else False
-    """
-    # grep -r old_string . returns an array of which files match the string.
-    proc = subprocess.Popen(
-        f"grep -r {old_string} .",
-        cwd=repo_path,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        shell=True
-    )
-    res, _ = proc.communicate()
-    return len(res) > 0
-
-
-def swap_strings(old_string, new_string, repo_path):
-    """
-    Replaces all occurances of `old_string` in the repo with `new_string`
-    recursively starting in the root directory given by `repo_path`
-
-    Does not inspect the `.git/` directory.
-    """
-    # Command one: Look for files with the old_string, skipping the .git dir
-    c1 = f'/usr/bin/grep -rl --exclude-dir=.git "{old_string}"'
-
-    # Command two: Swap!
-    # delimiter for sed; rather than escape we'll use _ if we're replacing a URL
-    d = "/"
-    if "/" in old_string or "/" in new_string:
-        d = "_"
-    # NOTE!!! This is the OSX command, drop `LC_ALL=C` and `'' -e` if not OSX!
-    c2 = f"LC_ALL=C /usr/bin/xargs /usr/bin/sed -i '' -e 's{d}{old_string}{d}{new_string}{d}g'"
-
-    # Now chain those calls together in a subprocess wheee
-    chained = c1 + " | " + c2
-    proc = subprocess.Popen(
-        chained,
-        cwd=repo_path,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        shell=True
-    )
-
-    _ = proc.communicate()
-
 
 if __name__ == "__main__":
     root_dir = "/Users/sarinacanelake/openedx/"
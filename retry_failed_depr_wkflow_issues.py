@@ -16,12 +16,8 @@
 import json
 import logging
 import sys
-import time
 
-from github_helpers import get_github_headers
-from add_depr_wkflw_issues import (
-    make_pr, git, get_repo_path, PrCreationError
-)
+from github_helpers import get_github_headers, make_prs, open_prs
 
 # Switch to DEBUG for additional debugging info
 logging.basicConfig(stream=sys.stderr, level=logging.INFO)
@@ -36,7 +32,8 @@ def main(path_to_failed_json, repo_root):
       (org, repo name, branch name, default branch name, dict that has one,
       both, or none of the keys "title" and "body" of the PR)
     repo_root must be a fully qualified path to the folder that holds the repo
-    directories (ex: Users/<uname>/openedx)
+    directories (ex: Users/<uname>/openedx). The PRs are opened from the
+    pushed branches, so the clones aren't touched any more.
     """
     gh_headers = get_github_headers()
 
@@ -45,25 +42,42 @@ def main(path_to_failed_json, repo_root):
     failed_repos = json.load(f)
     prs = []
     pr_failed = []
-    count = 1
+
+    # Many of these "failed" because a PR from the branch was already open
+    # (a 422). Look those up in bulk and keep them, rather than hitting the
+    # same 422 again.
+    existing = {}
+    by_branch = {}
+    for (org, rname, branch_name, _, _) in failed_repos:
+        by_branch.setdefault((org, branch_name), []).append(rname)
+    for (org, branch_name), rnames in by_branch.items():
+        for rname, pr_url in open_prs(gh_headers, org, rnames, branch_name).items():
+            existing[(org, rname, branch_name)] = pr_url
+
+    # Open the rest in batches per org (see github_helpers.make_prs), rather
+    # than one POST and a pause per PR
+    to_open = {}
     for repo_data in failed_repos:
         (org, rname, branch_name, dbranch, pr_details) = repo_data
-        LOG.info("\n\n******* CHECKING REPO: {} ({}) ************".format(rname, count))
-        repo_path = get_repo_path(rname, repo_root)
-        LOG.info("Got repo path {}".format(repo_path))
-        # check out branch_name
-        git("checkout", [branch_name], repo_path)
-        try:
-            pr_url = make_pr(gh_headers, org, rname, branch_name, dbranch, pr_details)
-            prs.append(pr_url)
-        except PrCreationError as pr_err:
-            LOG.info(pr_err)
-            # info you need to retry
-            pr_failed.append([org, rname, branch_name, dbranch, pr_details]) 
+        if (org, rname, branch_name) in existing:
+            LOG.info("{}: PR already open: {}".format(rname, existing[(org, rname, branch_name)]))
+            prs.append(existing[(org, rname, branch_name)])
+            continue
+        to_open.setdefault(org, []).append(repo_data)
 
-        count += 1
-        # sleep so we don't anger the secondary rate limit god
-        time.sleep(5)
+    for org, entries in to_open.items():
+        urls, errors = make_prs(
+            gh_headers, org,
+            [(rname, branch_name, dbranch, pr_details) for (_, rname, branch_name, dbranch, pr_details) in entries]
+        )
+        for repo_data in entries:
+            rname = repo_data[1]
+            if rname in urls:
+                prs.append(urls[rname])
+            else:
+                LOG.info("{}: {}".format(rname, errors.get(rname)))
+                # info you need to retry
+                pr_failed.append(repo_data)
 
     with open("output/prs.json", "w") as f:
         f.write(json.dumps(prs))
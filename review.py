@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""
+Review queue for interactive pipeline campaigns.
+
+Rather than stopping the whole run on `input()` for each repo, a campaign
+commits its edits locally as usual and hands each repo to a ReviewQueue. A
+LOCAL "diff" stage works out the `git diff --stat` and full patch of every
+repo in the background, while a single "review" stage asks about them one at
+a time. Clones and edits for the following repos keep going while you read,
+and approved repos go straight on to push & PR. Nothing is pushed until a repo
+is approved, so a rejected repo just stays as a local commit. Quitting stops
+the fetches and edits as well; repos already approved are still pushed, and
+the ones never reviewed come up again on the next run of the campaign.
+
+Repos with the same change (same added/removed lines, whatever the file
+names) share a fingerprint, and can be approved or rejected in bulk.
+"""
+import hashlib
+import logging
+import sys
+import threading
+
+from pipeline import LOCAL, REVIEW, Cancel, Skip, Stage
+from shell_helpers import git
+
+
+logging.basicConfig(stream=sys.stderr, level=logging.INFO)
+LOG = logging.getLogger(__name__)
+
+PROMPT = (
+    "[y]es / [n]o / [a]pprove all like this / [r]eject all like this /"
+    " [p]atch / [q]uit reviewing: "
+)
+
+
+class ReviewQueue:
+    """
+    Holds the diffs waiting for review, and the bulk decisions made so far.
+    Use `stages()` to put it in a pipeline, after the stage that commits and
+    before `pipeline.push`.
+
+    Each item's diff is taken from `item["base_sha"]` (set this before editing
+    if the branch may already have commits) or else `origin/<dbranch>`, up to
+    HEAD.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        # fingerprint -> True (approve) / False (reject), set by a bulk answer
+        self._decisions = {}
+        # fingerprint -> how many prepared repos are waiting with it
+        self._waiting = {}
+
+    def stages(self):
+        """
+        Returns the Stages that make up the review: "diff" (LOCAL) precomputes
+        each repo's diff, "review" (REVIEW, one at a time) asks about it.
+        """
+        return [
+            Stage("diff", self.prepare, LOCAL),
+            Stage("review", self.review, REVIEW),
+        ]
+
+    def prepare(self, item):
+        """
+        Stage function: works out the repo's diff stat, patch & fingerprint
+        """
+        base = item.get("base_sha") or f"origin/{item['dbranch']}"
+        stat, _ = git("diff", ["--stat", base, "HEAD"], item["repo_path"])
+        patch, _ = git("diff", [base, "HEAD"], item["repo_path"])
+        # kept out of the journal, it only saves keys that don't start with _
+        item["_stat"] = stat.decode("utf-8", "replace")
+        item["_patch"] = patch.decode("utf-8", "replace")
+        item["fingerprint"] = fingerprint(item["_patch"])
+        with self._lock:
+            self._waiting[item["fingerprint"]] = self._waiting.get(item["fingerprint"], 0) + 1
+        return item
+
+    def review(self, item):
+        """
+        Stage function: returns the item if it's approved, raises Skip if it's
+        rejected, or Cancel if the reviewer quits
+        """
+        if "_patch" not in item:
+            # resumed run; the diff was worked out by an earlier one
+            self.prepare(item)
+        rname, fp = item["rname"], item["fingerprint"]
+        with self._lock:
+            self._waiting[fp] -= 1
+            waiting = self._waiting[fp]
+            decision = self._decisions.get(fp)
+
+        if decision is None:
+            decision = self._ask(item, waiting)
+        elif decision:
+            LOG.info(f" {rname}: approved (same change as before, {fp})")
+        else:
+            LOG.info(f" {rname}: rejected (same change as before, {fp})")
+        if not decision:
+            raise Skip("rejected in review")
+        return item
+
+    def _ask(self, item, waiting):
+        fp = item["fingerprint"]
+        print(f"\n===== {item['rname']} (change {fp}, {waiting} more like it queued) =====")
+        print(item["_stat"])
+        while True:
+            try:
+                cmd = input(PROMPT).strip().lower()
+            except EOFError:
+                cmd = "q"
+            if cmd == "p":
+                print(item["_patch"])
+            elif cmd in ("y", "n"):
+                return cmd == "y"
+            elif cmd in ("a", "r"):
+                with self._lock:
+                    self._decisions[fp] = cmd == "a"
+                return cmd == "a"
+            elif cmd == "q":
+                # stops the fetches & edits too; the repos that weren't
+                # reviewed aren't journaled, so the next run asks about them
+                raise Cancel("stopped reviewing")
+
+
+def fingerprint(patch):
+    """
+    Returns a short hash of the lines a patch adds and removes, leaving out
+    file names, hunk positions and context, so the same edit made in
+    different repos gets the same fingerprint.
+    """
+    digest = hashlib.sha1()
+    for line in patch.splitlines():
+        if line.startswith(("+++", "---")):
+            continue
+        if line.startswith(("+", "-")):
+            digest.update(line.encode())
+            digest.update(b"\n")
+    return digest.hexdigest()[:10]
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+"""
+Orders a campaign's repos by how long they're likely to take.
+
+`get_repos` hands repos out in API order, so a giant repo like edx-platform
+can come up at any point; under a parallel pipeline it then tends to be the
+straggler everything else waits on. Starting the biggest repos first (longest
+job first) keeps the pipeline's workers evenly loaded to the end. Smallest
+first is there too, for when you'd rather see results early.
+
+A repo's expected cost is how long it took on the last run (see History),
+falling back on its size: the API's `size` field, or the clone's disk usage.
+"""
+import json
+import logging
+import os
+import statistics
+import sys
+import threading
+
+from github_helpers import get_repo_path
+from shell_helpers import run
+
+
+logging.basicConfig(stream=sys.stderr, level=logging.INFO)
+LOG = logging.getLogger(__name__)
+
+LARGEST_FIRST = "largest"
+SMALLEST_FIRST = "smallest"
+
+DEFAULT_PATH = "output/durations.json"
+
+
+class History:
+    """
+    How many seconds each repo spent in a campaign's stages on its last run,
+    kept in a JSON file of {campaign: {repo name: seconds}}. Campaigns are
+    timed separately, since a repo that's slow to lint-and-rewrite can be
+    quick to copy one file into. `pipeline.run_pipeline` adds to it as stages
+    finish and saves it at the end of the run.
+
+    * campaign (str): the campaign's name, as in its journal
+    * path (str): optional; where the JSON file lives
+    """
+    def __init__(self, campaign, path=DEFAULT_PATH):
+        self.campaign = campaign
+        self.path = path
+        self._lock = threading.Lock()
+        self._this_run = {}
+        self._durations = self._load().get(campaign, {})
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                saved = json.load(f)
+        except FileNotFoundError:
+            return {}
+        # files from before durations were kept per campaign are just
+        # {repo name: seconds}, which can't be told apart; start over
+        return {
+            campaign: durations for campaign, durations in saved.items()
+            if isinstance(durations, dict)
+        }
+
+    def __contains__(self, rname):
+        return rname in self._durations
+
+    def __getitem__(self, rname):
+        return self._durations[rname]
+
+    def add(self, rname, seconds):
+        """
+        Adds `seconds` to the time `rname` has spent in this run
+        """
+        with self._lock:
+            self._this_run[rname] = self._this_run.get(rname, 0) + seconds
+
+    def save(self):
+        """
+        Writes this run's durations over the campaign's saved ones, leaving
+        other campaigns' as they are in the file
+        """
+        with self._lock:
+            self._durations.update(self._this_run)
+            self._this_run = {}
+            saved = self._load()
+            saved[self.campaign] = dict(self._durations)
+        with open(self.path, "w") as f:
+            json.dump(saved, f, indent=4, sort_keys=True)
+
+    def seconds_per_kb(self, sizes):
+        """
+        Returns the median seconds per KB over the repos that have both a
+        duration and a size, or None if there are none
+        """
+        rates = [
+            seconds / sizes[rname] for rname, seconds in self._durations.items()
+            if sizes.get(rname)
+        ]
+        return statistics.median(rates) if rates else None
+
+
+def local_size(repo_path):
+    """
+    Returns the disk usage of the clone at repo_path in KB (0 if it isn't
+    cloned yet)
+    """
+    if not os.path.exists(repo_path):
+        return 0
+    result = run(["du", "-sk", repo_path], repo_path)
+    try:
+        return int(result.stdout.split()[0])
+    except (IndexError, ValueError):
+        return 0
+
+
+def order_repos(repos, sizes, order=LARGEST_FIRST, history=None, root_dir=None):
+    """
+    Returns the repos (5-tuples from `github_helpers.get_repos`) as a list,
+    ordered by expected cost.
+
+    * sizes (dict): {repo name: size in KB}, e.g. from
+      `github_helpers.get_repo_sizes`. Repos missing from it are sized by
+      their local clone, if root_dir is given
+    * order (str): LARGEST_FIRST or SMALLEST_FIRST
+    * history (History): optional; last run's durations, used instead of the
+      size for the repos that have one
+    * root_dir (str): optional; where the repos are cloned
+    """
+    repos = list(repos)
+    sizes = dict(sizes)
+    if root_dir:
+        for repo in repos:
+            if repo[0] not in sizes:
+                sizes[repo[0]] = local_size(get_repo_path(repo[0], root_dir))
+    # durations only help if they can be put on the same scale as sizes
+    rate = history.seconds_per_kb(sizes) if history else None
+
+    def cost(repo):
+        rname = repo[0]
+        if rate and rname in history:
+            return history[rname]
+        size = sizes.get(rname, 0)
+        return size * rate if rate else size
+
+    LOG.info(f" Scheduling {len(repos)} repos, {order} first")
+    # sorted() is stable, so repos that cost the same stay in API order
+    return sorted(repos, key=cost, reverse=(order == LARGEST_FIRST))
@@ -3,22 +3,137 @@
 Helpers for shell commands, such as `cp`, `mv`, or a call
 for any command that starts with `git`.
 """
+import logging
+import os
+import signal
 import subprocess
+import sys
+import threading
+import time
 
-def mkdir(working_dir, dir_name):
-    p1 = subprocess.Popen(
-        ["/bin/mkdir", dir_name],
-        cwd=working_dir, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+from collections import namedtuple
+from fnmatch import fnmatch
+
+from command_metrics import RECORDER as COMMAND_METRICS
+from file_helpers import is_binary, rewrite_files
+
+
+logging.basicConfig(stream=sys.stderr, level=logging.INFO)
+LOG = logging.getLogger(__name__)
+
+GIT = "/opt/homebrew/bin/git"
+
+# git subcommands that go out to the network, and get the longer timeout
+GIT_NETWORK_COMMANDS = {"clone", "fetch", "pull", "push", "ls-remote"}
+
+# How long (seconds) each class of command may run before it's killed. One
+# hung host-key or credential prompt, or a stalled fetch, then costs at most
+# this much instead of freezing the whole run.
+TIMEOUTS = {
+    "git-network": 600,
+    "git": 120,
+    "shell": 300,
+}
+
+# Never let git or ssh stop to ask for anything; fail instead
+NO_PROMPT_ENV = {
+    "GIT_TERMINAL_PROMPT": "0",
+    "GIT_SSH_COMMAND": os.environ.get("GIT_SSH_COMMAND", "ssh -o BatchMode=yes"),
+}
+
+# What `run` returns:
+# - args: the command that was run
+# - returncode (int): exit code (negative if killed by a signal)
+# - duration (float): wall time in seconds
+# - stdout, stderr (bytes)
+# - timed_out (bool): True if the command was killed for running too long
+CommandResult = namedtuple(
+    "CommandResult", ["args", "returncode", "duration", "stdout", "stderr", "timed_out"]
+)
+
+
+class CommandTimeout(Exception):
+    """
+    A command ran past its timeout and was killed
+    """
+    def __init__(self, result):
+        self.result = result
+
+    def __str__(self):
+        return f"Timed out after {self.result.duration:.0f}s: {self.result.args}"
+
+
+def run(args, cwd, kind="shell", timeout=None, shell=False):
+    """
+    Runs a command and waits for it, but no longer than `timeout` seconds
+    (default: TIMEOUTS[kind]). Prompts are turned off (no stdin,
+    GIT_TERMINAL_PROMPT=0, ssh BatchMode), and the command runs in its own
+    process group so that if it times out (or we're interrupted) the whole
+    group is killed, not just the top process.
+
+    * args: list of command line arguments, or a string if `shell` is True
+    * cwd: string, which working dir to execute the command in
+    * kind: which TIMEOUTS entry applies
+
+    Returns a CommandResult. Every command is also timed in
+    command_metrics.py.
+    """
+    timeout = timeout or TIMEOUTS[kind]
+    start = time.monotonic()
+    proc = subprocess.Popen(
+        args,
+        cwd=cwd,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        env={**os.environ, **NO_PROMPT_ENV},
+        shell=shell,
+        start_new_session=True
     )
-    _ = p1.communicate()
+    timed_out = False
+    try:
+        out, err = proc.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        timed_out = True
+        _kill_group(proc)
+        out, err = proc.communicate()
+        LOG.warning(f" Killed after {timeout}s: {args} (in {cwd})")
+    except BaseException:
+        # e.g. Ctrl-C; don't leave the command running on its own
+        _kill_group(proc)
+        raise
+    result = CommandResult(
+        args, proc.returncode, time.monotonic() - start, out, err, timed_out
+    )
+    COMMAND_METRICS.record(
+        args, cwd, result.duration, result.returncode, len(out), len(err), timed_out
+    )
+    return result
+
+
+def _kill_group(proc):
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+def mkdir(working_dir, dir_name):
+    run(["/bin/mkdir", dir_name], working_dir)
 
 
 def cp(working_dir, filepath, dest_path):
-    p1 = subprocess.Popen(
-        ["cp", filepath, dest_path],
-        cwd=working_dir, stdout=subprocess.PIPE, stderr=subprocess.PIPE
-    )
-    _ = p1.communicate()
+    run(["cp", filepath, dest_path], working_dir)
+
+
+def git_run(command, args, cwd, timeout=None):
+    """
+    Like `git`, but returns the full CommandResult (exit code, duration,
+    timed_out, ...). Network subcommands get the "git-network" timeout, the
+    rest the "git" one, unless `timeout` is given.
+    """
+    kind = "git-network" if command in GIT_NETWORK_COMMANDS else "git"
+    return run([GIT, command] + list(args), cwd, kind, timeout)
 
 
 def git(command, args, cwd):
@@ -27,17 +142,15 @@ def git(command, args, cwd):
     * command: string
     * args: list of command line arguments
     * cwd: string, which working dir to execute the command in
+
+    Returns (stdout, stderr). Raises CommandTimeout if the command had to be
+    killed (see `git_run` for the timeouts), so a hung clone or fetch fails
+    that one repo instead of the whole run.
     """
-    array = ["/opt/homebrew/bin/git", command]
-    array.extend(args)
-    p1 = subprocess.Popen(
-        array,
-        cwd=cwd,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE
-    )
-    out = p1.communicate()
-    return out
+    result = git_run(command, args, cwd)
+    if result.timed_out:
+        raise CommandTimeout(result)
+    return result.stdout, result.stderr
 
 
 class RepoError(Exception):
@@ -50,7 +163,7 @@ def interactive_commit(repo_path):
     """
     # don't call the `git` method because we always want this to go to stdout
     p1 = subprocess.Popen(
-        ["/opt/homebrew/bin/git", "diff"],
+        [GIT, "diff"],
         cwd=repo_path
     )
     _ = p1.communicate()
@@ -65,51 +178,238 @@ def interactive_commit(repo_path):
         raise RepoError
 
 
-def swap_strings(old_string, new_string, repo_path):
+# Files bigger than this (in bytes) are never scanned or rewritten
+MAX_FILE_SIZE = 2 * 1024 * 1024
+
+# Tracked files whose repo-relative path matches one of these globs are never
+# scanned or rewritten
+SKIP_GLOBS = [
+    "node_modules/*", "*/node_modules/*",
+    "fixtures/*", "*/fixtures/*",
+    "*.min.js", "*.min.css", "*.map",
+    "package-lock.json", "*/package-lock.json",
+    "yarn.lock", "*/yarn.lock",
+    "*.png", "*.jpg", "*.jpeg", "*.gif", "*.ico", "*.svg", "*.pdf",
+    "*.woff", "*.woff2", "*.ttf", "*.eot",
+]
+
+# Files with any of these .gitattributes set are never scanned or rewritten
+SKIP_ATTRIBUTES = ["binary", "linguist-generated", "linguist-vendored"]
+
+
+def pathspec_args(include=None, exclude=None):
     """
-    Replaces all occurances of `old_string` in the repo with `new_string`
-    recursively starting in the root directory given by `repo_path`
+    Builds the `-- <pathspec>...` tail of a git command that limits it to the
+    paths in `include` (all paths if empty) minus the paths in `exclude`.
+    Both are lists of git pathspecs, e.g. `[".github/workflows/"]` or
+    `["*.py"]`.
+    """
+    args = ["--"]
+    args.extend(include or [])
+    args.extend(f":(exclude){path}" for path in (exclude or []))
+    return args
+
 
-    Does not inspect the `.git/` directory.
+def candidate_files(
+        old_string, repo_path, max_size=MAX_FILE_SIZE, skip_globs=SKIP_GLOBS,
+        include=None, exclude=None
+    ):
     """
-    # Command one: Look for files with the old_string, skipping the .git directorys
-    c1 = f'/usr/bin/grep -rl --exclude-dir=.git "{old_string}"'
+    Finds the files in the repo at `repo_path` that contain `old_string` and
+    are safe to rewrite.
 
-    # Command two: Swap!
-    # delimiter for sed; rather than escape we'll use _ if we're replacing a URL
-    d = "/"
-    if "/" in old_string or "/" in new_string:
-        d = "_"
-    # NOTE!!! This is the OSX command, drop `LC_ALL=C` and `'' -e` if not OSX!
-    c2 = f"LC_ALL=C /usr/bin/xargs /usr/bin/sed -i '' -e 's{d}{old_string}{d}{new_string}{d}g'"
+    `include` and `exclude` are lists of git pathspecs (see `pathspec_args`)
+    that scope the search; files outside them are never opened.
 
-    # Now chain those calls together in a subprocess wheee
-    chained = c1 + " | " + c2
-    proc = subprocess.Popen(
-        chained,
-        cwd=repo_path,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        shell=True
+    Only git-tracked files are looked at (`git grep`), and binary files are
+    skipped by NUL-sniffing. Also skips files that match one of `skip_globs`,
+    have one of SKIP_ATTRIBUTES set in .gitattributes, are symlinks, or are
+    bigger than `max_size` bytes.
+
+    Returns a list of fully-qualified file paths.
+    """
+    # -I skips files git thinks are binary; -z separates names with NULs so
+    # odd names survive
+    out, _ = git(
+        "grep",
+        ["-l", "-z", "-I", "-F", "-e", old_string] + pathspec_args(include, exclude),
+        repo_path
     )
+    names = [
+        name for name in out.decode("utf-8", "surrogateescape").split("\0")
+        if name and not any(fnmatch(name, glob) for glob in skip_globs)
+    ]
+    names = _without_attributes(names, repo_path)
 
-    _ = proc.communicate()
+    paths = []
+    for name in names:
+        path = os.path.join(repo_path, name)
+        if os.path.islink(path) or os.lstat(path).st_size > max_size:
+            continue
+        if is_binary(path):
+            continue
+        paths.append(path)
+    return paths
 
 
-def found(old_string, repo_path):
+def _without_attributes(names, repo_path, chunk_size=500, rev=None):
+    """
+    Drops the files (repo-relative names) that have any of SKIP_ATTRIBUTES set.
+    With `rev`, the .gitattributes files are read from that commit instead of
+    the working tree (needs git 2.40 or later).
+    """
+    source = [f"--source={rev}"] if rev else []
+    skipped = set()
+    for i in range(0, len(names), chunk_size):
+        out, _ = git(
+            "check-attr",
+            source + ["-z"] + SKIP_ATTRIBUTES + ["--"] + names[i:i + chunk_size],
+            repo_path
+        )
+        # output is `path NUL attribute NUL value NUL` for every pair
+        fields = out.decode("utf-8", "surrogateescape").split("\0")
+        for j in range(0, len(fields) - 2, 3):
+            name, _, value = fields[j:j + 3]
+            if value not in ("unspecified", "unset", "false"):
+                skipped.add(name)
+    return [name for name in names if name not in skipped]
+
+
+def swap_strings(
+        old_string, new_string, repo_path, processes=None,
+        max_size=MAX_FILE_SIZE, skip_globs=SKIP_GLOBS,
+        include=None, exclude=None
+    ):
+    """
+    Replaces all occurances of `old_string` in the repo with `new_string`
+    recursively starting in the root directory given by `repo_path`
+
+    Only touches the files `candidate_files` picks out, so untracked, binary,
+    generated, vendored and oversized files are left alone. Strings are matched
+    literally. `include` and `exclude` are lists of git pathspecs that limit
+    the swap to part of the repo. Big repos get their files rewritten in
+    parallel (see `file_helpers.rewrite_files`); `processes` caps the number
+    of workers.
+
+    Returns a sorted list of the files that were changed.
+    """
+    file_paths = candidate_files(
+        old_string, repo_path, max_size, skip_globs, include, exclude
+    )
+    return rewrite_files(file_paths, old_string, new_string, processes)
+
+
+def found(
+        old_string, repo_path, max_size=MAX_FILE_SIZE, skip_globs=SKIP_GLOBS,
+        include=None, exclude=None
+    ):
     """
     Looks through the repo specified by `repo_path` to see if there are any
-    occurances of `old_string`
+    occurances of `old_string`, in the files that `swap_strings` would touch.
+    `include` and `exclude` are lists of git pathspecs that limit the search.
+
+    Returns bool: True if the string is found, else False
+    """
+    file_paths = candidate_files(
+        old_string, repo_path, max_size, skip_globs, include, exclude
+    )
+    return len(file_paths) > 0
+
+
+def found_in_rev(
+        old_string, repo_path, rev, include=None, exclude=None, skip_globs=SKIP_GLOBS
+    ):
+    """
+    Like `found`, but searches the git object database at `rev` (a commit,
+    branch or remote-tracking ref such as `origin/main`) instead of the working
+    tree, so the repo doesn't need to be checked out first. `include` and
+    `exclude` are lists of git pathspecs that limit the search.
+
+    Skips the same `skip_globs` and SKIP_ATTRIBUTES files as `found`, going by
+    the .gitattributes at `rev`. File sizes aren't checked.
 
     Returns bool: True if the string is found, else False
     """
-    # grep -r old_string . returns an array of which files match the string.
+    # the globs go in as more excludes, so git never opens those files
+    exclude = list(exclude or []) + list(skip_globs)
+    # git grep -l prints `rev:path` for each file that matches
+    out, _ = git(
+        "grep",
+        ["-l", "-z", "-I", "-F", "-e", old_string, rev] + pathspec_args(include, exclude),
+        repo_path
+    )
+    prefix = f"{rev}:"
+    names = [
+        name[len(prefix):] if name.startswith(prefix) else name
+        for name in out.decode("utf-8", "surrogateescape").split("\0") if name
+    ]
+    return len(_without_attributes(names, repo_path, rev=rev)) > 0
+
+
+def grep_lines(pattern, repo_path, fixed=True, rev=None, include=None, exclude=None):
+    """
+    Generator
+    Runs `git grep` over the repo at `repo_path` and yields each matching line
+    as it comes in, as a 4-tuple:
+    - file path, relative to the repo (str)
+    - line number (int)
+    - column of the first match (int)
+    - text of the line (str)
+
+    * fixed (bool): if True, `pattern` is a literal string; otherwise it's an
+      extended regex
+    * rev (str): optional; search this commit/ref (e.g. `origin/main`) instead
+      of the working tree, which works on `--no-checkout` clones too
+    * include, exclude (list): optional git pathspecs that limit the search
+    """
+    args = ["-n", "--column", "-z", "-I", "-F" if fixed else "-E", "-e", pattern]
+    if rev:
+        args.append(rev)
+    args.extend(pathspec_args(include, exclude))
     proc = subprocess.Popen(
-        f"grep -r {old_string} .",
+        [GIT, "grep"] + args,
         cwd=repo_path,
+        stdin=subprocess.DEVNULL,
         stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        shell=True
+        stderr=subprocess.DEVNULL,
+        env={**os.environ, **NO_PROMPT_ENV},
+        start_new_session=True
     )
-    res, _ = proc.communicate()
-    return len(res) > 0
+    # the output is streamed, so a watchdog kills the search if it's still
+    # going when the timeout runs out
+    start = time.monotonic()
+    timed_out = threading.Event()
+
+    def expire():
+        timed_out.set()
+        _kill_group(proc)
+
+    watchdog = threading.Timer(TIMEOUTS["git"], expire)
+    watchdog.daemon = True
+    watchdog.start()
+    prefix = f"{rev}:" if rev else ""
+    out_bytes = 0
+    try:
+        for raw in proc.stdout:
+            out_bytes += len(raw)
+            # each line is `path NUL line NUL column NUL text`
+            line = raw.decode("utf-8", "replace").rstrip("\n")
+            path, line_no, column, text = line.split("\0", 3)
+            if prefix and path.startswith(prefix):
+                path = path[len(prefix):]
+            yield path, int(line_no), int(column), text
+        # don't let a cut-off search pass for a complete one
+        if timed_out.is_set() and proc.wait() < 0:
+            raise CommandTimeout(CommandResult(
+                proc.args, proc.returncode, time.monotonic() - start, b"", b"", True
+            ))
+    finally:
+        watchdog.cancel()
+        proc.stdout.close()
+        if proc.poll() is None:
+            _kill_group(proc)
+        proc.wait()
+        COMMAND_METRICS.record(
+            proc.args, repo_path, time.monotonic() - start, proc.returncode,
+            out_bytes, 0, timed_out.is_set()
+        )
@@ -0,0 +1,19 @@
+"""
+Keeps the shared modules' import times under their budgets in
+gh_scripting.IMPORT_BUDGETS (the same check as `gh_scripting.py imports`).
+"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from gh_scripting import IMPORT_BUDGETS, import_time
+
+
+@pytest.mark.parametrize("module", sorted(IMPORT_BUDGETS))
+def test_import_budget(module):
+    # the first import also compiles the module; time a warm one
+    import_time(module)
+    assert import_time(module) <= IMPORT_BUDGETS[module]
@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+"""
+Usage:
+    python workqueue.py [-h] [-p PATH] [-P] [--order {largest,smallest}] [-c CAMPAIGN] {enqueue,status,reset} name [org]
+
+Description:
+    Shared queue of repos for splitting one campaign over several worker
+    processes, on one host or many. It's a SQLite file in rollback-journal
+    mode, so it can live on a shared filesystem with working file locks
+    (keep the hosts' clocks in sync, leases are wall-clock times).
+
+    A coordinator fills the queue once:
+
+        python workqueue.py enqueue copy_file:tcril/some-branch openedx
+
+    and then each worker runs the campaign with `work_queue=` set to the same
+    name (e.g. `copy_file_to_repos.main(..., work_queue="copy_file:...")`).
+    Workers claim repos a few at a time with a lease, keep the lease alive
+    while they work on them, and report each repo as done or failed. If a
+    worker dies, its leases run out and the repos go back to the other
+    workers (a repo that fails, or whose lease runs out, MAX_ATTEMPTS times
+    is left failed).
+
+    Each worker has its own pipeline limits, so throughput grows with the
+    number of workers until GitHub's API limits are what's holding it back.
+
+    `status` prints how many repos are in each state; `reset` puts failed
+    repos back in the queue.
+"""
+import argparse
+import json
+import logging
+import os
+import socket
+import sqlite3
+import sys
+import threading
+import time
+
+
+logging.basicConfig(stream=sys.stderr, level=logging.INFO)
+LOG = logging.getLogger(__name__)
+
+DEFAULT_PATH = "output/workqueue.sqlite3"
+
+# How long (seconds) a claimed repo stays with its worker without a renewal
+LEASE = 15 * 60
+
+# A repo is left failed after this many tries
+MAX_ATTEMPTS = 3
+
+PENDING = "pending"
+CLAIMED = "claimed"
+DONE = "done"
+FAILED = "failed"
+
+
+class WorkQueue:
+    """
+    One named queue of repos (usually named after the campaign).
+
+    * name (str): which queue in the file
+    * path (str): optional; where the SQLite file lives
+    * worker (str): optional; this worker's id (default `<host>:<pid>`)
+    * lease (int): optional; lease length in seconds
+    """
+    def __init__(self, name, path=DEFAULT_PATH, worker=None, lease=LEASE):
+        self.name = name
+        self.worker = worker or f"{socket.gethostname()}:{os.getpid()}"
+        self.lease = lease
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._heartbeat = None
+        # several workers write to the same file, so wait on their locks
+        # rather than failing straight away
+        self._conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        # WAL keeps its index in shared memory, which other hosts can't see;
+        # the rollback journal only needs file locks. Set it explicitly, as a
+        # file once put in WAL mode stays that way.
+        self._conn.execute("PRAGMA journal_mode=DELETE")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS tasks (
+                queue TEXT NOT NULL,
+                repo TEXT NOT NULL,
+                priority INTEGER NOT NULL,
+                data TEXT NOT NULL,
+                status TEXT NOT NULL,
+                worker TEXT,
+                lease_until REAL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                error TEXT,
+                PRIMARY KEY (queue, repo)
+            )"""
+        )
+        self._conn.commit()
+
+    def enqueue(self, repos):
+        """
+        Adds repos (5-tuples from `github_helpers.get_repos`) to the queue,
+        to be claimed in the order given. Repos already in it are left alone.
+
+        Returns how many were added.
+        """
+        with self._lock:
+            (start,) = self._conn.execute(
+                "SELECT COALESCE(MAX(priority), 0) FROM tasks WHERE queue = ?",
+                (self.name,)
+            ).fetchone()
+            cursor = self._conn.executemany(
+                "INSERT OR IGNORE INTO tasks (queue, repo, priority, data, status)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (
+                    (self.name, repo[0], start + i, json.dumps(list(repo)), PENDING)
+                    for i, repo in enumerate(repos, 1)
+                )
+            )
+            self._conn.commit()
+        return cursor.rowcount
+
+    def claim(self):
+        """
+        Leases the next repo in the queue to this worker: a pending one, or
+        one whose lease ran out. Repos whose lease ran out on their last
+        attempt are marked failed instead.
+
+        Returns its 5-tuple, or None if there's nothing left to claim.
+        """
+        now = time.time()
+        with self._lock:
+            # take the write lock up front, so two workers can't both read
+            # the same row as free
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute(
+                    "UPDATE tasks SET status = ?, error = ?, lease_until = NULL"
+                    " WHERE queue = ? AND status = ? AND lease_until < ? AND attempts >= ?",
+                    (FAILED, "lease ran out", self.name, CLAIMED, now, MAX_ATTEMPTS)
+                )
+                row = self._conn.execute(
+                    "SELECT repo, data FROM tasks WHERE queue = ? AND attempts < ?"
+                    " AND (status = ? OR (status = ? AND lease_until < ?))"
+                    " ORDER BY priority LIMIT 1",
+                    (self.name, MAX_ATTEMPTS, PENDING, CLAIMED, now)
+                ).fetchone()
+                if row:
+                    self._conn.execute(
+                        "UPDATE tasks SET status = ?, worker = ?, lease_until = ?,"
+                        " attempts = attempts + 1 WHERE queue = ? AND repo = ?",
+                        (CLAIMED, self.worker, now + self.lease, self.name, row[0])
+                    )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return tuple(json.loads(row[1])) if row else None
+
+    def claim_repos(self):
+        """
+        Generator
+        Claims repos one at a time as they're asked for, until the queue is
+        empty. Feed it to `pipeline.repo_items`; the pipeline's bounded queues
+        keep a worker from claiming much more than it's ready to work on.
+        While it runs, a heartbeat thread keeps this worker's leases alive.
+        """
+        self._start_heartbeat()
+        count = 0
+        while True:
+            repo = self.claim()
+            if repo is None:
+                return
+            count += 1
+            LOG.info(f" {self.worker} claimed {repo[0]}")
+            # keep `count` local to this worker, like get_repos does
+            yield repo[:4] + (count,)
+
+    def finish(self, item, err=None):
+        """
+        Reports a repo (a pipeline item, or anything with a `rname` key) as
+        done, or as failed if `err` is set; fits `run_pipeline`'s `on_exit`.
+        A failed repo goes back in the queue until it's been tried
+        MAX_ATTEMPTS times.
+        """
+        if err is None:
+            status, error = DONE, None
+        else:
+            status, error = PENDING, str(err)
+        with self._lock:
+            self._conn.execute(
+                "UPDATE tasks SET status = CASE"
+                "  WHEN ? = ? AND attempts >= ? THEN ? ELSE ? END,"
+                " error = ?, lease_until = NULL"
+                " WHERE queue = ? AND repo = ? AND worker = ?",
+                (
+                    status, PENDING, MAX_ATTEMPTS, FAILED, status,
+                    error, self.name, item["rname"], self.worker
+                )
+            )
+            self._conn.commit()
+
+    def renew(self):
+        """
+        Pushes back the lease on every repo this worker holds
+        """
+        with self._lock:
+            self._conn.execute(
+                "UPDATE tasks SET lease_until = ?"
+                " WHERE queue = ? AND worker = ? AND status = ?",
+                (time.time() + self.lease, self.name, self.worker, CLAIMED)
+            )
+            self._conn.commit()
+
+    def counts(self):
+        """
+        Returns a dict of {status: number of repos}
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT status, COUNT(*) FROM tasks WHERE queue = ? GROUP BY status",
+                (self.name,)
+            ).fetchall()
+        return dict(rows)
+
+    def reset_failed(self):
+        """
+        Puts every failed repo back in the queue with a fresh set of attempts.
+        Returns how many there were.
+        """
+        with self._lock:
+            cursor = self._conn.execute(
+                "UPDATE tasks SET status = ?, attempts = 0"
+                " WHERE queue = ? AND status = ?",
+                (PENDING, self.name, FAILED)
+            )
+            self._conn.commit()
+        return cursor.rowcount
+
+    def close(self):
+        self._stop.set()
+        if self._heartbeat:
+            self._heartbeat.join()
+        with self._lock:
+            self._conn.close()
+
+    def _start_heartbeat(self):
+        if self._heartbeat:
+            return
+
+        def beat():
+            while not self._stop.wait(self.lease / 3):
+                self.renew()
+
+        self._heartbeat = threading.Thread(target=beat, daemon=True)
+        self._heartbeat.start()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Fills, or reports on, a shared queue of repos that\
+            several workers can split a campaign over."
+    )
+
+    parser.add_argument(
+        "action",
+        choices=["enqueue", "status", "reset"],
+        help="enqueue: add an org's repos; status: count repos per state;\
+            reset: retry failed repos"
+    )
+
+    parser.add_argument(
+        "name",
+        help="Name of the queue (usually the campaign, e.g. copy_file:tcril/some-branch)"
+    )
+
+    parser.add_argument(
+        "org",
+        nargs="?",
+        help="Organization whose repos to enqueue (enqueue only)"
+    )
+
+    parser.add_argument(
+        "-p", "--path",
+        help=f"Queue file (default {DEFAULT_PATH})",
+        default=DEFAULT_PATH
+    )
+
+    parser.add_argument(
+        "-P", "--exclude-private",
+        help="Don't enqueue the org's private repos",
+        action="store_true"
+    )
+
+    parser.add_argument(
+        "--order",
+        choices=["largest", "smallest"],
+        help="Hand out the biggest (or smallest) repos first (see schedule.py)"
+    )
+
+    parser.add_argument(
+        "-c", "--campaign",
+        help="With --order, go by how long repos took in this campaign (default the queue's name)"
+    )
+
+    args = parser.parse_args()
+    work_queue = WorkQueue(args.name, args.path)
+    if args.action == "enqueue":
+        if not args.org:
+            parser.error("enqueue needs an org")
+        from github_helpers import get_github_headers, get_repo_sizes, get_repos
+        gh_headers = get_github_headers()
+        repos = get_repos(gh_headers, args.org, args.exclude_private)
+        if args.order:
+            from schedule import History, order_repos
+            sizes = get_repo_sizes(gh_headers, args.org, args.exclude_private)
+            history = History(args.campaign or args.name)
+            repos = order_repos(repos, sizes, args.order, history)
+        LOG.info(f" Added {work_queue.enqueue(repos)} repos to {args.name}")
+    elif args.action == "reset":
+        LOG.info(f" Put {work_queue.reset_failed()} failed repos back in {args.name}")
+    print(json.dumps(work_queue.counts()))
+    work_queue.close()